@@ -1,10 +1,26 @@
+import binascii
+import hashlib
 import json
 import os
+import random
+import string
 from typing import Dict, Any, List
 import psycopg2
 from psycopg2.extras import RealDictCursor
-from datetime import datetime
+from runtime import http_handler, json_response, error_response, list_response, encode_cursor, decode_cursor
 
+MAX_PAGE_SIZE = 100
+
+KEY_FIELD_COLUMNS = {
+    'id': 'id',
+    'name': 'name',
+    'key': 'key_prefix as key',
+    'created': "TO_CHAR(created_at, 'YYYY-MM-DD') as created",
+    'active': 'active',
+    'requests': 'requests_count as requests'
+}
+
+@http_handler('GET, POST, PUT, DELETE', allow_headers='Content-Type, If-None-Match')
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Управление API ключами - получение, создание, обновление статуса
@@ -14,57 +30,58 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     method: str = event.get('httpMethod', 'GET')
     
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
-    
     database_url = os.environ.get('DATABASE_URL')
     if not database_url:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Database not configured'}),
-            'isBase64Encoded': False
-        }
+        return error_response(500, 'Database not configured')
     
     try:
         conn = psycopg2.connect(database_url)
         cursor = conn.cursor(cursor_factory=RealDictCursor)
         
         if method == 'GET':
-            cursor.execute('''
-                SELECT id, name, key_prefix as key, 
-                       TO_CHAR(created_at, 'YYYY-MM-DD') as created,
-                       active, requests_count as requests
-                FROM api_keys
-                ORDER BY created_at DESC
-            ''')
+            query_params = event.get('queryStringParameters') or {}
+            
+            fields = list(KEY_FIELD_COLUMNS)
+            if query_params.get('fields'):
+                fields = [f.strip() for f in query_params['fields'].split(',') if f.strip()]
+                unknown = [f for f in fields if f not in KEY_FIELD_COLUMNS]
+                if unknown:
+                    return error_response(400, f'Unknown fields: {", ".join(unknown)}')
+            
+            try:
+                limit = int(query_params['limit']) if query_params.get('limit') else None
+                after = decode_cursor(query_params['after'], int) if query_params.get('after') else None
+            except (ValueError, TypeError, binascii.Error):
+                return error_response(400, 'Invalid limit or after cursor')
+            
+            if limit is not None:
+                limit = max(1, min(limit, MAX_PAGE_SIZE))
+            
+            columns = ', '.join(KEY_FIELD_COLUMNS[f] for f in fields)
+            sql = f'SELECT {columns}, id AS cursor_id, created_at AS cursor_created_at FROM api_keys'
+            params: List[Any] = []
+            if after:
+                sql += ' WHERE (created_at, id) < (%s::timestamp, %s)'
+                params.extend(after)
+            sql += ' ORDER BY created_at DESC, id DESC'
+            if limit is not None:
+                sql += ' LIMIT %s'
+                params.append(limit + 1)
+            
+            cursor.execute(sql, params)
             keys = cursor.fetchall()
             
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps([dict(row) for row in keys]),
-                'isBase64Encoded': False
-            }
+            next_cursor = None
+            if limit is not None and len(keys) > limit:
+                keys = keys[:limit]
+                next_cursor = encode_cursor(keys[-1]['cursor_created_at'], keys[-1]['cursor_id'])
+            
+            return list_response(event, [{f: row[f] for f in fields} for row in keys], next_cursor)
         
         elif method == 'POST':
             body = json.loads(event.get('body', '{}'))
             name = body.get('name', f'New API Key')
             
-            import random
-            import string
-            import hashlib
-            
             # Generate full key: sk_live_<32 random chars>
             full_key = 'sk_live_' + ''.join(random.choices(string.ascii_lowercase + string.digits, k=32))
             
@@ -96,12 +113,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 'key': full_key  # Full key returned ONLY on creation
             }
             
-            return {
-                'statusCode': 201,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps(response_data),
-                'isBase64Encoded': False
-            }
+            return json_response(201, response_data)
         
         elif method == 'PUT':
             body = json.loads(event.get('body', '{}'))
@@ -110,12 +122,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             name = body.get('name')
             
             if key_id is None:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Missing id field'}),
-                    'isBase64Encoded': False
-                }
+                return error_response(400, 'Missing id field')
             
             if active is not None:
                 cursor.execute('''
@@ -136,76 +143,34 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                               active, requests_count as requests
                 ''', (name, key_id))
             else:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Missing active or name field'}),
-                    'isBase64Encoded': False
-                }
+                return error_response(400, 'Missing active or name field')
             
             updated_key = cursor.fetchone()
             conn.commit()
             
             if not updated_key:
-                return {
-                    'statusCode': 404,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Key not found'}),
-                    'isBase64Encoded': False
-                }
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps(dict(updated_key)),
-                'isBase64Encoded': False
-            }
+                return error_response(404, 'Key not found')
+            
+            return json_response(200, dict(updated_key))
         
         elif method == 'DELETE':
             params = event.get('queryStringParameters', {})
             key_id = params.get('id')
             
             if not key_id:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Missing id parameter'}),
-                    'isBase64Encoded': False
-                }
+                return error_response(400, 'Missing id parameter')
             
             cursor.execute('DELETE FROM api_keys WHERE id = %s RETURNING id', (key_id,))
             deleted_key = cursor.fetchone()
             conn.commit()
             
             if not deleted_key:
-                return {
-                    'statusCode': 404,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Key not found'}),
-                    'isBase64Encoded': False
-                }
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'success': True, 'id': deleted_key['id']}),
-                'isBase64Encoded': False
-            }
-        
-        return {
-            'statusCode': 405,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Method not allowed'}),
-            'isBase64Encoded': False
-        }
+                return error_response(404, 'Key not found')
+            
+            return json_response(200, {'success': True, 'id': deleted_key['id']})
         
     except Exception as e:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': str(e)}),
-            'isBase64Encoded': False
-        }
+        return error_response(500, str(e))
     finally:
         if 'cursor' in locals():
             cursor.close()
@@ -1,17 +1,79 @@
+import binascii
 import json
+import math
 import os
-from typing import Dict, Any
-from datetime import datetime, timedelta
-from decimal import Decimal
+from typing import Dict, Any, List
+from datetime import datetime
 import psycopg2
 from psycopg2.extras import RealDictCursor
+from runtime import http_handler, json_response, error_response, list_response, encode_cursor, decode_cursor
 
-class DecimalEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, Decimal):
-            return float(obj)
-        return super(DecimalEncoder, self).default(obj)
+HLL_REGISTERS = 4096
 
+def estimate_unique_users(users_hll: Any) -> int:
+    '''
+    Оценка числа уникальных пользователей по HyperLogLog-скетчу из assistant_stats
+    (4096 однобайтовых регистров, заполняются gptunnel-bot)
+    '''
+    if not users_hll:
+        return 0
+    registers = bytes(users_hll)
+    m = len(registers)
+    alpha = 0.7213 / (1 + 1.079 / m)
+    estimate = alpha * m * m / sum(2.0 ** -r for r in registers)
+    zeros = registers.count(0)
+    if estimate <= 2.5 * m and zeros:
+        estimate = m * math.log(m / zeros)
+    return int(round(estimate))
+
+MAX_PAGE_SIZE = 100
+
+ROUTING_STRATEGIES = ('cheapest', 'fastest', 'fallback')
+
+def routing_policy_json(policy: Any) -> Any:
+    '''
+    JSON политики маршрутизации для assistants.routing_policy (разбирает её routing.py
+    в gptunnel-bot и v1-chat-completions); None отключает маршрутизацию
+    '''
+    if policy is None:
+        return None
+    if not isinstance(policy, dict):
+        raise ValueError('routingPolicy must be an object')
+    models = policy.get('models')
+    if not isinstance(models, list) or not models or not all(isinstance(m, str) and m for m in models):
+        raise ValueError('routingPolicy.models must be a non-empty list of model names')
+    if policy.get('strategy', 'fallback') not in ROUTING_STRATEGIES:
+        raise ValueError(f"routingPolicy.strategy must be one of: {', '.join(ROUTING_STRATEGIES)}")
+    return json.dumps(policy)
+
+ASSISTANT_FIELDS = {
+    'id': ('a.id', lambda r: r['id']),
+    'name': ('a.name', lambda r: r['name']),
+    'type': ('a.type', lambda r: r.get('type', 'simple')),
+    'firstMessage': ('a.first_message', lambda r: r['first_message']),
+    'instructions': ('a.instructions', lambda r: r['instructions']),
+    'model': ('a.model', lambda r: r['model']),
+    'contextLength': ('a.context_length', lambda r: r['context_length']),
+    'humanEmulation': ('a.human_emulation', lambda r: r['human_emulation']),
+    'creativity': ('a.creativity', lambda r: float(r['creativity'])),
+    'voiceRecognition': ('a.voice_recognition', lambda r: r['voice_recognition']),
+    'moderationEnabled': ('a.moderation_enabled', lambda r: r['moderation_enabled']),
+    'routingPolicy': ('a.routing_policy', lambda r: r.get('routing_policy')),
+    'ragDatabaseIds': ('a.rag_database_ids', lambda r: r.get('rag_database_ids') or []),
+    'assistantCode': ('a.assistant_code', lambda r: r.get('assistant_code')),
+    'status': ('a.status', lambda r: r['status']),
+    'created_at': ('a.created_at', lambda r: r['created_at'].isoformat() if r['created_at'] else None),
+    'stats': (
+        'COALESCE(s.total_messages, 0) as total_messages, COALESCE(s.total_tokens, 0) as total_tokens, s.users_hll',
+        lambda r: {
+            'totalMessages': int(r['total_messages']),
+            'totalTokens': int(r['total_tokens']),
+            'uniqueUsers': estimate_unique_users(r['users_hll'])
+        }
+    )
+}
+
+@http_handler('GET, POST, PUT, DELETE', allow_headers='Content-Type, If-None-Match')
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Управление AI ассистентами с сохранением в БД и статистикой
@@ -20,27 +82,9 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     method: str = event.get('httpMethod', 'GET')
     
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
-    
     database_url = os.environ.get('DATABASE_URL')
     if not database_url:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Database not configured'}, cls=DecimalEncoder),
-            'isBase64Encoded': False
-        }
+        return error_response(500, 'Database not configured')
     
     conn = None
     cursor = None
@@ -50,50 +94,54 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         cursor = conn.cursor(cursor_factory=RealDictCursor)
         
         if method == 'GET':
-            cursor.execute('''
-                SELECT 
-                    a.*,
-                    COALESCE(SUM(u.message_count), 0) as total_messages,
-                    COALESCE(SUM(u.tokens_used), 0) as total_tokens,
-                    COUNT(DISTINCT u.user_id) as unique_users
+            query_params = event.get('queryStringParameters') or {}
+            
+            fields = list(ASSISTANT_FIELDS)
+            if query_params.get('fields'):
+                fields = [f.strip() for f in query_params['fields'].split(',') if f.strip()]
+                unknown = [f for f in fields if f not in ASSISTANT_FIELDS]
+                if unknown:
+                    return error_response(400, f'Unknown fields: {", ".join(unknown)}')
+            
+            try:
+                limit = int(query_params['limit']) if query_params.get('limit') else None
+                after = decode_cursor(query_params['after']) if query_params.get('after') else None
+            except (ValueError, TypeError, binascii.Error):
+                return error_response(400, 'Invalid limit or after cursor')
+            
+            if limit is not None:
+                limit = max(1, min(limit, MAX_PAGE_SIZE))
+            
+            columns = ', '.join(ASSISTANT_FIELDS[f][0] for f in fields)
+            sql = f'''
+                SELECT {columns}, a.id AS cursor_id, a.created_at AS cursor_created_at
                 FROM assistants a
-                LEFT JOIN assistant_usage u ON a.id = u.assistant_id
+                LEFT JOIN assistant_stats s ON s.assistant_id = a.id
                 WHERE a.status = 'active'
-                GROUP BY a.id
-                ORDER BY a.created_at DESC
-            ''')
+            '''
+            params: List[Any] = []
+            if after:
+                sql += ' AND (a.created_at, a.id) < (%s::timestamp, %s)'
+                params.extend(after)
+            sql += ' ORDER BY a.created_at DESC, a.id DESC'
+            if limit is not None:
+                sql += ' LIMIT %s'
+                params.append(limit + 1)
+            
+            cursor.execute(sql, params)
             assistants = cursor.fetchall()
             
-            result = []
-            for assistant in assistants:
-                result.append({
-                    'id': assistant['id'],
-                    'name': assistant['name'],
-                    'type': assistant.get('type', 'simple'),
-                    'firstMessage': assistant['first_message'],
-                    'instructions': assistant['instructions'],
-                    'model': assistant['model'],
-                    'contextLength': assistant['context_length'],
-                    'humanEmulation': assistant['human_emulation'],
-                    'creativity': float(assistant['creativity']),
-                    'voiceRecognition': assistant['voice_recognition'],
-                    'ragDatabaseIds': assistant.get('rag_database_ids') or [],
-                    'assistantCode': assistant.get('assistant_code'),
-                    'status': assistant['status'],
-                    'created_at': assistant['created_at'].isoformat() if assistant['created_at'] else None,
-                    'stats': {
-                        'totalMessages': int(assistant['total_messages']),
-                        'totalTokens': int(assistant['total_tokens']),
-                        'uniqueUsers': int(assistant['unique_users'])
-                    }
-                })
+            next_cursor = None
+            if limit is not None and len(assistants) > limit:
+                assistants = assistants[:limit]
+                next_cursor = encode_cursor(assistants[-1]['cursor_created_at'], assistants[-1]['cursor_id'])
             
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'isBase64Encoded': False,
-                'body': json.dumps(result, cls=DecimalEncoder)
-            }
+            result = [
+                {field: ASSISTANT_FIELDS[field][1](assistant) for field in fields}
+                for assistant in assistants
+            ]
+            
+            return list_response(event, result, next_cursor)
         
         if method == 'POST':
             body_data = json.loads(event.get('body', '{}'))
@@ -105,12 +153,17 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             assistant_type = body_data.get('type', 'simple')
             assistant_code = body_data.get('assistantCode') if assistant_type == 'external' else None
             
+            try:
+                routing_policy = routing_policy_json(body_data.get('routingPolicy'))
+            except ValueError as e:
+                return error_response(400, str(e))
+            
             cursor.execute('''
                 INSERT INTO assistants (
                     id, name, type, first_message, instructions, model,
                     context_length, human_emulation, creativity,
-                    voice_recognition, rag_database_ids, assistant_code, status
-                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                    voice_recognition, moderation_enabled, routing_policy, rag_database_ids, assistant_code, status
+                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
                 RETURNING *
             ''', (
                 assistant_id,
@@ -123,6 +176,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 body_data.get('humanEmulation', 5),
                 body_data.get('creativity', 0.7),
                 body_data.get('voiceRecognition', False),
+                body_data.get('moderationEnabled', False),
+                routing_policy,
                 rag_database_ids,
                 assistant_code,
                 'active'
@@ -142,6 +197,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 'humanEmulation': new_assistant['human_emulation'],
                 'creativity': float(new_assistant['creativity']),
                 'voiceRecognition': new_assistant['voice_recognition'],
+                'moderationEnabled': new_assistant['moderation_enabled'],
+                'routingPolicy': new_assistant.get('routing_policy'),
                 'ragDatabaseIds': new_assistant.get('rag_database_ids') or [],
                 'assistantCode': new_assistant.get('assistant_code'),
                 'status': new_assistant['status'],
@@ -153,28 +210,24 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 }
             }
             
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'isBase64Encoded': False,
-                'body': json.dumps(result, cls=DecimalEncoder)
-            }
+            return json_response(200, result)
         
         if method == 'PUT':
             body_data = json.loads(event.get('body', '{}'))
             assistant_id = body_data.get('id')
             
             if not assistant_id:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Assistant ID required'}, cls=DecimalEncoder),
-                    'isBase64Encoded': False
-                }
+                return error_response(400, 'Assistant ID required')
             
             assistant_type = body_data.get('type', 'simple')
             assistant_code = body_data.get('assistantCode') if assistant_type == 'external' else None
             
+            # routingPolicy без ключа в теле не меняется, null — отключает маршрутизацию
+            try:
+                routing_policy = routing_policy_json(body_data.get('routingPolicy'))
+            except ValueError as e:
+                return error_response(400, str(e))
+            
             cursor.execute('''
                 UPDATE assistants
                 SET name = %s,
@@ -186,6 +239,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     human_emulation = %s,
                     creativity = %s,
                     voice_recognition = %s,
+                    moderation_enabled = COALESCE(%s, moderation_enabled),
+                    routing_policy = CASE WHEN %s THEN %s::jsonb ELSE routing_policy END,
                     rag_database_ids = %s,
                     assistant_code = %s,
                     updated_at = CURRENT_TIMESTAMP
@@ -201,6 +256,9 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 body_data.get('humanEmulation'),
                 body_data.get('creativity'),
                 body_data.get('voiceRecognition'),
+                body_data.get('moderationEnabled'),
+                'routingPolicy' in body_data,
+                routing_policy,
                 body_data.get('ragDatabaseIds', []),
                 assistant_code,
                 assistant_id
@@ -209,25 +267,17 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             updated = cursor.fetchone()
             
             if not updated:
-                return {
-                    'statusCode': 404,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Assistant not found'}, cls=DecimalEncoder),
-                    'isBase64Encoded': False
-                }
+                return error_response(404, 'Assistant not found')
             
             conn.commit()
             
             cursor.execute('''
-                SELECT 
-                    COALESCE(SUM(message_count), 0) as total_messages,
-                    COALESCE(SUM(tokens_used), 0) as total_tokens,
-                    COUNT(DISTINCT user_id) as unique_users
-                FROM assistant_usage
+                SELECT total_messages, total_tokens, users_hll
+                FROM assistant_stats
                 WHERE assistant_id = %s
             ''', (assistant_id,))
             
-            stats = cursor.fetchone()
+            stats = cursor.fetchone() or {'total_messages': 0, 'total_tokens': 0, 'users_hll': None}
             
             result = {
                 'id': updated['id'],
@@ -240,6 +290,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 'humanEmulation': updated['human_emulation'],
                 'creativity': float(updated['creativity']),
                 'voiceRecognition': updated['voice_recognition'],
+                'moderationEnabled': updated['moderation_enabled'],
+                'routingPolicy': updated.get('routing_policy'),
                 'ragDatabaseIds': updated.get('rag_database_ids') or [],
                 'assistantCode': updated.get('assistant_code'),
                 'status': updated['status'],
@@ -247,55 +299,28 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 'stats': {
                     'totalMessages': int(stats['total_messages']),
                     'totalTokens': int(stats['total_tokens']),
-                    'uniqueUsers': int(stats['unique_users'])
+                    'uniqueUsers': estimate_unique_users(stats['users_hll'])
                 }
             }
             
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'isBase64Encoded': False,
-                'body': json.dumps(result, cls=DecimalEncoder)
-            }
+            return json_response(200, result)
         
         if method == 'DELETE':
             params = event.get('queryStringParameters', {})
             assistant_id = params.get('id')
             
             if not assistant_id:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Assistant ID required'}, cls=DecimalEncoder),
-                    'isBase64Encoded': False
-                }
+                return error_response(400, 'Assistant ID required')
             
             cursor.execute('UPDATE assistants SET status = %s WHERE id = %s', ('inactive', assistant_id))
             conn.commit()
             
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'isBase64Encoded': False,
-                'body': json.dumps({'success': True}, cls=DecimalEncoder)
-            }
-        
-        return {
-            'statusCode': 405,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Method not allowed'}, cls=DecimalEncoder),
-            'isBase64Encoded': False
-        }
+            return json_response(200, {'success': True})
     
     except Exception as e:
         if conn:
             conn.rollback()
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': str(e)}, cls=DecimalEncoder),
-            'isBase64Encoded': False
-        }
+        return error_response(500, str(e))
     
     finally:
         if cursor:
@@ -0,0 +1,584 @@
+'''
+Общий рантайм облачных функций: маршрутизация по HTTP-методу (CORS preflight, 405),
+сборка JSON-ответов, сжатие, проверка клиентских API-ключей, ленивые тяжёлые импорты
+и прогрев контейнера по расписанию.
+Каждая функция деплоится из своего каталога, поэтому модуль лежит копией рядом с index.py —
+копии во всех каталогах backend/ должны совпадать (это проверяет bench/cold_start.py).
+'''
+import base64
+import contextlib
+import functools
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+import weakref
+import zlib
+from datetime import datetime
+from decimal import Decimal
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+GPTUNNEL_DEFAULT_BASE_URL = 'https://gptunnel.ru'
+
+JSON_HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+
+COMPRESS_MIN_BYTES = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+# Шаблон gzip-компрессора создаётся один раз на контейнер, на каждый ответ берётся его copy()
+_gzip_template = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+Handler = Callable[[Dict[str, Any], Any], Dict[str, Any]]
+
+class DecimalEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, Decimal):
+            return float(obj)
+        return super(DecimalEncoder, self).default(obj)
+
+def json_dumps(data: Any, **kwargs) -> str:
+    kwargs['cls'] = DecimalEncoder
+    return json.dumps(data, **kwargs)
+
+def raw_response(status_code: int, body: str, headers: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    return {
+        'statusCode': status_code,
+        'headers': {**JSON_HEADERS, **(headers or {})},
+        'body': body,
+        'isBase64Encoded': False
+    }
+
+def json_response(status_code: int, data: Any, headers: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    return raw_response(status_code, json_dumps(data), headers)
+
+def error_response(status_code: int, message: Any, **extra: Any) -> Dict[str, Any]:
+    return json_response(status_code, {'error': message, **extra})
+
+def preflight_response(methods: str, allow_headers: str) -> Dict[str, Any]:
+    return {
+        'statusCode': 200,
+        'headers': {
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Methods': f'{methods}, OPTIONS',
+            'Access-Control-Allow-Headers': allow_headers,
+            'Access-Control-Max-Age': '86400'
+        },
+        'body': '',
+        'isBase64Encoded': False
+    }
+
+def http_handler(
+    methods: str, allow_headers: str = 'Content-Type', compress: bool = True,
+    warmup: Optional[Callable[[Dict[str, Any]], None]] = None
+) -> Callable[[Handler], Handler]:
+    '''
+    Декоратор handler: отвечает на CORS preflight, возвращает 405 для методов вне списка
+    и сжимает ответ. Первый метод в списке используется, если httpMethod не передан.
+    Если задан warmup, событие прогрева (см. is_warmup_event) не доходит до handler:
+    warmup заполняет отчёт шагами warmup_step, отчёт возвращается ответом.
+    '''
+    allowed = [m.strip() for m in methods.split(',')]
+
+    def decorator(func: Handler) -> Handler:
+        invocations = 0
+
+        @functools.wraps(func)
+        def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+            nonlocal invocations
+            invocations += 1
+            if warmup is not None and is_warmup_event(event):
+                return warmup_response(warmup, invocations)
+            method = event.get('httpMethod') or allowed[0]
+            if method == 'OPTIONS':
+                return preflight_response(methods, allow_headers)
+            if method not in allowed:
+                return error_response(405, 'Method not allowed')
+            response = func(event, context)
+            return compress_response(event, response) if compress else response
+        return wrapper
+    return decorator
+
+# Момент импорта модуля — начало жизни контейнера
+_container_started = time.monotonic()
+
+def timer_payload(event: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    '''
+    payload таймер-триггера (messages[0].details.payload) как dict; None, если событие не от триггера
+    '''
+    messages = event.get('messages')
+    if not messages or not isinstance(messages, list):
+        return None
+    payload = (messages[0].get('details') or {}).get('payload')
+    try:
+        data = json.loads(payload) if payload else {}
+    except ValueError:
+        data = {}
+    return data if isinstance(data, dict) else {}
+
+def is_warmup_event(event: Dict[str, Any]) -> bool:
+    '''
+    Прогрев: вызов таймер-триггером (если в payload нет "warmup": false) или тело {"warmup": true}
+    с заголовком X-Warmup-Token, равным секрету WARMUP_TOKEN. Эндпоинты публичные, а прогрев
+    тратит ресурсы (rag-databases продолжает загрузки документов), поэтому без секрета
+    тело {"warmup": true} — обычный запрос
+    '''
+    payload = timer_payload(event)
+    if payload is not None:
+        return payload.get('warmup', True) is not False
+    token = os.environ.get('WARMUP_TOKEN')
+    if not token or not hmac.compare_digest((get_header(event, 'X-Warmup-Token') or '').encode(), token.encode()):
+        return False
+    body = event.get('body')
+    if not body or '"warmup"' not in body:
+        return False
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return False
+    return isinstance(data, dict) and data.get('warmup') is True
+
+def warmup_step(report: Dict[str, Any], name: str, step: Callable[..., Any], *args: Any) -> Any:
+    '''
+    Выполняет шаг прогрева и пишет в report его время (и результат, если это простое значение).
+    Ошибка шага попадает в отчёт и не прерывает остальные шаги.
+    '''
+    started = time.monotonic()
+    result = None
+    try:
+        result = step(*args)
+        entry: Dict[str, Any] = {'result': result} if isinstance(result, (dict, list, str, int, float)) else {}
+    except Exception as e:
+        entry = {'error': str(e)}
+    entry['elapsedMs'] = round((time.monotonic() - started) * 1000, 1)
+    report[name] = entry
+    return result
+
+def warmup_response(warmup: Callable[[Dict[str, Any]], None], invocations: int) -> Dict[str, Any]:
+    started = time.monotonic()
+    steps: Dict[str, Any] = {}
+    warmup(steps)
+    elapsed_ms = round((time.monotonic() - started) * 1000, 1)
+    print(f"[WARMUP] {elapsed_ms}ms, invocations={invocations}, steps={json_dumps(steps)}")
+    return json_response(200, {
+        'warmup': True,
+        'coldStart': invocations == 1,
+        'containerAgeSeconds': int(time.monotonic() - _container_started),
+        'steps': steps,
+        'elapsedMs': elapsed_ms
+    })
+
+def get_header(event: Dict[str, Any], name: str) -> Optional[str]:
+    headers = event.get('headers') or {}
+    name = name.lower()
+    for key, value in headers.items():
+        if key.lower() == name:
+            return value
+    return None
+
+def encode_cursor(created_at: Any, row_id: Any) -> str:
+    raw = json.dumps([created_at.isoformat(), row_id])
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor: str, id_type: type = str) -> Tuple[str, Any]:
+    '''
+    Разбор курсора keyset-пагинации: [created_at в ISO 8601, id типа id_type].
+    ValueError/binascii.Error при повреждённом значении — до запроса в базу, чтобы ответ был 400
+    '''
+    padded = cursor + '=' * (-len(cursor) % 4)
+    decoded = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    if not isinstance(decoded, list) or len(decoded) != 2:
+        raise ValueError('Cursor must be a [created_at, id] pair')
+    created_at, row_id = decoded
+    if not isinstance(created_at, str):
+        raise ValueError('Cursor created_at must be a string')
+    datetime.fromisoformat(created_at)
+    if not isinstance(row_id, id_type) or isinstance(row_id, bool):
+        raise ValueError(f'Cursor id must be {id_type.__name__}')
+    return created_at, row_id
+
+def encoded_etag(etag: str, encoding: str) -> str:
+    '''
+    ETag сжатого представления: у каждой кодировки свой сильный валидатор ("abc" -> "abc-gzip")
+    '''
+    return etag[:-1] + f'-{encoding}"' if etag.endswith('"') else etag
+
+def matching_etag(event: Dict[str, Any], etag: str) -> Optional[str]:
+    '''
+    Валидатор из If-None-Match, совпавший с etag или с его сжатым вариантом (клиент хранит тот ETag,
+    с которым получил тело); None, если совпадений нет
+    '''
+    if_none_match = get_header(event, 'If-None-Match')
+    if not if_none_match:
+        return None
+    variants = {etag, *(encoded_etag(etag, encoding) for encoding in ('gzip', 'br'))}
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag == '*':
+            return etag
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag in variants:
+            return tag
+    return None
+
+def etag_matches(event: Dict[str, Any], etag: str) -> bool:
+    return matching_etag(event, etag) is not None
+
+def list_response(event: Dict[str, Any], items: List[Dict[str, Any]], next_cursor: Optional[str]) -> Dict[str, Any]:
+    '''
+    Ответ со списком: ETag по содержимому, 304 при совпадении If-None-Match,
+    курсор следующей страницы в заголовке X-Next-Cursor (тело остаётся массивом)
+    '''
+    body = json_dumps(items)
+    etag = '"' + hashlib.md5(body.encode('utf-8')).hexdigest() + '"'
+    headers = {
+        **JSON_HEADERS,
+        'Access-Control-Expose-Headers': 'ETag, X-Next-Cursor',
+        'ETag': etag
+    }
+    if next_cursor:
+        headers['X-Next-Cursor'] = next_cursor
+
+    if etag_matches(event, etag):
+        return {'statusCode': 304, 'headers': headers, 'body': '', 'isBase64Encoded': False}
+
+    return {'statusCode': 200, 'headers': headers, 'body': body, 'isBase64Encoded': False}
+
+def negotiate_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    '''
+    Выбор кодировки по Accept-Encoding с учётом q-значений: br (если доступен brotli), затем gzip
+    '''
+    if not accept_encoding:
+        return None
+
+    accepted: Dict[str, float] = {}
+    for part in accept_encoding.split(','):
+        token, _, params = part.strip().partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[token.strip().lower()] = quality
+
+    for encoding in ('br', 'gzip'):
+        if encoding == 'br' and brotli is None:
+            continue
+        if accepted.get(encoding, accepted.get('*', 0.0)) > 0:
+            return encoding
+    return None
+
+def compress_body(data: bytes, encoding: str) -> bytes:
+    if encoding == 'br':
+        return brotli.compress(data, mode=brotli.MODE_TEXT, quality=BROTLI_QUALITY)
+    compressor = _gzip_template.copy()
+    return compressor.compress(data) + compressor.flush()
+
+def vary_accept_encoding(headers: Dict[str, str]) -> Dict[str, str]:
+    vary = headers.get('Vary')
+    if not vary:
+        return {**headers, 'Vary': 'Accept-Encoding'}
+    if 'accept-encoding' in (name.strip().lower() for name in vary.split(',')):
+        return dict(headers)
+    return {**headers, 'Vary': f'{vary}, Accept-Encoding'}
+
+def compress_response(event: Dict[str, Any], response: Dict[str, Any], min_size: int = COMPRESS_MIN_BYTES) -> Dict[str, Any]:
+    '''
+    Сжимает тело ответа, если клиент это поддерживает и тело больше порога.
+    Сжатое тело отдаётся в base64 с isBase64Encoded=True — шлюз функций декодирует его сам.
+    Представление зависит от Accept-Encoding, поэтому Vary отдаётся и на несжатые ответы и на 304
+    (иначе общий кэш отдаст gzip клиенту без его поддержки), а ETag сжатого тела получает
+    суффикс кодировки; 304 повторяет валидатор, который прислал клиент.
+    '''
+    body = response.get('body')
+    headers = response.get('headers') or {}
+    status = response.get('statusCode')
+    if (
+        not isinstance(body, str)
+        or response.get('isBase64Encoded')
+        or status == 204
+        or 'Content-Encoding' in headers
+    ):
+        return response
+
+    headers = vary_accept_encoding(headers)
+    if status == 304:
+        if headers.get('ETag'):
+            headers['ETag'] = matching_etag(event, headers['ETag']) or headers['ETag']
+        return {**response, 'headers': headers}
+
+    raw = body.encode('utf-8')
+    encoding = negotiate_encoding(get_header(event, 'Accept-Encoding')) if len(raw) >= min_size else None
+    compressed = compress_body(raw, encoding) if encoding else None
+    if compressed is None or len(compressed) >= len(raw):
+        return {**response, 'headers': headers}
+
+    headers['Content-Encoding'] = encoding
+    if headers.get('ETag'):
+        headers['ETag'] = encoded_etag(headers['ETag'], encoding)
+    return {
+        **response,
+        'headers': headers,
+        'body': base64.b64encode(compressed).decode('ascii'),
+        'isBase64Encoded': True
+    }
+
+def gptunnel_url(path: str) -> str:
+    '''
+    Адрес метода GPTunnel; GPTUNNEL_BASE_URL подменяет хост (например, локальной заглушкой из bench/)
+    '''
+    return os.environ.get('GPTUNNEL_BASE_URL', GPTUNNEL_DEFAULT_BASE_URL).rstrip('/') + path
+
+_requests_module = None
+_http_session = None
+
+def lazy_requests():
+    '''
+    requests импортируется при первом обращении, а не при холодном старте
+    '''
+    global _requests_module
+    if _requests_module is None:
+        import requests
+        _requests_module = requests
+    return _requests_module
+
+def http_session():
+    '''
+    Общая requests.Session с keep-alive: TCP/TLS-соединения переживают тёплые вызовы
+    '''
+    global _http_session
+    if _http_session is None:
+        requests = lazy_requests()
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        _http_session = session
+    return _http_session
+
+UPSTREAM_MAX_IDLE_CONNECTIONS = 8
+UPSTREAM_IDLE_TIMEOUT = 60
+
+# (scheme, host, port) -> [(http.client-соединение, last_used)]
+_upstream_idle: Dict[Tuple[str, str, int], List[Tuple[Any, float]]] = {}
+_upstream_lock = threading.Lock()
+
+def _upstream_origin(url: str) -> Tuple[Tuple[str, str, int], str]:
+    from urllib.parse import urlsplit
+    parts = urlsplit(url)
+    port = parts.port or (443 if parts.scheme == 'https' else 80)
+    path = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+    return (parts.scheme, parts.hostname, port), path
+
+def _take_upstream_connection(origin: Tuple[str, str, int], timeout: float) -> Tuple[Any, bool]:
+    now = time.monotonic()
+    with _upstream_lock:
+        idle = _upstream_idle.get(origin) or []
+        while idle:
+            conn, last_used = idle.pop()
+            if conn.sock is not None and now - last_used < UPSTREAM_IDLE_TIMEOUT:
+                conn.timeout = timeout
+                conn.sock.settimeout(timeout)
+                return conn, True
+            conn.close()
+    import http.client
+    scheme, host, port = origin
+    connection_class = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+    return connection_class(host, port, timeout=timeout), False
+
+def _release_upstream_connection(origin: Tuple[str, str, int], conn: Any) -> None:
+    with _upstream_lock:
+        idle = _upstream_idle.setdefault(origin, [])
+        if len(idle) < UPSTREAM_MAX_IDLE_CONNECTIONS:
+            idle.append((conn, time.monotonic()))
+            return
+    conn.close()
+
+def upstream_request(
+    url: str, data: Optional[bytes] = None, headers: Optional[Dict[str, str]] = None,
+    method: Optional[str] = None, timeout: float = 60
+) -> bytes:
+    '''
+    Тело ответа апстрима, как urllib.request.urlopen(...).read(), но по keep-alive соединению
+    контейнера: TCP и TLS не повторяются на каждый запрос. Ошибки те же, что у urlopen:
+    HTTPError со статусом и телом, URLError при сетевой ошибке. Соединение, которое сервер
+    закрыл за время простоя, молча заменяется новым.
+    '''
+    import http.client
+    import io
+    import urllib.error
+    origin, path = _upstream_origin(url)
+    method = method or ('POST' if data is not None else 'GET')
+    while True:
+        conn, reused = _take_upstream_connection(origin, timeout)
+        try:
+            conn.request(method, path, body=data, headers=headers or {})
+            response = conn.getresponse()
+            body = response.read()
+        except (http.client.HTTPException, OSError) as e:
+            conn.close()
+            if reused and isinstance(e, (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError)):
+                continue
+            raise urllib.error.URLError(e)
+        if response.will_close:
+            conn.close()
+        else:
+            _release_upstream_connection(origin, conn)
+        if response.status >= 400:
+            raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, io.BytesIO(body))
+        return body
+
+def warm_upstream(url: str, timeout: float = 5) -> None:
+    '''
+    Заранее открывает keep-alive соединение (TCP + TLS) к хосту url для upstream_request
+    '''
+    origin, _ = _upstream_origin(url)
+    conn, reused = _take_upstream_connection(origin, timeout)
+    if not reused:
+        conn.connect()
+    _release_upstream_connection(origin, conn)
+
+DB_POOL_MAX_CONNECTIONS = 4
+DB_IDLE_TIMEOUT = 300
+
+class ConnectionPool:
+    '''
+    Соединения psycopg2 на контейнер: открываются по требованию, переживают тёплые вызовы,
+    простаивавшие дольше DB_IDLE_TIMEOUT закрываются. При исчерпании getconn ждёт, а не падает.
+    Соединения в autocommit: несколько операторов в одном execute выполняются одной неявной
+    транзакцией за один round trip.
+    '''
+    def __init__(self, database_url: str, max_connections: int = DB_POOL_MAX_CONNECTIONS):
+        self.database_url = database_url
+        self.idle: List[Tuple[Any, float]] = []
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(max_connections)
+
+    def getconn(self) -> Any:
+        self.slots.acquire()
+        try:
+            now = time.monotonic()
+            while True:
+                with self.lock:
+                    conn, last_used = self.idle.pop() if self.idle else (None, now)
+                if conn is None:
+                    import psycopg2
+                    conn = psycopg2.connect(self.database_url)
+                    conn.autocommit = True
+                    return conn
+                if not conn.closed and now - last_used < DB_IDLE_TIMEOUT:
+                    return conn
+                conn.close()
+        except Exception:
+            self.slots.release()
+            raise
+
+    def putconn(self, conn: Any, discard: bool = False) -> None:
+        try:
+            if discard or conn.closed:
+                conn.close()
+            else:
+                with self.lock:
+                    self.idle.append((conn, time.monotonic()))
+        finally:
+            self.slots.release()
+
+_db_pools: Dict[str, ConnectionPool] = {}
+_db_pools_lock = threading.Lock()
+
+def db_pool(database_url: str) -> ConnectionPool:
+    pool = _db_pools.get(database_url)
+    if pool is None:
+        with _db_pools_lock:
+            pool = _db_pools.setdefault(database_url, ConnectionPool(database_url))
+    return pool
+
+@contextlib.contextmanager
+def db_cursor(database_url: str, cursor_factory: Any = None):
+    '''
+    Курсор на соединении из пула контейнера; соединение с ошибкой не возвращается в пул
+    '''
+    pool = db_pool(database_url)
+    conn = pool.getconn()
+    discard = False
+    try:
+        cursor = conn.cursor(cursor_factory=cursor_factory)
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+    except Exception:
+        from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+        discard = bool(conn.closed) or conn.info.transaction_status != TRANSACTION_STATUS_IDLE
+        raise
+    finally:
+        pool.putconn(conn, discard)
+
+def warm_database(database_url: str) -> None:
+    '''
+    Открывает соединение пула контейнера заранее, чтобы первый запрос не платил за connect
+    '''
+    with db_cursor(database_url) as cursor:
+        cursor.execute('SELECT 1')
+
+# Имена prepared statements, уже подготовленных на каждом соединении
+_prepared_statements: 'weakref.WeakKeyDictionary[Any, set]' = weakref.WeakKeyDictionary()
+
+def execute_prepared(cursor: Any, name: str, param_types: Tuple[str, ...], statement: str, params: Tuple[Any, ...]) -> None:
+    '''
+    Выполняет серверный prepared statement (параметры в statement — $1, $2, ...).
+    PREPARE уходит на соединение один раз, в одном round trip с первым EXECUTE; дальше запрос
+    не разбирается и не планируется заново. При ошибке соединение закрывается, чтобы не гадать,
+    успел ли PREPARE выполниться.
+    '''
+    conn = cursor.connection
+    prepared = _prepared_statements.setdefault(conn, set())
+    execute = f'EXECUTE {name} ({", ".join(["%s"] * len(params))})'
+    try:
+        if name in prepared:
+            cursor.execute(execute, params)
+        else:
+            cursor.execute(f'PREPARE {name} ({", ".join(param_types)}) AS {statement}; {execute}', params)
+            prepared.add(name)
+    except Exception:
+        _prepared_statements.pop(conn, None)
+        conn.close()
+        raise
+
+def authenticate_client(event: Dict[str, Any], database_url: str) -> Optional[Dict[str, Any]]:
+    '''
+    Проверка Bearer-ключа клиента по sha256-хэшу в api_keys.
+    Возвращает готовый ответ с ошибкой или None, если ключ действителен.
+    '''
+    auth_header = get_header(event, 'Authorization') or ''
+    if not auth_header.startswith('Bearer '):
+        return error_response(401, 'Missing or invalid authorization header')
+
+    key_hash = hashlib.sha256(auth_header[7:].encode()).hexdigest()
+
+    try:
+        import psycopg2
+        conn = psycopg2.connect(database_url)
+        cursor = conn.cursor()
+        cursor.execute('SELECT active FROM api_keys WHERE key_hash = %s', (key_hash,))
+        result = cursor.fetchone()
+        cursor.close()
+        conn.close()
+    except Exception as e:
+        return error_response(500, f'Authentication error: {str(e)}')
+
+    if not result:
+        return error_response(401, 'Invalid API key')
+    if not result[0]:
+        return error_response(403, 'API key is disabled')
+    return None
@@ -1,9 +1,59 @@
+import binascii
+import hashlib
 import json
 import os
+import time
 import psycopg2
 from psycopg2.extras import RealDictCursor
-from typing import Dict, Any, List
+from runtime import http_handler, json_response, error_response, list_response, encode_cursor, decode_cursor, etag_matches, JSON_HEADERS
+from typing import Dict, Any, List, Optional, Tuple
 
+MAX_PAGE_SIZE = 100
+
+CHAT_FIELDS = ['id', 'name', 'config', 'code', 'created_at']
+
+WIDGET_CACHE_CONTROL = 'public, max-age=300, stale-while-revalidate=86400'
+CONFIG_CACHE_TTL = 60
+CONFIG_CACHE_MAX_ITEMS = 512
+
+# Сериализованные конфиги виджетов: chat_id -> (etag, body, expires_at); живёт между тёплыми вызовами
+_config_cache: Dict[str, Tuple[str, str, float]] = {}
+
+def get_cached_config(chat_id: str) -> Optional[Tuple[str, str]]:
+    entry = _config_cache.get(chat_id)
+    if not entry:
+        return None
+    etag, body, expires_at = entry
+    if expires_at < time.monotonic():
+        _config_cache.pop(chat_id, None)
+        return None
+    return etag, body
+
+def put_cached_config(chat_id: str, etag: str, body: str) -> None:
+    if len(_config_cache) >= CONFIG_CACHE_MAX_ITEMS:
+        _config_cache.pop(next(iter(_config_cache)))
+    _config_cache[chat_id] = (etag, body, time.monotonic() + CONFIG_CACHE_TTL)
+
+def config_etag(chat_id: str, updated_at: Any) -> str:
+    version = updated_at.isoformat() if updated_at else ''
+    return '"' + hashlib.md5(f'{chat_id}:{version}'.encode('utf-8')).hexdigest() + '"'
+
+def config_response(event: Dict[str, Any], etag: str, body: str, cache_status: str) -> Dict[str, Any]:
+    '''
+    Конфиг виджета с заголовками для кэширования в браузере и CDN
+    '''
+    headers = {
+        **JSON_HEADERS,
+        'Access-Control-Expose-Headers': 'ETag',
+        'Cache-Control': WIDGET_CACHE_CONTROL,
+        'ETag': etag,
+        'X-Cache': cache_status
+    }
+    if etag_matches(event, etag):
+        return {'statusCode': 304, 'headers': headers, 'body': '', 'isBase64Encoded': False}
+    return {'statusCode': 200, 'headers': headers, 'body': body, 'isBase64Encoded': False}
+
+@http_handler('GET, POST, PUT, DELETE', allow_headers='Content-Type, If-None-Match')
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Manage chat widgets (CRUD operations)
@@ -12,25 +62,15 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     method: str = event.get('httpMethod', 'GET')
     
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': ''
-        }
-    
     dsn = os.environ.get('DATABASE_URL')
     if not dsn:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Database configuration missing'})
-        }
+        return error_response(500, 'Database configuration missing')
+    
+    if method == 'GET':
+        widget_chat_id = (event.get('queryStringParameters') or {}).get('id')
+        cached = get_cached_config(widget_chat_id) if widget_chat_id else None
+        if cached:
+            return config_response(event, cached[0], cached[1], 'HIT')
     
     conn = psycopg2.connect(dsn)
     cur = conn.cursor(cursor_factory=RealDictCursor)
@@ -41,40 +81,64 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             chat_id = query_params.get('id')
             
             if chat_id:
-                cur.execute('SELECT config FROM chats WHERE id = %s', (chat_id,))
+                cur.execute('SELECT config, updated_at FROM chats WHERE id = %s', (chat_id,))
                 chat = cur.fetchone()
                 
                 if not chat:
-                    return {
-                        'statusCode': 404,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Chat not found'})
-                    }
+                    return error_response(404, 'Chat not found')
+                
+                etag = config_etag(chat_id, chat['updated_at'])
+                body = json.dumps(chat['config'])
+                put_cached_config(chat_id, etag, body)
                 
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps(chat['config'])
-                }
+                return config_response(event, etag, body, 'MISS')
             
-            cur.execute('SELECT id, name, config, code, created_at FROM chats ORDER BY created_at DESC')
+            fields = CHAT_FIELDS
+            if query_params.get('fields'):
+                fields = [f.strip() for f in query_params['fields'].split(',') if f.strip()]
+                unknown = [f for f in fields if f not in CHAT_FIELDS]
+                if unknown:
+                    return error_response(400, f'Unknown fields: {", ".join(unknown)}')
+            
+            try:
+                limit = int(query_params['limit']) if query_params.get('limit') else None
+                after = decode_cursor(query_params['after']) if query_params.get('after') else None
+            except (ValueError, TypeError, binascii.Error):
+                return error_response(400, 'Invalid limit or after cursor')
+            
+            if limit is not None:
+                limit = max(1, min(limit, MAX_PAGE_SIZE))
+            
+            columns = ', '.join(dict.fromkeys(fields + ['id', 'created_at']))
+            sql = f'SELECT {columns} FROM chats'
+            params: List[Any] = []
+            if after:
+                sql += ' WHERE (created_at, id) < (%s::timestamptz, %s)'
+                params.extend(after)
+            sql += ' ORDER BY created_at DESC, id DESC'
+            if limit is not None:
+                sql += ' LIMIT %s'
+                params.append(limit + 1)
+            
+            cur.execute(sql, params)
             chats = cur.fetchall()
             
+            next_cursor = None
+            if limit is not None and len(chats) > limit:
+                chats = chats[:limit]
+                next_cursor = encode_cursor(chats[-1]['created_at'], chats[-1]['id'])
+            
             result = []
             for chat in chats:
-                result.append({
-                    'id': chat['id'],
-                    'name': chat['name'],
-                    'config': chat['config'],
-                    'code': chat['code'],
-                    'created_at': chat['created_at'].isoformat() if chat['created_at'] else None
-                })
+                item = {}
+                for field in fields:
+                    if field == 'created_at':
+                        item['created_at'] = chat['created_at'].isoformat() if chat['created_at'] else None
+                    else:
+                        item[field] = chat[field]
+                result.append(item)
             
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps(result)
-            }
+            return list_response(event, result, next_cursor)
         
         if method == 'POST':
             body_data = json.loads(event.get('body', '{}'))
@@ -84,11 +148,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             code = body_data.get('code')
             
             if not all([chat_id, name, config, code]):
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Missing required fields'})
-                }
+                return error_response(400, 'Missing required fields')
             
             cur.execute(
                 'INSERT INTO chats (id, name, config, code) VALUES (%s, %s, %s, %s) RETURNING id, name, config, code, created_at',
@@ -97,17 +157,13 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             conn.commit()
             
             chat = cur.fetchone()
-            return {
-                'statusCode': 201,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({
+            return json_response(201, {
                     'id': chat['id'],
                     'name': chat['name'],
                     'config': chat['config'],
                     'code': chat['code'],
                     'created_at': chat['created_at'].isoformat()
                 })
-            }
         
         if method == 'PUT':
             body_data = json.loads(event.get('body', '{}'))
@@ -117,63 +173,39 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             code = body_data.get('code')
             
             if not chat_id:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Chat ID required'})
-                }
+                return error_response(400, 'Chat ID required')
             
             cur.execute(
                 'UPDATE chats SET name = %s, config = %s, code = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s RETURNING id, name, config, code, created_at',
                 (name, json.dumps(config), code, chat_id)
             )
             conn.commit()
+            _config_cache.pop(chat_id, None)
             
             chat = cur.fetchone()
             if not chat:
-                return {
-                    'statusCode': 404,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Chat not found'})
-                }
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({
+                return error_response(404, 'Chat not found')
+            
+            return json_response(200, {
                     'id': chat['id'],
                     'name': chat['name'],
                     'config': chat['config'],
                     'code': chat['code'],
                     'created_at': chat['created_at'].isoformat()
                 })
-            }
         
         if method == 'DELETE':
             body_data = json.loads(event.get('body', '{}'))
             chat_id = body_data.get('id')
             
             if not chat_id:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Chat ID required'})
-                }
+                return error_response(400, 'Chat ID required')
             
             cur.execute('DELETE FROM chats WHERE id = %s', (chat_id,))
             conn.commit()
+            _config_cache.pop(chat_id, None)
             
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'success': True})
-            }
-        
-        return {
-            'statusCode': 405,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Method not allowed'})
-        }
+            return json_response(200, {'success': True})
     
     finally:
         cur.close()
@@ -1,88 +1,805 @@
 import json
+import hashlib
 import os
-from typing import Dict, Any, Optional
-import urllib.request
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional, Tuple
 import urllib.parse
 import urllib.error
-import psycopg2
 import uuid
-import time
-from datetime import datetime
-from decimal import Decimal
+from datetime import datetime, timedelta
+from runtime import (
+    http_handler, json_response, error_response, json_dumps, gptunnel_url, db_cursor, execute_prepared,
+    upstream_request, warmup_step, warm_database, warm_upstream
+)
+from routing import FAILOVER_STATUSES, RoutingPolicy, plan_route, record_failure, record_success
 
-class DecimalEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, Decimal):
-            return float(obj)
-        return super(DecimalEncoder, self).default(obj)
+# Регулярки компилируются один раз на контейнер, а не на каждый запрос
+HOTELS_PATTERN = re.compile(r'\bотел[ьия]\b')
+EXTERNAL_ACTION_JSON_PATTERN = re.compile(r'\{[^{}]*"action"[^{}]*"params"[^{}]*\}', re.DOTALL)
 
-def json_dumps(data, **kwargs):
-    kwargs['cls'] = DecimalEncoder
-    return json.dumps(data, **kwargs)
+HLL_PRECISION = 12
 
-def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+def hll_register(user_id: str):
     '''
-    Business: Проксирование запросов к GPTunnel Bot API
-    Args: event с httpMethod, body с message и assistant_id
-          context с request_id
-    Returns: HTTP response с ответом от бота
+    Регистр HyperLogLog-скетча assistant_stats.users_hll для user_id:
+    индекс = старшие 12 бит первых 8 байт md5, значение = позиция первой единицы в остальных битах
     '''
-    method: str = event.get('httpMethod', 'POST')
+    value = int.from_bytes(hashlib.md5(user_id.encode('utf-8')).digest()[:8], 'big')
+    rest_bits = 64 - HLL_PRECISION
+    rest = value & ((1 << rest_bits) - 1)
+    return value >> rest_bits, rest_bits - rest.bit_length() + 1
+
+# Пул потоков на контейнер: параллельные обращения к БД внутри одного хода, переживает тёплые вызовы
+_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='bot-io')
+
+ASSISTANT_CACHE_TTL = 60
+ASSISTANT_CACHE_MAX_ITEMS = 256
+
+RANKING_WEIGHT_NAMES = ('price', 'rating', 'distance', 'capacity')
+
+def ranking_config(raw: Any) -> Dict[str, Any]:
+    '''
+    Веса ранжирования результатов поиска из api_integrations.ranking_weights: неотрицательные числа
+    для price, rating, distance, capacity; presort — ранжировать ответ API один раз перед записью в search_cache
+    '''
+    raw = raw if isinstance(raw, dict) else {}
+    weights = {
+        name: float(raw[name]) for name in RANKING_WEIGHT_NAMES
+        if isinstance(raw.get(name), (int, float)) and not isinstance(raw.get(name), bool) and raw[name] > 0
+    }
+    return {'ranking_weights': weights or None, 'ranking_presort': bool(weights) and raw.get('presort') is True}
+
+class AssistantConfig:
+    '''
+    Настройки ассистента и его API интеграции; живёт в кэше контейнера между тёплыми вызовами
+    '''
+    __slots__ = (
+        'name', 'first_message', 'instructions', 'model', 'context_length', 'creativity',
+        'status', 'assistant_code', 'assistant_type', 'rag_database_ids', 'moderation_enabled', 'routing_policy',
+        'api_config'
+    )
     
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
+    def __init__(self, row: tuple):
+        (
+            self.name, self.first_message, self.instructions, self.model, self.context_length, self.creativity,
+            self.status, self.assistant_code, self.assistant_type, self.rag_database_ids, self.moderation_enabled
+        ) = row[:11]
+        self.routing_policy = RoutingPolicy.from_config(row[11])
+        self.api_config: Optional[Dict[str, Any]] = None
+        integration_id, *integration = row[12:]
+        if integration_id:
+            self.api_config = {
+                'name': integration[0],
+                'api_base_url': integration[1],
+                'function_name': integration[2],
+                'function_description': integration[3],
+                'function_parameters': integration[4],
+                'response_mode': integration[5]
+            }
+            self.api_config.update(ranking_config(integration[6]))
+
+# Секрет, ассистент и интеграция одним запросом; строка возвращается всегда,
+# даже если ассистента нет, чтобы отличить отсутствие ключа от отсутствия ассистента
+ASSISTANT_CONFIG_SQL = '''
+    SELECT (SELECT secret_value FROM secrets WHERE secret_name = 'GPTUNNEL_API_KEY' LIMIT 1),
+           a.id, a.name, a.first_message, a.instructions, a.model,
+           a.context_length, a.creativity, a.status, a.assistant_code, a.type, a.rag_database_ids,
+           a.moderation_enabled, a.routing_policy, i.id, i.name, i.api_base_url, i.function_name, i.function_description,
+           i.function_parameters, i.response_mode, i.ranking_weights
+    FROM (SELECT 1) AS one
+    LEFT JOIN assistants a ON a.id = $1
+    LEFT JOIN api_integrations i ON i.id = a.api_integration_id
+'''
+
+# assistant_id -> (ключ GPTunnel, конфиг, expires_at)
+_assistant_cache: Dict[str, Tuple[str, AssistantConfig, float]] = {}
+
+def load_assistant_config(database_url: str, assistant_id: str) -> Tuple[Optional[str], Optional[AssistantConfig]]:
+    '''
+    Ключ GPTunnel и конфиг ассистента: из кэша контейнера или одним prepared statement
+    '''
+    entry = _assistant_cache.get(assistant_id)
+    if entry and entry[2] > time.monotonic():
+        return entry[0], entry[1]
     
-    if method != 'POST':
-        return {
-            'statusCode': 405,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json_dumps({'error': 'Method not allowed'}),
-            'isBase64Encoded': False
-        }
+    with db_cursor(database_url) as cursor:
+        execute_prepared(cursor, 'bot_assistant_config', ('text',), ASSISTANT_CONFIG_SQL, (assistant_id,))
+        row = cursor.fetchone()
     
-    database_url = os.environ.get('DATABASE_URL')
-    if not database_url:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json_dumps({'error': 'Database not configured'}),
-            'isBase64Encoded': False
-        }
+    api_key = row[0] or None
+    if not row[1]:
+        return api_key, None
     
+    config = AssistantConfig(row[2:])
+    if api_key:
+        if len(_assistant_cache) >= ASSISTANT_CACHE_MAX_ITEMS:
+            _assistant_cache.pop(next(iter(_assistant_cache)), None)
+        _assistant_cache[assistant_id] = (api_key, config, time.monotonic() + ASSISTANT_CACHE_TTL)
+    return api_key, config
+
+MODERATION_REFUSAL = 'Сообщение нарушает правила использования, поэтому ответ на него не может быть показан.'
+MODERATION_CACHE_MAX_ITEMS = 4096
+MODERATION_VERDICT_TTL_DAYS = 30
+
+# Ключ вердикта как в v1-moderations при запросе без model: sha256('\0' + текст) -> элемент results
+_moderation_cache: Dict[str, Dict[str, Any]] = {}
+
+MODERATION_SAVE_SQL = '''
+    INSERT INTO moderation_verdicts (text_hash, model, result, expires_at)
+    VALUES (%s, %s, %s, CURRENT_TIMESTAMP + %s * INTERVAL '1 day')
+    ON CONFLICT (text_hash) DO NOTHING
+'''
+
+def moderate_message(database_url: str, api_key: str, message: str) -> Dict[str, Any]:
+    '''
+    Вердикт модерации сообщения: кэш контейнера, затем общая с v1-moderations таблица
+    moderation_verdicts, затем GPTunnel. Выполняется в пуле параллельно с генерацией ответа.
+    '''
+    text_hash = hashlib.sha256(f'\0{message}'.encode('utf-8')).hexdigest()
+    verdict = _moderation_cache.pop(text_hash, None)
+    if verdict is None:
+        with db_cursor(database_url) as cursor:
+            cursor.execute(
+                'SELECT result FROM moderation_verdicts WHERE text_hash = %s AND expires_at > CURRENT_TIMESTAMP',
+                (text_hash,)
+            )
+            row = cursor.fetchone()
+        if row:
+            verdict = row[0]
+        else:
+            response_data = json.loads(upstream_request(
+                gptunnel_url('/v1/moderations'),
+                data=json_dumps({'input': message}).encode('utf-8'),
+                headers={'Content-Type': 'application/json', 'Authorization': f'Bearer {api_key}'},
+                method='POST',
+                timeout=15
+            ))
+            verdict = response_data['results'][0]
+            with db_cursor(database_url) as cursor:
+                cursor.execute(MODERATION_SAVE_SQL, (text_hash, response_data.get('model'), json_dumps(verdict), MODERATION_VERDICT_TTL_DAYS))
+        if len(_moderation_cache) >= MODERATION_CACHE_MAX_ITEMS:
+            _moderation_cache.pop(next(iter(_moderation_cache)), None)
+    _moderation_cache[text_hash] = verdict
+    return verdict
+
+# Одна команда и читает, и ротирует сессию: строка блокируется на время upsert, поэтому
+# параллельные ходы одного пользователя (несколько вкладок) не создают дубликатов и не ротируют дважды
+SESSION_UPSERT_SQL = '''
+    INSERT INTO chat_sessions (id, assistant_id, user_id, chat_id, message_count)
+    VALUES (%(id)s, %(assistant_id)s, %(user_id)s, %(chat_id)s, 0)
+    ON CONFLICT (assistant_id, user_id)
+    DO UPDATE SET
+        chat_id = CASE WHEN chat_sessions.message_count >= %(limit)s THEN EXCLUDED.chat_id ELSE chat_sessions.chat_id END,
+        message_count = CASE WHEN chat_sessions.message_count >= %(limit)s THEN 0 ELSE chat_sessions.message_count END,
+        updated_at = CURRENT_TIMESTAMP
+    RETURNING chat_id, chat_id = %(chat_id)s AS is_new
+'''
+
+def prepare_session(database_url: str, assistant_id: str, user_id: str, context_length: Optional[int]) -> str:
+    '''
+    chat_id сессии GPTunnel для пары ассистент–пользователь: создаёт сессию или начинает новую,
+    когда исчерпан лимит контекста. Счётчик сообщений увеличивает record_usage после ответа.
+    '''
+    # Лимит: context_length * 2 сообщений (пары запрос-ответ), не больше 5 пар для экономии токенов
+    # и не больше 20 сообщений (лимит GPTunnel)
+    max_context = min(context_length if context_length else 5, 5)
+    chat_id = str(uuid.uuid4())
+    with db_cursor(database_url) as cursor:
+        cursor.execute(SESSION_UPSERT_SQL, {
+            'id': str(uuid.uuid4()),
+            'assistant_id': assistant_id,
+            'user_id': user_id,
+            'chat_id': chat_id,
+            'limit': min(max_context * 2, 20)
+        })
+        chat_id, is_new = cursor.fetchone()
+    
+    if is_new:
+        print(f"[DEBUG] Started chat session: {chat_id}")
+    return chat_id
+
+# Все записи статистики хода уходят одной строкой: на autocommit-соединении это одна неявная
+# транзакция и один round trip
+USAGE_BATCH_SQL = '''
+    INSERT INTO assistant_usage (assistant_id, user_id, message_count, tokens_used)
+    VALUES (%(assistant_id)s, %(user_id)s, 1, %(tokens_total)s);
+
+    INSERT INTO assistant_stats (assistant_id, total_messages, total_tokens, users_hll)
+    VALUES (%(assistant_id)s, 1, %(tokens_total)s, set_byte(decode(repeat('00', 4096), 'hex'), %(hll_index)s, %(hll_rank)s))
+    ON CONFLICT (assistant_id)
+    DO UPDATE SET
+        total_messages = assistant_stats.total_messages + 1,
+        total_tokens = assistant_stats.total_tokens + EXCLUDED.total_tokens,
+        users_hll = set_byte(assistant_stats.users_hll, %(hll_index)s, GREATEST(get_byte(assistant_stats.users_hll, %(hll_index)s), %(hll_rank)s)),
+        updated_at = CURRENT_TIMESTAMP;
+
+    INSERT INTO usage_stats (endpoint, model, assistant_id, request_count, total_tokens, total_prompt_tokens, total_completion_tokens, total_cost)
+    VALUES ('/gptunnel-bot', %(model)s, %(assistant_id)s, 1, %(tokens_total)s, %(tokens_prompt)s, %(tokens_completion)s, %(total_cost)s)
+    ON CONFLICT (endpoint, model, COALESCE(assistant_id, ''), date) 
+    DO UPDATE SET 
+        request_count = usage_stats.request_count + 1,
+        total_tokens = usage_stats.total_tokens + EXCLUDED.total_tokens,
+        total_prompt_tokens = usage_stats.total_prompt_tokens + EXCLUDED.total_prompt_tokens,
+        total_completion_tokens = usage_stats.total_completion_tokens + EXCLUDED.total_completion_tokens,
+        total_cost = usage_stats.total_cost + EXCLUDED.total_cost,
+        updated_at = CURRENT_TIMESTAMP;
+
+    INSERT INTO messages (assistant_id, user_id, role, content, tokens_used)
+    VALUES (%(assistant_id)s, %(user_id)s, 'user', %(message)s, %(tokens_prompt)s),
+           (%(assistant_id)s, %(user_id)s, 'assistant', %(response_text)s, %(tokens_completion)s);
+
+    UPDATE chat_sessions 
+    SET message_count = message_count + 2, updated_at = CURRENT_TIMESTAMP
+    WHERE assistant_id = %(assistant_id)s AND user_id = %(user_id)s
+'''
+
+# Каждая попытка вызова GPTunnel — строка api_requests: из них routing считает latency,
+# долю ошибок и стоимость моделей
+ATTEMPTS_SQL = '''
+    INSERT INTO api_requests (endpoint, method, model, status_code, latency_ms, tokens_total, total_cost)
+    SELECT '/gptunnel-bot', 'POST', model, status_code, latency_ms, tokens_total, total_cost
+    FROM unnest(
+        %(attempt_models)s::varchar[], %(attempt_statuses)s::int[], %(attempt_latencies)s::int[],
+        %(attempt_tokens)s::int[], %(attempt_costs)s::numeric[]
+    ) AS a(model, status_code, latency_ms, tokens_total, total_cost)
+'''
+
+# (модель, HTTP-статус или None при сетевой ошибке, latency_ms, токены, стоимость)
+Attempt = Tuple[Optional[str], Optional[int], int, int, float]
+
+def attempts_params(attempts: List[Attempt]) -> Dict[str, Any]:
+    models, statuses, latencies, tokens, costs = (list(column) for column in zip(*attempts))
+    return {
+        'attempt_models': models,
+        'attempt_statuses': statuses,
+        'attempt_latencies': latencies,
+        'attempt_tokens': tokens,
+        'attempt_costs': costs
+    }
+
+def record_attempts(
+    database_url: str, attempts: List[Attempt], prefetch: Optional[Dict[str, Any]] = None,
+    search_cursor: Optional[Dict[str, Any]] = None
+) -> None:
+    '''
+    Попытки хода, который не дошёл до record_usage (ошибка GPTunnel, ответ в режиме json),
+    исход упреждающего поиска или быстрого пути и курсор показанных результатов поиска
+    '''
+    statements: List[str] = []
+    params: Dict[str, Any] = {}
+    if attempts:
+        statements.append(ATTEMPTS_SQL)
+        params.update(attempts_params(attempts))
+    if prefetch:
+        statements.append(PREFETCH_SQL)
+        params.update(prefetch)
+    if search_cursor:
+        statements.append(SEARCH_CURSOR_SAVE_SQL)
+        params.update(search_cursor)
+    if not statements:
+        return
+    sql = ';'.join(statements)
     try:
-        conn = psycopg2.connect(database_url)
-        cursor = conn.cursor()
-        cursor.execute("SELECT secret_value FROM secrets WHERE secret_name = 'GPTUNNEL_API_KEY' LIMIT 1")
-        result = cursor.fetchone()
-        cursor.close()
-        conn.close()
-        
-        if not result or not result[0]:
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json_dumps({'error': 'GPTunnel API key not configured in secrets'}),
-                'isBase64Encoded': False
-            }
-        
-        gptunnel_api_key = result[0]
+        with db_cursor(database_url) as cursor:
+            cursor.execute(sql, params)
     except Exception as e:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json_dumps({'error': f'Failed to load API key from database: {str(e)}'}),
-            'isBase64Encoded': False
+        print(f"[DEBUG] Failed to record GPTunnel attempts: {str(e)}")
+
+def record_usage(
+    database_url: str, assistant_id: str, user_id: str, model_name: str, message: str, response_text: Optional[str],
+    tokens_total: int, tokens_prompt: int, tokens_completion: int, total_cost: float,
+    attempts: Optional[List[Attempt]] = None, prefetch: Optional[Dict[str, Any]] = None
+) -> None:
+    hll_index, hll_rank = hll_register(user_id)
+    params = {
+            'assistant_id': assistant_id,
+            'user_id': user_id,
+            'model': model_name,
+            'message': message,
+            'response_text': response_text,
+            'tokens_total': tokens_total,
+            'tokens_prompt': tokens_prompt,
+            'tokens_completion': tokens_completion,
+            'total_cost': total_cost,
+            'hll_index': hll_index,
+            'hll_rank': hll_rank
         }
+    sql = USAGE_BATCH_SQL
+    if attempts:
+        sql += ';' + ATTEMPTS_SQL
+        params.update(attempts_params(attempts))
+    if prefetch:
+        sql += ';' + PREFETCH_SQL
+        params.update(prefetch)
+    with db_cursor(database_url) as cursor:
+        cursor.execute(sql, params)
+
+def complete_with_failover(
+    endpoint: str, payload: Dict[str, Any], headers: Dict[str, str], route: List[Optional[str]],
+    timeout: float, attempts: List[Attempt]
+) -> Tuple[Dict[str, Any], Optional[str]]:
+    '''
+    Ответ GPTunnel и модель, которая его дала. Модели маршрута пробуются по очереди: статус
+    из FAILOVER_STATUSES, сетевая ошибка, таймаут или битый ответ переводят запрос на следующую,
+    остальные 4xx поднимаются сразу. Повтор той же модели (маршрут без политики) идёт
+    с экспоненциальной паузой. None в маршруте — модель не подставляется (external ассистент).
+    Когда маршрут исчерпан, поднимается последняя ошибка.
+    '''
+    retry_delay = 1
+    last_error: Exception = urllib.error.URLError('empty route')
+    for attempt, route_model in enumerate(route):
+        if route_model is not None:
+            payload['model'] = route_model
+        started = time.monotonic()
+        try:
+            response_data = upstream_request(
+                endpoint, data=json_dumps(payload).encode('utf-8'), headers=headers, method='POST', timeout=timeout
+            ).decode('utf-8')
+            api_response = json.loads(response_data)
+            if not isinstance(api_response, dict):
+                raise ValueError(f'unexpected response: {response_data[:200]}')
+        except (urllib.error.URLError, ConnectionResetError, ValueError) as e:
+            last_error = e
+            status = e.code if isinstance(e, urllib.error.HTTPError) else None
+            attempts.append((route_model, status, int((time.monotonic() - started) * 1000), 0, 0.0))
+            if status is not None and status not in FAILOVER_STATUSES:
+                print(f"[DEBUG] GPTunnel API attempt {attempt + 1}/{len(route)} (model={route_model}) rejected: {str(e)}")
+                raise
+            record_failure(route_model)
+            print(f"[DEBUG] GPTunnel API attempt {attempt + 1}/{len(route)} (model={route_model}) failed: {str(e)}")
+            if attempt + 1 < len(route) and route[attempt + 1] == route_model:
+                print(f"[DEBUG] Retrying in {retry_delay} seconds...")
+                time.sleep(retry_delay)
+                retry_delay *= 2
+            continue
+        usage = api_response.get('usage') or {}
+        attempts.append((
+            route_model, 200, int((time.monotonic() - started) * 1000),
+            usage.get('total_tokens') or api_response.get('spendTokenCount') or 0, usage.get('total_cost') or 0.0
+        ))
+        record_success(route_model)
+        print(f"[DEBUG] GPTunnel API response (model={route_model}): {response_data[:1000]}")
+        return api_response, route_model
+    print("[DEBUG] All GPTunnel API attempts exhausted")
+    raise last_error
+
+SEARCH_KEY_SEPARATORS = re.compile(r'[\s_\-]+')
+
+def canonical_search_value(value: Any) -> Any:
+    '''
+    Значение параметра в ключе search_cache: регистр, ё/е, пробелы и «2» против 2 не различаются
+    '''
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    if isinstance(value, int):
+        return str(value)
+    if isinstance(value, str):
+        value = ' '.join(value.lower().replace('ё', 'е').split())
+        return str(int(value)) if value.isdigit() else value
+    if isinstance(value, (list, tuple)):
+        return sorted((canonical_search_value(item) for item in value), key=json_dumps)
+    return value
+
+class SearchRequest:
+    '''
+    Аргументы tool_call поиска, приведённые к запросу API интеграции: checkout из checkin + nights,
+    hotels/group_id по сообщению, город в каноническом написании, клиентские фильтры (нет в API) отдельно.
+    Ключ search_cache строится только из того, что уходит в API: выборки с разными max_price
+    и exclude_property_types получаются фильтрацией одного закэшированного результата. Ответ,
+    ранжированный при записи (веса presort интеграции), хранится под своим ключом.
+    '''
+    __slots__ = ('api_args', 'max_price', 'exclude_property_types', 'presort', 'cache_params', 'cache_key')
+    
+    def __init__(
+        self, function_args: Dict[str, Any], user_wants_hotels: bool, presort: Optional[Dict[str, float]] = None
+    ):
+        # Пустые параметры в API не передаются и на ключ не влияют
+        api_args = {key: value for key, value in function_args.items() if value is not None and value != '' and value != []}
+        # checkout считается, только если модель не передала его сама; nights в API не уходит
+        if 'checkin' in api_args and 'checkout' not in api_args and 'nights' in api_args:
+            checkout_date = datetime.strptime(api_args['checkin'], '%Y-%m-%d') + timedelta(days=int(api_args['nights']))
+            api_args['checkout'] = checkout_date.strftime('%Y-%m-%d')
+        api_args.pop('nights', None)
+        # Пользователь упомянул «отели» — hotels=1 и group_id=4
+        if user_wants_hotels:
+            api_args['hotels'] = 1
+            api_args['group_id'] = 4
+        # «москва», «Moscow», «г. Москва» — один город из справочника slots
+        if isinstance(api_args.get('city'), str):
+            from slots import canonical_city
+            api_args['city'] = canonical_city(api_args['city']) or api_args['city'].strip()
+        self.max_price = api_args.pop('max_price', None)
+        self.exclude_property_types = api_args.pop('exclude_property_types', None)
+        self.api_args = api_args
+        self.presort = presort
+        self.cache_params = {
+            SEARCH_KEY_SEPARATORS.sub('', key.lower()): canonical_search_value(value) for key, value in api_args.items()
+        }
+        if presort:
+            self.cache_params['presort'] = presort
+        self.cache_key = hashlib.md5(json_dumps(self.cache_params, sort_keys=True).encode()).hexdigest()
+    
+    def same_query(self, other: 'SearchRequest') -> bool:
+        '''
+        Тот же запрос к API с точностью до канонизации; клиентские фильтры не важны
+        '''
+        return self.cache_params == other.cache_params
+
+SEARCH_CACHE_SQL = '''
+    SELECT search_results
+    FROM search_cache
+    WHERE cache_key = %s AND expires_at > CURRENT_TIMESTAMP
+    LIMIT 1
+'''
+
+SEARCH_CACHE_SAVE_SQL = '''
+    INSERT INTO search_cache (id, cache_key, search_params, search_results, expires_at)
+    VALUES (%s, %s, %s, %s, CURRENT_TIMESTAMP + INTERVAL '30 minutes')
+    ON CONFLICT (id) DO NOTHING
+'''
+
+def fetch_search(database_url: str, api_base_url: str, search: SearchRequest, max_retries: int = 3) -> Any:
+    '''
+    Результаты поиска из search_cache или из API интеграции (сохраняются в кэш на 30 минут).
+    Повторы идут с экспоненциальной паузой; когда они исчерпаны, поднимается последняя ошибка.
+    Если интеграция ранжирует при кэшировании (search.presort), ответ ранжируется один раз перед записью.
+    '''
+    with db_cursor(database_url) as cursor:
+        cursor.execute(SEARCH_CACHE_SQL, (search.cache_key,))
+        cached_result = cursor.fetchone()
+    if cached_result:
+        print(f"[DEBUG] Cache HIT for key {search.cache_key}")
+        return cached_result[0]
+    
+    print(f"[DEBUG] Cache MISS for key {search.cache_key}")
+    api_url = f"{api_base_url}?{urllib.parse.urlencode(search.api_args)}"
+    print(f"[DEBUG] Calling external API: {api_url}")
+    
+    retry_delay = 1
+    for attempt in range(max_retries):
+        try:
+            api_data = json.loads(upstream_request(api_url, headers={'Accept': 'application/json'}, timeout=30).decode('utf-8'))
+            break
+        except (urllib.error.URLError, ConnectionResetError) as e:
+            print(f"[DEBUG] Attempt {attempt + 1}/{max_retries} failed: {str(e)}")
+            if attempt + 1 == max_retries:
+                print(f"[DEBUG] All retry attempts exhausted")
+                raise
+            print(f"[DEBUG] Retrying in {retry_delay} seconds...")
+            time.sleep(retry_delay)
+            retry_delay *= 2
+    
+    if api_data is not None:
+        if search.presort:
+            from ranking import presort_results
+            api_data = presort_results(api_data, search.presort, search.api_args.get('guests'))
+        with db_cursor(database_url) as cursor:
+            cursor.execute(SEARCH_CACHE_SAVE_SQL, (str(uuid.uuid4()), search.cache_key, json_dumps(search.cache_params), json_dumps(api_data)))
+        print(f"[DEBUG] Saved to cache: key={search.cache_key}, expires in 30 minutes")
+    return api_data
+
+def timed_search(database_url: str, api_base_url: str, search: SearchRequest) -> Tuple[Any, float]:
+    started = time.monotonic()
+    # Упреждающий поиск не повторяется: при ошибке ход просто ищет заново после tool_call
+    return fetch_search(database_url, api_base_url, search, max_retries=1), time.monotonic() - started
+
+class SpeculativeSearch:
+    '''
+    Поиск по слотам из сообщения (slots.py), запущенный в пуле параллельно с первым вызовом GPTunnel.
+    Результат забирает tool_call с тем же запросом к API, иначе он отбрасывается
+    (но остаётся в search_cache). Исход хода пишется в prefetch_stats.
+    '''
+    __slots__ = ('search', 'future', 'started', 'outcome', 'saved_ms')
+    
+    def __init__(self, database_url: str, api_base_url: str, search: SearchRequest):
+        self.search = search
+        self.started = time.monotonic()
+        self.future = _executor.submit(timed_search, database_url, api_base_url, search)
+        self.outcome = 'unused'
+        self.saved_ms = 0
+    
+    def take(self, search: SearchRequest) -> Any:
+        if not self.search.same_query(search):
+            self.outcome = 'miss'
+            print(f"[DEBUG] Speculative search MISS: guessed {json_dumps(self.search.api_args, ensure_ascii=False)}")
+            return None
+        needed = time.monotonic()
+        try:
+            api_data, elapsed = self.future.result()
+        except Exception as e:
+            print(f"[DEBUG] Speculative search failed, searching again: {str(e)}")
+            return None
+        if api_data is None:
+            return None
+        self.outcome = 'hit'
+        # Сэкономлена та часть поиска, что прошла до момента, когда он понадобился
+        self.saved_ms = int(min(elapsed, needed - self.started) * 1000)
+        print(f"[DEBUG] Speculative search HIT, saved {self.saved_ms} ms")
+        return api_data
+
+SEARCH_PAGE_SIZE = 10
+
+def page_weights(api_config: Dict[str, Any]) -> Optional[Dict[str, float]]:
+    # Ответ, ранжированный при записи в кэш (presort), уже лежит в нужном порядке
+    return None if api_config.get('ranking_presort') else api_config.get('ranking_weights')
+
+def presort_weights(api_config: Dict[str, Any]) -> Optional[Dict[str, float]]:
+    return api_config.get('ranking_weights') if api_config.get('ranking_presort') else None
+
+def ranked_page(
+    api_data: Any, search: SearchRequest, offset: int = 0, sort: Optional[str] = None,
+    weights: Optional[Dict[str, float]] = None
+) -> Tuple[Any, int]:
+    '''
+    Страница результатов поиска после клиентских фильтров и ранжирования (ranking.py) и число
+    объектов, прошедших фильтры. Ответ API без массива результатов возвращается как есть
+    '''
+    # Extract results array from response if it exists
+    results = api_data.get('results', []) if isinstance(api_data, dict) else api_data
+    if not isinstance(results, list):
+        print("[DEBUG] Extracted results: not a list")
+        return results, 1
+    
+    # exclude_property_types может быть строкой или списком
+    excluded = search.exclude_property_types
+    if excluded and not isinstance(excluded, list):
+        excluded = [excluded]
+    
+    from ranking import rank_results
+    page, total = rank_results(
+        results, search.cache_key, weights, max_price=search.max_price, exclude_types=excluded,
+        guests=search.api_args.get('guests'), sort=sort, offset=offset, limit=SEARCH_PAGE_SIZE
+    )
+    print(
+        f"[DEBUG] Ranked {len(results)} results: {total} after filters (max_price={search.max_price}, "
+        f"excluded={excluded}), sort={sort or ('weights' if weights else 'api')}, page from {offset}"
+    )
+    return page, total
+
+def json_results(
+    api_data: Any, search: SearchRequest, offset: int = 0, sort: Optional[str] = None,
+    weights: Optional[Dict[str, float]] = None
+) -> Any:
+    '''
+    Результаты поиска для ответа в режиме json: страница из 10 объектов после фильтров и ранжирования,
+    ссылки на бронирование с датами и гостями, фото из preview_img
+    '''
+    results, _ = ranked_page(api_data, search, offset, sort, weights)
+    
+    # Добавляем параметры бронирования к каждому объекту для ссылок
+    if isinstance(results, list):
+        # Параметры бронирования для ссылок (checkout уже в search.api_args)
+        url_params = urllib.parse.urlencode({
+            'dateStart': search.api_args.get('checkin'),
+            'dateEnd': search.api_args.get('checkout'),
+            'adults': search.api_args.get('guests', 1),
+            'children': search.api_args.get('children', 0),
+            'infants': search.api_args.get('infants', 0),
+            'pets': search.api_args.get('pets', 0)
+        })
+        
+        # Добавляем готовую ссылку с параметрами к каждому результату
+        is_hotels = search.api_args.get('hotels') == 1
+        print(f"[DEBUG] URL generation: hotels={search.api_args.get('hotels')}, is_hotels={is_hotels}")
+        
+        # Объекты страницы копируются: признаки ответа переиспользуются другими страницами и поисками
+        results = [dict(result) if isinstance(result, dict) else result for result in results]
+        for result in results:
+            if isinstance(result, dict) and 'id' in result:
+                obj_id = str(result['id'])
+                # Убираем префикс (hotel-, hostel-, flat-, room-) из ID
+                numeric_id = obj_id.replace('hotel-', '').replace('hostel-', '').replace('flat-', '').replace('room-', '')
+                # Логика формирования ссылки: если hotels=1, то /hotels/, иначе /rooms/
+                if is_hotels:
+                    result['bookingUrl'] = f"https://qqrenta.ru/hotels/{numeric_id}?{url_params}"
+                else:
+                    result['bookingUrl'] = f"https://qqrenta.ru/rooms/{numeric_id}?{url_params}"
+                print(f"[DEBUG] Added bookingUrl for {obj_id} -> {numeric_id}: {result['bookingUrl']}")
+                
+                # Маппинг фотографий: если есть preview_img, добавляем в массив photos
+                if 'preview_img' in result and result['preview_img']:
+                    result['photos'] = [result['preview_img']]
+                    print(f"[DEBUG] Added photo for {obj_id}: {result['preview_img']}")
+    
+    print(f"[DEBUG] Returning to frontend: {len(results) if isinstance(results, list) else 1} items")
+    return results
+
+SEARCH_PAGE_END = 'Больше вариантов по этому запросу нет. Попробуйте изменить даты, город или бюджет.'
+
+# Курсор пользователя по результатам последнего поиска в режиме json: ключ search_cache,
+# аргументы для ссылок и фильтров, показанное число объектов и сортировка. Быстрый путь
+# не готовит сессию, поэтому строка chat_sessions при необходимости создаётся здесь
+SEARCH_CURSOR_SAVE_SQL = '''
+    INSERT INTO chat_sessions (id, assistant_id, user_id, chat_id, message_count, search_cursor)
+    VALUES (%(cursor_session_id)s, %(assistant_id)s, %(user_id)s, %(cursor_chat_id)s, 0, %(search_cursor)s)
+    ON CONFLICT (assistant_id, user_id)
+    DO UPDATE SET search_cursor = EXCLUDED.search_cursor, updated_at = CURRENT_TIMESTAMP
+'''
+
+# Продолжение сдвигает курсор (или задаёт сортировку и начинает с первой страницы) и тем же
+# запросом достаёт закэшированный ответ API: «покажи ещё» — один round trip к базе.
+# Если ответ в кэше истёк, курсор не двигается: ход пойдёт обычным путём, и страница не потеряется
+SEARCH_CURSOR_ADVANCE_SQL = '''
+    UPDATE chat_sessions
+    SET search_cursor = search_cursor || jsonb_build_object(
+            'offset', CASE WHEN %(sort)s::text IS NULL
+                THEN COALESCE((search_cursor->>'offset')::int, 0) + %(page_size)s
+                ELSE %(page_size)s END,
+            'sort', COALESCE(%(sort)s::text, search_cursor->>'sort')
+        ),
+        updated_at = CURRENT_TIMESTAMP
+    WHERE assistant_id = %(assistant_id)s AND user_id = %(user_id)s AND search_cursor IS NOT NULL
+      AND EXISTS (
+          SELECT 1 FROM search_cache c
+          WHERE c.cache_key = chat_sessions.search_cursor->>'cacheKey' AND c.expires_at > CURRENT_TIMESTAMP
+      )
+    RETURNING search_cursor, (
+        SELECT c.search_results
+        FROM search_cache c
+        WHERE c.cache_key = chat_sessions.search_cursor->>'cacheKey' AND c.expires_at > CURRENT_TIMESTAMP
+        LIMIT 1
+    )
+'''
+
+def search_cursor_params(assistant_id: str, user_id: str, search: SearchRequest) -> Optional[Dict[str, Any]]:
+    '''
+    Курсор после показа первой страницы поиска. Анонимные пользователи делят одну сессию,
+    поэтому курсор им не сохраняется
+    '''
+    if user_id == 'anonymous':
+        return None
+    return {
+        'assistant_id': assistant_id,
+        'user_id': user_id,
+        'cursor_session_id': str(uuid.uuid4()),
+        'cursor_chat_id': str(uuid.uuid4()),
+        'search_cursor': json_dumps({
+            'cacheKey': search.cache_key,
+            'args': search.api_args,
+            'maxPrice': search.max_price,
+            'excludePropertyTypes': search.exclude_property_types,
+            'offset': SEARCH_PAGE_SIZE,
+            'sort': None
+        })
+    }
+
+def next_search_page(
+    database_url: str, assistant_id: str, user_id: str, intent: str, api_config: Dict[str, Any]
+) -> Optional[List[Any]]:
+    '''
+    Следующая страница ('more') или первая страница в новой сортировке из закэшированного ответа API.
+    None — курсора нет или кэш истёк, тогда ход идёт обычным путём; пустой список — результаты кончились
+    '''
+    if user_id == 'anonymous':
+        return None
+    with db_cursor(database_url) as cursor:
+        cursor.execute(SEARCH_CURSOR_ADVANCE_SQL, {
+            'assistant_id': assistant_id,
+            'user_id': user_id,
+            'sort': None if intent == 'more' else intent,
+            'page_size': SEARCH_PAGE_SIZE
+        })
+        row = cursor.fetchone()
+    if not row or row[1] is None:
+        return None
+    state, api_data = row
+    search = SearchRequest({
+        **state['args'], 'max_price': state.get('maxPrice'), 'exclude_property_types': state.get('excludePropertyTypes')
+    }, False, presort_weights(api_config))
+    print(f"[DEBUG] Search cursor {intent}: offset {state['offset'] - SEARCH_PAGE_SIZE}, sort {state.get('sort')}")
+    results = json_results(api_data, search, state['offset'] - SEARCH_PAGE_SIZE, state.get('sort'), page_weights(api_config))
+    return results if isinstance(results, list) else None
+
+# Ход ассистента с интеграцией поиска: обслужен ли он без модели, был ли упреждающий поиск и пригодился ли он
+PREFETCH_SQL = '''
+    INSERT INTO prefetch_stats (assistant_id, turns, direct, speculated, hits, misses, saved_ms)
+    VALUES (
+        %(assistant_id)s, 1, %(prefetch_direct)s, %(prefetch_speculated)s, %(prefetch_hits)s, %(prefetch_misses)s,
+        %(prefetch_saved_ms)s
+    )
+    ON CONFLICT (assistant_id, date)
+    DO UPDATE SET
+        turns = prefetch_stats.turns + 1,
+        direct = prefetch_stats.direct + EXCLUDED.direct,
+        speculated = prefetch_stats.speculated + EXCLUDED.speculated,
+        hits = prefetch_stats.hits + EXCLUDED.hits,
+        misses = prefetch_stats.misses + EXCLUDED.misses,
+        saved_ms = prefetch_stats.saved_ms + EXCLUDED.saved_ms,
+        updated_at = CURRENT_TIMESTAMP
+'''
+
+def prefetch_params(assistant_id: str, speculative: Optional[SpeculativeSearch], direct: bool = False) -> Dict[str, Any]:
+    return {
+        'assistant_id': assistant_id,
+        'prefetch_direct': int(direct),
+        'prefetch_speculated': int(speculative is not None),
+        'prefetch_hits': int(speculative is not None and speculative.outcome == 'hit'),
+        'prefetch_misses': int(speculative is not None and speculative.outcome == 'miss'),
+        'prefetch_saved_ms': speculative.saved_ms if speculative else 0
+    }
+
+WARMUP_ASSISTANTS_LIMIT = 16
+
+# Ассистенты, которым писали последними, — их конфиги прогрев кладёт в кэш контейнера
+HOT_ASSISTANTS_SQL = '''
+    SELECT s.assistant_id
+    FROM assistant_stats s
+    JOIN assistants a ON a.id = s.assistant_id AND a.status = 'active'
+    ORDER BY s.updated_at DESC
+    LIMIT %s
+'''
+
+def preload_assistants(database_url: str) -> Dict[str, Any]:
+    with db_cursor(database_url) as cursor:
+        cursor.execute(HOT_ASSISTANTS_SQL, (WARMUP_ASSISTANTS_LIMIT,))
+        assistant_ids = [row[0] for row in cursor.fetchall()]
+    api_hosts = set()
+    rag_database_ids = set()
+    for assistant_id in assistant_ids:
+        _, config = load_assistant_config(database_url, assistant_id)
+        if config and config.api_config and config.api_config.get('api_base_url'):
+            parts = urllib.parse.urlsplit(config.api_config['api_base_url'])
+            api_hosts.add(f'{parts.scheme}://{parts.netloc}')
+        if config and config.rag_database_ids and config.assistant_type != 'external':
+            rag_database_ids.update(config.rag_database_ids)
+    return {'assistants': len(assistant_ids), 'apiHosts': sorted(api_hosts), 'ragDatabases': sorted(rag_database_ids)}
+
+def preload_rag_indexes(database_url: str, database_ids: List[str]) -> int:
+    '''
+    Открывает (при необходимости строит) локальные RAG-индексы горячих ассистентов
+    '''
+    from rag_index import ready_indexes
+    return len(ready_indexes(database_url, database_ids, wait=True))
+
+def preload_slots() -> int:
+    '''
+    Разбор слотов (регулярки и справочник городов) нужен только ассистентам с интеграцией поиска,
+    поэтому slots импортируется лениво, а прогрев загружает его заранее
+    '''
+    from slots import GAZETTEER
+    return len(GAZETTEER)
+
+def preload_ranking() -> int:
+    '''
+    Ранжирование результатов поиска (ranking.py, numpy) тоже нужно только ассистентам с интеграцией
+    '''
+    from ranking import SORTS
+    return len(SORTS)
+
+def warm_up(report: Dict[str, Any]) -> None:
+    '''
+    Прогрев контейнера по расписанию: соединение с БД, горячие конфиги ассистентов в кэше
+    и keep-alive соединения к GPTunnel и API интеграций
+    '''
+    database_url = os.environ.get('DATABASE_URL')
+    preloaded = None
+    if database_url:
+        warmup_step(report, 'database', warm_database, database_url)
+        preloaded = warmup_step(report, 'assistants', preload_assistants, database_url)
+    warmup_step(report, 'gptunnel', warm_upstream, gptunnel_url('/'))
+    for api_host in (preloaded or {}).get('apiHosts', []):
+        warmup_step(report, f'api {api_host}', warm_upstream, api_host)
+    if (preloaded or {}).get('apiHosts'):
+        warmup_step(report, 'slots', preload_slots)
+        warmup_step(report, 'ranking', preload_ranking)
+    if (preloaded or {}).get('ragDatabases'):
+        warmup_step(report, 'rag', preload_rag_indexes, database_url, preloaded['ragDatabases'])
+
+@http_handler('POST', allow_headers='Content-Type, X-User-Id', warmup=warm_up)
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''
+    Business: Проксирование запросов к GPTunnel Bot API
+    Args: event с httpMethod, body с message и assistant_id
+          context с request_id
+    Returns: HTTP response с ответом от бота
+    '''
+    database_url = os.environ.get('DATABASE_URL')
+    if not database_url:
+        return error_response(500, 'Database not configured')
     
     try:
         body_data = json.loads(event.get('body', '{}'))
@@ -92,122 +809,113 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         message_history = body_data.get('history', [])
         
         # Check if user mentioned "отели" in the original message
-        import re
-        user_wants_hotels = bool(re.search(r'\bотел[ьия]\b', message.lower()))
+        user_wants_hotels = bool(HOTELS_PATTERN.search(message.lower()))
         
         if not message:
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json_dumps({'error': 'Message is required'}),
-                'isBase64Encoded': False
-            }
+            return error_response(400, 'Message is required')
         
         if not assistant_id:
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json_dumps({'error': 'Assistant ID is required'}),
-                'isBase64Encoded': False
-            }
+            return error_response(400, 'Assistant ID is required')
         
-        conn = psycopg2.connect(database_url)
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT name, first_message, instructions, model, 
-                   context_length, creativity, status, api_integration_id, assistant_code, type
-            FROM assistants 
-            WHERE id = %s
-        ''', (assistant_id,))
-        assistant = cursor.fetchone()
+        try:
+            gptunnel_api_key, assistant = load_assistant_config(database_url, assistant_id)
+        except Exception as e:
+            return error_response(500, f'Failed to load API key from database: {str(e)}')
+        
+        if not gptunnel_api_key:
+            return error_response(400, 'GPTunnel API key not configured in secrets')
         
         if not assistant:
-            cursor.close()
-            conn.close()
-            return {
-                'statusCode': 404,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json_dumps({'error': 'Assistant not found'}),
-                'isBase64Encoded': False
-            }
+            return error_response(404, 'Assistant not found')
         
-        assistant_name, first_message, instructions, model, context_length, creativity, status, api_integration_id, assistant_code, assistant_type = assistant
+        instructions, model, context_length, creativity = assistant.instructions, assistant.model, assistant.context_length, assistant.creativity
+        assistant_type, assistant_code, rag_database_ids = assistant.assistant_type, assistant.assistant_code, assistant.rag_database_ids
+        api_config = assistant.api_config
         
-        # Получаем или создаём chat_id для сессии с GPTunnel
-        cursor.execute('''
-            SELECT chat_id, message_count FROM chat_sessions
-            WHERE assistant_id = %s AND user_id = %s
-        ''', (assistant_id, user_id))
-        session = cursor.fetchone()
+        if assistant.status != 'active':
+            return error_response(403, 'Assistant is not active')
         
-        chat_id: Optional[str] = None
-        message_count = 0
+        # Модерация идёт параллельно с генерацией и не добавляет round trip к ходу
+        moderation_future = None
+        if assistant.moderation_enabled:
+            moderation_future = _executor.submit(moderate_message, database_url, gptunnel_api_key, message)
         
-        if session:
-            chat_id = session[0]
-            message_count = session[1]
-            
-            # Если достигнут лимит сообщений (context_length * 2 для пары запрос-ответ)
-            # или прошло больше 20 сообщений (лимит GPTunnel), создаём новую сессию
-            # Используем максимум 5 сообщений для экономии токенов
-            max_context = min(context_length if context_length else 5, 5)
-            if message_count >= min(max_context * 2, 20):
-                chat_id = str(uuid.uuid4())
-                message_count = 0
-                cursor.execute('''
-                    UPDATE chat_sessions 
-                    SET chat_id = %s, message_count = 0, updated_at = CURRENT_TIMESTAMP
-                    WHERE assistant_id = %s AND user_id = %s
-                ''', (chat_id, assistant_id, user_id))
-                conn.commit()
-                print(f"[DEBUG] Created new chat session: {chat_id}")
-            # НЕ обновляем счётчик здесь - обновим после успешного ответа от GPT
-        else:
-            # Создаём новую сессию (счётчик обновим после успешного ответа)
-            chat_id = str(uuid.uuid4())
-            cursor.execute('''
-                INSERT INTO chat_sessions (id, assistant_id, user_id, chat_id, message_count)
-                VALUES (%s, %s, %s, %s, 0)
-            ''', (str(uuid.uuid4()), assistant_id, user_id, chat_id))
-            conn.commit()
-            print(f"[DEBUG] Created first chat session: {chat_id}")
-        
-        # Load API integration config if exists
-        api_config = None
-        if api_integration_id:
-            cursor.execute('''
-                SELECT name, api_base_url, function_name, function_description, 
-                       function_parameters, response_mode
-                FROM api_integrations
-                WHERE id = %s
-            ''', (api_integration_id,))
-            api_data = cursor.fetchone()
-            if api_data:
-                api_config = {
-                    'name': api_data[0],
-                    'api_base_url': api_data[1],
-                    'function_name': api_data[2],
-                    'function_description': api_data[3],
-                    'function_parameters': api_data[4],
-                    'response_mode': api_data[5]
-                }
+        user_history = message_history if isinstance(message_history, list) else None
         
-        cursor.close()
-        conn.close()
+        # Быстрый путь режима json: если сообщение целиком разобрано правилами (slots.py), поиск идёт
+        # сразу в API интеграции — без вызова модели и без токенов. Помеченное модерацией сообщение
+        # идёт обычным путём, где ответ заменяется отказом
+        # Продолжение прошлого поиска («покажи ещё», «подешевле») отдаётся страницей из search_cache по курсору сессии
+        if api_config and api_config.get('api_base_url') and api_config.get('response_mode') == 'json' and assistant_type != 'external':
+            from slots import confident_search_slots, follow_up_intent
+            intent = follow_up_intent(message)
+            slots = None if intent else confident_search_slots(message, user_history, api_config.get('function_parameters'))
+            if (intent or slots) and moderation_future is not None:
+                try:
+                    if (moderation_future.result() or {}).get('flagged'):
+                        intent, slots = None, None
+                except Exception as e:
+                    print(f"[DEBUG] Moderation failed, answering without it: {str(e)}")
+            page = next_search_page(database_url, assistant_id, user_id, intent, api_config) if intent else None
+            if page is not None:
+                record_attempts(database_url, [], prefetch_params(assistant_id, None, direct=True))
+                if not page:
+                    return json_response(200, {'response': SEARCH_PAGE_END, 'mode': 'text'})
+                return json_response(200, {'response': page, 'mode': 'json'})
+            if slots:
+                print(f"[DEBUG] Slots parsed locally, searching without GPTunnel: {json_dumps(slots, ensure_ascii=False)}")
+                search = SearchRequest(slots, user_wants_hotels, presort_weights(api_config))
+                try:
+                    api_data = fetch_search(database_url, api_config['api_base_url'], search)
+                except (urllib.error.URLError, ConnectionResetError) as e:
+                    return error_response(503, f'External API unavailable: {str(e)}')
+                if api_data is None:
+                    return error_response(503, 'External API returned no data')
+                results = json_results(api_data, search, weights=page_weights(api_config))
+                record_attempts(
+                    database_url, [], prefetch_params(assistant_id, None, direct=True),
+                    search_cursor_params(assistant_id, user_id, search)
+                )
+                return json_response(200, {'response': results, 'mode': 'json'})
         
-        if status != 'active':
-            return {
-                'statusCode': 403,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json_dumps({'error': 'Assistant is not active'}),
-                'isBase64Encoded': False
-            }
+        # Поиск по слотам, найденным в сообщении локально, стартует до вызова GPTunnel:
+        # tool_call с теми же аргументами заберёт готовый результат вместо второго сетевого ожидания
+        speculative: Optional[SpeculativeSearch] = None
+        if api_config and api_config.get('api_base_url'):
+            from slots import extract_search_slots
+            slots = extract_search_slots(message, user_history)
+            if slots:
+                speculative = SpeculativeSearch(
+                    database_url, api_config['api_base_url'], SearchRequest(slots, user_wants_hotels, presort_weights(api_config))
+                )
+                print(f"[DEBUG] Speculative search started: {json_dumps(slots, ensure_ascii=False)}")
+        
+        # chat_id нужен в запросе только внешнему ассистенту; для simple сессия готовится
+        # параллельно с вызовом GPTunnel
+        chat_id: Optional[str] = None
+        session_future = None
+        if assistant_type == 'external':
+            chat_id = prepare_session(database_url, assistant_id, user_id, context_length)
+        else:
+            session_future = _executor.submit(prepare_session, database_url, assistant_id, user_id, context_length)
         
         messages = []
         
         if instructions:
             messages.append({'role': 'system', 'content': instructions})
         
+        # Локальный RAG: top-k фрагментов баз ассистента попадают в промпт уже первого вызова.
+        # rag_index (numpy) импортируется только здесь, чтобы не удлинять холодный старт остальным
+        if rag_database_ids and assistant_type != 'external':
+            try:
+                from rag_index import retrieve, format_context
+                rag_hits = retrieve(database_url, gptunnel_api_key, list(rag_database_ids), message)
+                if rag_hits:
+                    messages.append({'role': 'system', 'content': format_context(rag_hits)})
+                    print(f"[DEBUG] Local RAG: {len(rag_hits)} passages, best score {rag_hits[0]['score']:.3f}")
+            except Exception as e:
+                print(f"[DEBUG] Local RAG retrieval failed, answering without it: {str(e)}")
+        
         if len(message_history) > 0:
             # Ограничиваем историю 5 последними сообщениями для экономии
             max_context = min(context_length if context_length else 5, 5)
@@ -237,22 +945,12 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             }]
         
         # Выбираем эндпоинт по ТИПУ ассистента (а не по наличию RAG базы)
-        import time
-        
         if assistant_type == 'external':
             # Тип "external" → используем /v1/assistant/chat с assistantCode
             if not assistant_code:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json_dumps({
-                        'error': 'assistant_code not configured',
-                        'message': 'Для внешнего ассистента необходимо указать ID ассистента из GPTunnel UI'
-                    }),
-                    'isBase64Encoded': False
-                }
+                return error_response(400, 'assistant_code not configured', message='Для внешнего ассистента необходимо указать ID ассистента из GPTunnel UI')
             
-            endpoint = 'https://gptunnel.ru/v1/assistant/chat'
+            endpoint = gptunnel_url('/v1/assistant/chat')
             payload = {
                 'chatId': chat_id,
                 'assistantCode': assistant_code,
@@ -263,7 +961,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             print(f"[DEBUG] Payload: {json_dumps(payload, ensure_ascii=False)}")
         else:
             # Тип "simple" → используем /v1/chat/completions (даже если есть RAG база)
-            endpoint = 'https://gptunnel.ru/v1/chat/completions'
+            endpoint = gptunnel_url('/v1/chat/completions')
             payload = {
                 'model': model or 'gpt-4o-mini',
                 'messages': messages,
@@ -278,59 +976,34 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         
         print(f"[DEBUG] Sending to GPTunnel: {json_dumps(payload, ensure_ascii=False)[:1000]}")
         
-        request_data = json_dumps(payload).encode('utf-8')
-        
         # Формируем заголовки - всегда используем Bearer токен
         headers = {
             'Content-Type': 'application/json',
             'Authorization': f'Bearer {gptunnel_api_key}'
         }
         
-        # Retry logic for GPTunnel API calls
-        max_retries = 3
-        retry_delay = 1
-        api_response = None
-        last_error = None
+        # Маршрут попыток: по политике ассистента — модели по статистике с переходом на следующую
+        # при ошибке, без политики — три попытки той же модели с паузой
+        routing_policy = assistant.routing_policy
+        request_timeout = 60
+        if assistant_type == 'external':
+            route: List[Optional[str]] = [None] * 3
+        elif routing_policy:
+            route = list(plan_route(routing_policy, database_url, gptunnel_api_key))
+            request_timeout = routing_policy.timeout(request_timeout)
+            print(f"[DEBUG] Routing policy {routing_policy.strategy}: route={route}")
+        else:
+            route = [payload['model']] * 3
         
-        for attempt in range(max_retries):
-            try:
-                req = urllib.request.Request(
-                    endpoint,
-                    data=request_data,
-                    headers=headers,
-                    method='POST'
-                )
-                
-                with urllib.request.urlopen(req, timeout=60) as response:
-                    response_data = response.read().decode('utf-8')
-                    api_response = json.loads(response_data)
-                    print(f"[DEBUG] GPTunnel API response: {response_data[:1000]}")
-                    break
-                    
-            except (urllib.error.URLError, urllib.error.HTTPError, ConnectionResetError) as e:
-                last_error = e
-                print(f"[DEBUG] GPTunnel API attempt {attempt + 1}/{max_retries} failed: {str(e)}")
-                
-                if attempt < max_retries - 1:
-                    print(f"[DEBUG] Retrying in {retry_delay} seconds...")
-                    time.sleep(retry_delay)
-                    retry_delay *= 2
-                else:
-                    print(f"[DEBUG] All GPTunnel API retry attempts exhausted")
-                    return {
-                        'statusCode': 503,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json_dumps({'error': f'GPTunnel API unavailable: {str(last_error)}'}),
-                        'isBase64Encoded': False
-                    }
-        
-        if api_response is None:
-            return {
-                'statusCode': 503,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json_dumps({'error': 'GPTunnel API returned no data'}),
-                'isBase64Encoded': False
-            }
+        attempts: List[Attempt] = []
+        try:
+            api_response, answered_model = complete_with_failover(endpoint, payload, headers, route, request_timeout, attempts)
+        except (urllib.error.URLError, ConnectionResetError, ValueError) as e:
+            record_attempts(database_url, attempts)
+            return error_response(503, f'GPTunnel API unavailable: {str(e)}')
+        
+        if session_future is not None:
+            chat_id = session_future.result()
         
         # External Assistant API возвращает прямой объект с полем 'message'
         if assistant_type == 'external' and 'message' in api_response:
@@ -340,9 +1013,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             
             # Пытаемся извлечь JSON из ответа external ассистента
             if api_config and response_text:
-                import re
                 # Ищем JSON в ответе (может быть в markdown блоке или просто в тексте)
-                json_match = re.search(r'\{[^{}]*"action"[^{}]*"params"[^{}]*\}', response_text, re.DOTALL)
+                json_match = EXTERNAL_ACTION_JSON_PATTERN.search(response_text)
                 if json_match:
                     try:
                         parsed_json = json.loads(json_match.group(0))
@@ -378,6 +1050,21 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             tool_calls = []
             print(f"[DEBUG] Unknown response format: {list(api_response.keys())}")
         
+        # Вердикт ждём только здесь: для помеченного сообщения ответ заменяется отказом,
+        # а внешние API и второй вызов GPT не выполняются. Ошибка модерации ответ не блокирует
+        flagged_categories: Optional[List[str]] = None
+        if moderation_future is not None:
+            try:
+                verdict = moderation_future.result()
+            except Exception as e:
+                verdict = None
+                print(f"[DEBUG] Moderation failed, answering without it: {str(e)}")
+            if verdict and verdict.get('flagged'):
+                flagged_categories = [name for name, value in (verdict.get('categories') or {}).items() if value]
+                print(f"[DEBUG] Message flagged by moderation: {flagged_categories}, answer withheld")
+                response_text = MODERATION_REFUSAL
+                tool_calls = []
+        
         # Обработка tool_calls для вызова внешних API
         if tool_calls and api_config:
                 print(f"[DEBUG] tool_calls detected: {len(tool_calls)} calls")
@@ -397,127 +1084,27 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         if missing_params:
                             error_msg = f"Не хватает обязательных параметров: {', '.join(missing_params)}. Пожалуйста, укажите город, дату заезда, количество ночей и количество гостей."
                             print(f"[DEBUG] Missing required params: {missing_params}")
-                            return {
-                                'statusCode': 400,
-                                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                                'body': json_dumps({'error': error_msg}),
-                                'isBase64Encoded': False
-                            }
-                        
-                        # Calculate checkout date from checkin + nights (only if checkout not provided)
-                        if 'checkin' in function_args and 'checkout' not in function_args and 'nights' in function_args:
-                            from datetime import datetime, timedelta
-                            checkin_date = datetime.strptime(function_args['checkin'], '%Y-%m-%d')
-                            nights = int(function_args['nights'])
-                            checkout_date = checkin_date + timedelta(days=nights)
-                            function_args['checkout'] = checkout_date.strftime('%Y-%m-%d')
-                            print(f"[DEBUG] Calculated checkout: {function_args['checkout']} from checkin={function_args['checkin']} + nights={nights}")
-                        
-                        # Remove nights from API request (always)
-                        function_args.pop('nights', None)
-                        
-                        # Add hotels=1 and group_id=4 if user mentioned "отели" in the original message
-                        if user_wants_hotels:
-                            function_args['hotels'] = 1
-                            function_args['group_id'] = 4
-                            print(f"[DEBUG] Detected 'отели' in user message, added hotels=1&group_id=4")
+                            return error_response(400, error_msg)
                         
-                        # Extract client-side filters (not supported by API)
-                        max_price = function_args.pop('max_price', None)
-                        exclude_property_types = function_args.pop('exclude_property_types', None)
+                        search = SearchRequest(function_args, user_wants_hotels, presort_weights(api_config))
+                        function_args = search.api_args
+                        max_price, exclude_property_types = search.max_price, search.exclude_property_types
                         
-                        # Build cache key from search parameters
-                        import hashlib
-                        cache_params = {k: v for k, v in function_args.items()}
+                        print(f"[DEBUG] Search args: {json_dumps(function_args)}, cache key: {search.cache_key}")
                         if max_price:
-                            cache_params['max_price'] = max_price
-                        cache_key = hashlib.md5(json_dumps(cache_params, sort_keys=True).encode()).hexdigest()
-                        
-                        print(f"[DEBUG] Cache key: {cache_key}")
-                        
-                        # Try to get from cache first
-                        conn = psycopg2.connect(database_url)
-                        cursor = conn.cursor()
-                        cursor.execute("""
-                            SELECT search_results 
-                            FROM search_cache 
-                            WHERE cache_key = %s AND expires_at > CURRENT_TIMESTAMP
-                        """, (cache_key,))
-                        cached_result = cursor.fetchone()
-                        
-                        api_data = None
+                            print(f"[DEBUG] Client-side filter: max_price={max_price}")
+                        if exclude_property_types:
+                            print(f"[DEBUG] Client-side filter: exclude_property_types={exclude_property_types}")
                         
-                        if cached_result:
-                            api_data = cached_result[0]
-                            cursor.close()
-                            conn.close()
-                            print(f"[DEBUG] Cache HIT for key {cache_key}")
-                        else:
-                            cursor.close()
-                            conn.close()
-                            print(f"[DEBUG] Cache MISS for key {cache_key}")
-                            
-                            # Build API URL with parameters (without client-side filters)
-                            search_params = urllib.parse.urlencode(function_args)
-                            api_url = f"{api_config['api_base_url']}?{search_params}"
-                            
-                            print(f"[DEBUG] Calling external API: {api_url}")
-                            if max_price:
-                                print(f"[DEBUG] Client-side filter: max_price={max_price}")
-                            if exclude_property_types:
-                                print(f"[DEBUG] Client-side filter: exclude_property_types={exclude_property_types}")
-                            
-                            # Retry logic with exponential backoff
-                            max_retries = 3
-                            retry_delay = 1
-                            last_error = None
-                        
-                        for attempt in range(max_retries):
+                        api_data = speculative.take(search) if speculative else None
+                        if api_data is None:
                             try:
-                                api_req = urllib.request.Request(api_url, headers={'Accept': 'application/json'})
-                                
-                                with urllib.request.urlopen(api_req, timeout=30) as api_response:
-                                    api_response_text = api_response.read().decode('utf-8')
-                                    api_data = json.loads(api_response_text)
-                                    break
-                                    
-                            except (urllib.error.URLError, urllib.error.HTTPError, ConnectionResetError) as e:
-                                last_error = e
-                                print(f"[DEBUG] Attempt {attempt + 1}/{max_retries} failed: {str(e)}")
-                                
-                                if attempt < max_retries - 1:
-                                    print(f"[DEBUG] Retrying in {retry_delay} seconds...")
-                                    time.sleep(retry_delay)
-                                    retry_delay *= 2
-                                else:
-                                    print(f"[DEBUG] All retry attempts exhausted")
-                                    return {
-                                        'statusCode': 503,
-                                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                                        'body': json_dumps({'error': f'External API unavailable: {str(last_error)}'}),
-                                        'isBase64Encoded': False
-                                    }
-                        
-                            if api_data is None:
-                                return {
-                                    'statusCode': 503,
-                                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                                    'body': json_dumps({'error': 'External API returned no data'}),
-                                    'isBase64Encoded': False
-                                }
+                                api_data = fetch_search(database_url, api_config['api_base_url'], search)
+                            except (urllib.error.URLError, ConnectionResetError) as e:
+                                return error_response(503, f'External API unavailable: {str(e)}')
                             
-                            # Save to cache (30 minutes TTL)
-                            conn = psycopg2.connect(database_url)
-                            cursor = conn.cursor()
-                            cursor.execute("""
-                                INSERT INTO search_cache (id, cache_key, search_params, search_results, expires_at)
-                                VALUES (%s, %s, %s, %s, CURRENT_TIMESTAMP + INTERVAL '30 minutes')
-                                ON CONFLICT (id) DO NOTHING
-                            """, (str(uuid.uuid4()), cache_key, json_dumps(cache_params), json_dumps(api_data)))
-                            conn.commit()
-                            cursor.close()
-                            conn.close()
-                            print(f"[DEBUG] Saved to cache: key={cache_key}, expires in 30 minutes")
+                            if api_data is None:
+                                return error_response(503, 'External API returned no data')
                         
                         print(f"[DEBUG] External API response (first 500 chars): {json_dumps(api_data)[:500]}")
                         print(f"[DEBUG] API response keys: {list(api_data.keys()) if isinstance(api_data, dict) else 'list'}")
@@ -526,81 +1113,15 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         if api_config.get('response_mode') == 'json':
                             print(f"[DEBUG] Response mode is 'json' - returning raw JSON to frontend (assistant_type={assistant_type})")
                             
-                            # Extract results array from response if it exists
-                            results = api_data.get('results', []) if isinstance(api_data, dict) else api_data
-                            
-                            print(f"[DEBUG] Extracted results: {len(results) if isinstance(results, list) else 'not a list'}")
-                            
-                            # Filter by max_price if specified
-                            if max_price and isinstance(results, list):
-                                results = [r for r in results if r.get('price', 0) <= max_price]
-                                print(f"[DEBUG] After price filter (<={max_price}): {len(results)} items")
-                            
-                            # Hotels filtering disabled - we trust API parameters hotels=1&group_id=4
-                            # if function_args.get('hotels') == 1 and isinstance(results, list):
-                            #     original_count = len(results)
-                            #     results = [r for r in results if r.get('category_id') == 1]
-                            #     print(f"[DEBUG] After hotels filter (category_id=1): {len(results)} items (removed {original_count - len(results)} non-hotels)")
-                            
-                            # Filter by property type if specified
-                            if exclude_property_types and isinstance(results, list):
-                                # exclude_property_types can be string or list
-                                excluded = exclude_property_types if isinstance(exclude_property_types, list) else [exclude_property_types]
-                                # Normalize to lowercase for comparison
-                                excluded_lower = [e.lower() for e in excluded]
-                                
-                                original_count = len(results)
-                                results = [
-                                    r for r in results 
-                                    if r.get('category', '').lower() not in excluded_lower
-                                ]
-                                print(f"[DEBUG] After property type filter (excluding {excluded}): {len(results)} items (removed {original_count - len(results)})")
+                            results = json_results(api_data, search, weights=page_weights(api_config))
                             
-                            # Limit to 10 items
-                            results = results[:10] if isinstance(results, list) else results
-                            
-                            # Добавляем параметры бронирования к каждому объекту для ссылок
-                            if isinstance(results, list):
-                                # Параметры бронирования для ссылок (checkout уже в function_args)
-                                url_params = urllib.parse.urlencode({
-                                    'dateStart': function_args.get('checkin'),
-                                    'dateEnd': function_args.get('checkout'),
-                                    'adults': function_args.get('guests', 1),
-                                    'children': function_args.get('children', 0),
-                                    'infants': function_args.get('infants', 0),
-                                    'pets': function_args.get('pets', 0)
-                                })
-                                
-                                # Добавляем готовую ссылку с параметрами к каждому результату
-                                is_hotels = function_args.get('hotels') == 1
-                                print(f"[DEBUG] URL generation: hotels={function_args.get('hotels')}, is_hotels={is_hotels}")
-                                
-                                for result in results:
-                                    if isinstance(result, dict) and 'id' in result:
-                                        obj_id = str(result['id'])
-                                        # Убираем префикс (hotel-, hostel-, flat-, room-) из ID
-                                        numeric_id = obj_id.replace('hotel-', '').replace('hostel-', '').replace('flat-', '').replace('room-', '')
-                                        # Логика формирования ссылки: если hotels=1, то /hotels/, иначе /rooms/
-                                        if is_hotels:
-                                            result['bookingUrl'] = f"https://qqrenta.ru/hotels/{numeric_id}?{url_params}"
-                                        else:
-                                            result['bookingUrl'] = f"https://qqrenta.ru/rooms/{numeric_id}?{url_params}"
-                                        print(f"[DEBUG] Added bookingUrl for {obj_id} -> {numeric_id}: {result['bookingUrl']}")
-                                        
-                                        # Маппинг фотографий: если есть preview_img, добавляем в массив photos
-                                        if 'preview_img' in result and result['preview_img']:
-                                            result['photos'] = [result['preview_img']]
-                                            print(f"[DEBUG] Added photo for {obj_id}: {result['preview_img']}")
-                            
-                            print(f"[DEBUG] Returning to frontend: {len(results) if isinstance(results, list) else 1} items")
+                            record_attempts(
+                                database_url, attempts, prefetch_params(assistant_id, speculative),
+                                search_cursor_params(assistant_id, user_id, search) if assistant_type != 'external' else None
+                            )
                             
                             # Return raw JSON data directly
-                            return {
-                                'statusCode': 200,
-                                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                                'body': json_dumps({'response': results, 'mode': 'json'}),
-                                'isBase64Encoded': False
-                            }
+                            return json_response(200, {'response': results, 'mode': 'json'})
                         else:
                             print(f"[DEBUG] Response mode is 'text' - sending API data to GPT for processing")
                             
@@ -611,10 +1132,13 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                                 'tool_calls': tool_calls
                             })
                             
+                            # Модели уходит одна страница отфильтрованных и ранжированных результатов, а не весь ответ API
+                            results, total = ranked_page(api_data, search, weights=page_weights(api_config))
+                            tool_content = {'results': results, 'total': total} if isinstance(results, list) else api_data
                             messages.append({
                                 'role': 'tool',
                                 'tool_call_id': tool_call.get('id'),
-                                'content': json_dumps(api_data, ensure_ascii=False)
+                                'content': json_dumps(tool_content, ensure_ascii=False)
                             })
                             
                             print(f"[DEBUG] Prepared messages for second GPT call (with API data)")
@@ -631,37 +1155,31 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                                 second_payload['database_ids'] = rag_database_ids
                                 second_payload['databases'] = rag_database_ids
                             
-                            second_request_data = json_dumps(second_payload).encode('utf-8')
-                            
                             print(f"[DEBUG] Sending second request to GPTunnel with API data")
                             print(f"[DEBUG] Second payload (first 500 chars): {json_dumps(second_payload, ensure_ascii=False)[:500]}")
                             
-                            # Для второго запроса используем тот же endpoint
-                            second_req = urllib.request.Request(
-                                endpoint,
-                                data=second_request_data,
-                                headers={
-                                    'Content-Type': 'application/json',
-                                    'Authorization': f'Bearer {gptunnel_api_key}'
-                                },
-                                method='POST'
-                            )
+                            # Для второго запроса используем тот же endpoint; по политике начинаем
+                            # с модели, которая ответила на первый
+                            if routing_policy and answered_model:
+                                second_route = [answered_model] + [m for m in route if m != answered_model]
+                            else:
+                                second_route = [second_payload['model']]
+                            try:
+                                bot_response, _ = complete_with_failover(endpoint, second_payload, headers, second_route, request_timeout, attempts)
+                            except (urllib.error.URLError, ConnectionResetError, ValueError) as e:
+                                # В attempts и первый вызов с его токенами: без записи они пропали бы из api_requests
+                                record_attempts(database_url, attempts, prefetch_params(assistant_id, speculative))
+                                return error_response(503, f'GPTunnel API unavailable: {str(e)}')
+                            
+                            # Extract final response from second GPT call
+                            if 'choices' in bot_response and len(bot_response['choices']) > 0:
+                                response_text = bot_response['choices'][0]['message'].get('content', 'Нет ответа')
+                                print(f"[DEBUG] Final response text from GPT: {response_text[:200]}")
+                            else:
+                                response_text = 'Нет ответа от GPT после вызова API'
+                                print(f"[DEBUG] No valid response from second GPT call")
                             
-                            with urllib.request.urlopen(second_req, timeout=60) as second_response:
-                                second_response_data = second_response.read().decode('utf-8')
-                                bot_response = json.loads(second_response_data)
-                                
-                                print(f"[DEBUG] Second GPT response (first 500 chars): {second_response_data[:500]}")
-                                
-                                # Extract final response from second GPT call
-                                if 'choices' in bot_response and len(bot_response['choices']) > 0:
-                                    response_text = bot_response['choices'][0]['message'].get('content', 'Нет ответа')
-                                    print(f"[DEBUG] Final response text from GPT: {response_text[:200]}")
-                                else:
-                                    response_text = 'Нет ответа от GPT после вызова API'
-                                    print(f"[DEBUG] No valid response from second GPT call")
-                                
-                                print(f"[DEBUG] Final response after tool call: {response_text[:200]}")
+                            print(f"[DEBUG] Final response after tool call: {response_text[:200]}")
         
         # Если ожидается JSON ответ, но GPT вернул длинный текст без tool_calls - обрезаем
         if api_config and api_config.get('response_mode') == 'json' and not tool_calls:
@@ -685,60 +1203,22 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             tokens_prompt = usage.get('prompt_tokens', len(message.split()))
             tokens_completion = usage.get('completion_tokens', len(response_text.split() if response_text else []))
             total_cost = usage.get('total_cost', 0.0)
-            model_name = model or 'gpt-4o'
+            model_name = answered_model or model or 'gpt-4o'
         
         try:
-                conn = psycopg2.connect(database_url)
-                cursor = conn.cursor()
-                
-                cursor.execute('''
-                    INSERT INTO assistant_usage (assistant_id, user_id, message_count, tokens_used)
-                    VALUES (%s, %s, %s, %s)
-                ''', (assistant_id, user_id, 1, tokens_total))
-                
-                cursor.execute('''
-                    INSERT INTO usage_stats (endpoint, model, assistant_id, request_count, total_tokens, total_prompt_tokens, total_completion_tokens, total_cost)
-                    VALUES (%s, %s, %s, 1, %s, %s, %s, %s)
-                    ON CONFLICT (endpoint, model, COALESCE(assistant_id, ''), date) 
-                    DO UPDATE SET 
-                        request_count = usage_stats.request_count + 1,
-                        total_tokens = usage_stats.total_tokens + EXCLUDED.total_tokens,
-                        total_prompt_tokens = usage_stats.total_prompt_tokens + EXCLUDED.total_prompt_tokens,
-                        total_completion_tokens = usage_stats.total_completion_tokens + EXCLUDED.total_completion_tokens,
-                        total_cost = usage_stats.total_cost + EXCLUDED.total_cost,
-                        updated_at = CURRENT_TIMESTAMP
-                ''', ('/gptunnel-bot', model_name, assistant_id, tokens_total, tokens_prompt, tokens_completion, total_cost))
-                
-                cursor.execute('''
-                    INSERT INTO messages (assistant_id, user_id, role, content, tokens_used)
-                    VALUES (%s, %s, 'user', %s, %s)
-                ''', (assistant_id, user_id, message, tokens_prompt))
-                
-                cursor.execute('''
-                    INSERT INTO messages (assistant_id, user_id, role, content, tokens_used)
-                    VALUES (%s, %s, 'assistant', %s, %s)
-                ''', (assistant_id, user_id, response_text, tokens_completion))
-                
-                # ОБНОВЛЯЕМ СЧЁТЧИК ТОЛЬКО ПОСЛЕ УСПЕШНОГО ОТВЕТА ОТ GPT
-                cursor.execute('''
-                    UPDATE chat_sessions 
-                    SET message_count = message_count + 2, updated_at = CURRENT_TIMESTAMP
-                    WHERE assistant_id = %s AND user_id = %s
-                ''', (assistant_id, user_id))
-                print(f"[DEBUG] Updated message_count +2 after successful response")
-                
-                conn.commit()
-                cursor.close()
-                conn.close()
-        except:
-            pass
+            record_usage(
+                database_url, assistant_id, user_id, model_name, message, response_text,
+                tokens_total, tokens_prompt, tokens_completion, total_cost, attempts,
+                prefetch_params(assistant_id, speculative) if api_config else None
+            )
+            print(f"[DEBUG] Recorded usage and message_count +2 after successful response")
+        except Exception as e:
+            print(f"[DEBUG] Failed to record usage: {str(e)}")
         
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json_dumps({'response': response_text, 'mode': 'text'}),
-            'isBase64Encoded': False
-        }
+        
+        if flagged_categories is not None:
+            return json_response(200, {'response': response_text, 'mode': 'text', 'flagged': True, 'categories': flagged_categories})
+        return json_response(200, {'response': response_text, 'mode': 'text'})
     
     except urllib.error.HTTPError as e:
         error_body = e.read().decode('utf-8')
@@ -754,25 +1234,10 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         except:
             error_message = str(e)
         
-        return {
-            'statusCode': e.code,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json_dumps({'error': error_message, 'details': error_body[:500]}),
-            'isBase64Encoded': False
-        }
+        return error_response(e.code, error_message, details=error_body[:500])
     
     except urllib.error.URLError as e:
-        return {
-            'statusCode': 503,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json_dumps({'error': f'GPTunnel API unavailable: {str(e)}'}),
-            'isBase64Encoded': False
-        }
+        return error_response(503, f'GPTunnel API unavailable: {str(e)}')
     
     except Exception as e:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json_dumps({'error': str(e)}),
-            'isBase64Encoded': False
-        }
\ No newline at end of file
+        return error_response(500, str(e))
\ No newline at end of file
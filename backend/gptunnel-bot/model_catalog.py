@@ -0,0 +1,217 @@
+'''
+Каталог моделей GPTunnel (/v1/models) на контейнер: копия в памяти, таблица model_catalog
+для холодных контейнеров и фоновое обновление после CATALOG_TTL — запрос никогда не ждёт GPTunnel,
+если каталог уже был загружен хоть одним контейнером. Кроме ответа в формате OpenAI хранит
+метаданные моделей (контекстное окно, цены) для маршрутизации и других функций.
+Модуль лежит копией в каталогах функций, которые его используют (это проверяет bench/cold_start.py).
+'''
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Set
+from runtime import (
+    JSON_HEADERS, db_cursor, upstream_request, gptunnel_url, json_dumps, compress_response,
+    negotiate_encoding, get_header, etag_matches
+)
+
+CATALOG_TTL = 600
+CATALOG_CACHE_CONTROL = 'public, max-age=300, stale-while-revalidate=3600'
+
+# Поля, в которых GPTunnel и совместимые API сообщают размер контекста и цены за 1000 токенов
+CONTEXT_WINDOW_KEYS = ('context_window', 'context_length', 'max_context', 'max_tokens')
+PROMPT_PRICE_KEYS = ('prompt_price', 'input_price', 'price_prompt', 'cost_prompt')
+COMPLETION_PRICE_KEYS = ('completion_price', 'output_price', 'price_completion', 'cost_completion')
+
+def first_number(entry: Dict[str, Any], keys: tuple, pricing_key: Optional[str] = None) -> Optional[float]:
+    '''
+    Первое числовое поле из keys; pricing_key ищется во вложенном объекте pricing (формат OpenRouter)
+    '''
+    candidates = [entry.get(key) for key in keys]
+    if pricing_key and isinstance(entry.get('pricing'), dict):
+        candidates.append(entry['pricing'].get(pricing_key))
+    for value in candidates:
+        if isinstance(value, bool) or value is None:
+            continue
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            continue
+    return None
+
+class ModelInfo:
+    __slots__ = ('id', 'context_window', 'prompt_price', 'completion_price', 'entry')
+
+    def __init__(self, entry: Dict[str, Any]):
+        self.id = entry['id']
+        self.entry = entry
+        context_window = first_number(entry, CONTEXT_WINDOW_KEYS)
+        self.context_window = int(context_window) if context_window else None
+        self.prompt_price = first_number(entry, PROMPT_PRICE_KEYS, 'prompt')
+        self.completion_price = first_number(entry, COMPLETION_PRICE_KEYS, 'completion')
+
+    @property
+    def price(self) -> Optional[float]:
+        '''
+        Средняя цена 1000 токенов по прайсу; None, если GPTunnel цен не сообщает
+        '''
+        prices = [p for p in (self.prompt_price, self.completion_price) if p is not None]
+        return sum(prices) / len(prices) if prices else None
+
+class Catalog:
+    '''
+    Снимок каталога: модели по id в порядке GPTunnel и готовое тело ответа /v1/models
+    '''
+    __slots__ = ('models', 'body', 'etag', 'fetched_at', 'expires', '_responses')
+
+    def __init__(self, entries: List[Dict[str, Any]], fetched_at: float):
+        self.models: Dict[str, ModelInfo] = {}
+        for entry in entries:
+            if isinstance(entry, dict) and entry.get('id'):
+                self.models[entry['id']] = ModelInfo(entry)
+        self.body = json_dumps({'object': 'list', 'data': [info.entry for info in self.models.values()]})
+        self.etag = '"' + hashlib.md5(self.body.encode('utf-8')).hexdigest() + '"'
+        self.fetched_at = fetched_at
+        self.expires = time.monotonic() + max(0.0, CATALOG_TTL - (time.time() - fetched_at))
+        # Кодировка -> готовый (сжатый) ответ: тело сжимается один раз на снимок
+        self._responses: Dict[Optional[str], Dict[str, Any]] = {}
+
+    def model_ids(self) -> Set[str]:
+        return set(self.models)
+
+    def response(self, event: Dict[str, Any]) -> Dict[str, Any]:
+        headers = {**JSON_HEADERS, 'Access-Control-Expose-Headers': 'ETag', 'Cache-Control': CATALOG_CACHE_CONTROL, 'ETag': self.etag}
+        if etag_matches(event, self.etag):
+            return {'statusCode': 304, 'headers': headers, 'body': '', 'isBase64Encoded': False}
+        encoding = negotiate_encoding(get_header(event, 'Accept-Encoding'))
+        response = self._responses.get(encoding)
+        if response is None:
+            response = compress_response(event, {'statusCode': 200, 'headers': headers, 'body': self.body, 'isBase64Encoded': False})
+            self._responses[encoding] = response
+        return response
+
+LOAD_CATALOG_SQL = '''
+    SELECT data, EXTRACT(EPOCH FROM updated_at) FROM model_catalog ORDER BY position
+'''
+
+# Замена каталога одним round trip: удалённые из GPTunnel модели уходят, остальные обновляются
+SAVE_CATALOG_SQL = '''
+    DELETE FROM model_catalog WHERE NOT (id = ANY(%(ids)s::varchar[]));
+
+    INSERT INTO model_catalog (id, position, data, context_window, prompt_price, completion_price, updated_at)
+    SELECT id, position, data, context_window, prompt_price, completion_price, CURRENT_TIMESTAMP
+    FROM unnest(
+        %(ids)s::varchar[], %(positions)s::int[], %(data)s::jsonb[], %(context_windows)s::int[],
+        %(prompt_prices)s::numeric[], %(completion_prices)s::numeric[]
+    ) AS m(id, position, data, context_window, prompt_price, completion_price)
+    ON CONFLICT (id) DO UPDATE SET
+        position = EXCLUDED.position,
+        data = EXCLUDED.data,
+        context_window = EXCLUDED.context_window,
+        prompt_price = EXCLUDED.prompt_price,
+        completion_price = EXCLUDED.completion_price,
+        updated_at = CURRENT_TIMESTAMP
+'''
+
+_catalog: Optional[Catalog] = None
+
+_refresh_lock = threading.Lock()
+_refreshing: Set[str] = set()
+
+def _run_in_background(name: str, target: Callable[..., Any], *args: Any) -> None:
+    with _refresh_lock:
+        if name in _refreshing:
+            return
+        _refreshing.add(name)
+
+    def run() -> None:
+        try:
+            target(*args)
+        except Exception as e:
+            print(f"[CATALOG] {name} failed: {str(e)}")
+        finally:
+            with _refresh_lock:
+                _refreshing.discard(name)
+
+    threading.Thread(target=run, name=f'catalog-{name}', daemon=True).start()
+
+def resolve_api_key(database_url: Optional[str]) -> str:
+    '''
+    Ключ GPTunnel: переменная окружения, иначе секрет из БД
+    '''
+    api_key = os.environ.get('GPTUNNEL_API_KEY')
+    if not api_key and database_url:
+        with db_cursor(database_url) as cursor:
+            cursor.execute("SELECT secret_value FROM secrets WHERE secret_name = 'GPTUNNEL_API_KEY' LIMIT 1")
+            row = cursor.fetchone()
+        api_key = row[0] if row else None
+    if not api_key:
+        raise LookupError('GPTUNNEL_API_KEY не настроен')
+    return api_key
+
+def fetch_catalog(api_key: str) -> List[Dict[str, Any]]:
+    '''
+    Элементы data ответа GPTunnel /v1/models; ошибки как у upstream_request (HTTPError, URLError)
+    '''
+    response = json.loads(upstream_request(
+        gptunnel_url('/v1/models'), headers={'Authorization': f'Bearer {api_key}'}, timeout=10
+    ))
+    return [entry for entry in response.get('data', []) if isinstance(entry, dict) and entry.get('id')]
+
+def store_catalog(database_url: Optional[str], entries: List[Dict[str, Any]]) -> Catalog:
+    '''
+    Делает entries текущим каталогом контейнера и сохраняет их в model_catalog
+    (например, ответ, полученный при проверке ключа в secrets)
+    '''
+    global _catalog
+    catalog = Catalog(entries, time.time())
+    _catalog = catalog
+    if database_url and catalog.models:
+        models = list(catalog.models.values())
+        with db_cursor(database_url) as cursor:
+            cursor.execute(SAVE_CATALOG_SQL, {
+                'ids': [info.id for info in models],
+                'positions': list(range(len(models))),
+                'data': [json_dumps(info.entry) for info in models],
+                'context_windows': [info.context_window for info in models],
+                'prompt_prices': [info.prompt_price for info in models],
+                'completion_prices': [info.completion_price for info in models]
+            })
+    return catalog
+
+def refresh_catalog(database_url: Optional[str], api_key: Optional[str] = None) -> Catalog:
+    return store_catalog(database_url, fetch_catalog(api_key or resolve_api_key(database_url)))
+
+def load_catalog(database_url: Optional[str], api_key: Optional[str] = None) -> Catalog:
+    '''
+    Каталог для холодного контейнера: из model_catalog (устаревший обновляется в фоне),
+    если таблица пуста — синхронно из GPTunnel
+    '''
+    global _catalog
+    if database_url:
+        with db_cursor(database_url) as cursor:
+            cursor.execute(LOAD_CATALOG_SQL)
+            rows = cursor.fetchall()
+        if rows:
+            catalog = Catalog([row[0] for row in rows], float(rows[0][1]))
+            _catalog = catalog
+            if catalog.expires <= time.monotonic():
+                _run_in_background('refresh', refresh_catalog, database_url, api_key)
+            return catalog
+    return refresh_catalog(database_url, api_key)
+
+def get_catalog(database_url: Optional[str], api_key: Optional[str] = None, wait: bool = True) -> Optional[Catalog]:
+    '''
+    Текущий каталог. Устаревший отдаётся сразу и обновляется в фоне. Без wait холодный
+    контейнер получает None, а загрузка уходит в фон (так делает маршрутизация).
+    '''
+    catalog = _catalog
+    if catalog is None:
+        if not wait:
+            _run_in_background('load', load_catalog, database_url, api_key)
+            return None
+        return load_catalog(database_url, api_key)
+    if catalog.expires <= time.monotonic():
+        _run_in_background('refresh', refresh_catalog, database_url, api_key)
+    return catalog
@@ -0,0 +1,408 @@
+'''
+Локальный векторный поиск по чанкам RAG-баз (таблица rag_chunks) без GPTunnel.
+Индекс базы — каталог .npy-файлов, которые читаются через mmap: векторы, квантованные в int8
+с масштабом на измерение (в 4 раза меньше float32 и быстрее в numpy, чем float16), отсортированные
+по спискам IVF, центроиды, границы списков, id чанков и тексты. Базы до FLAT_MAX_VECTORS чанков
+ищутся полным перебором, крупнее — по nprobe ближайшим спискам IVF. Индекс строится в каталоге
+контейнера из rag_chunks, переживает тёплые вызовы и перестраивается в фоне, когда чанки меняются.
+Вместе с ним строится лексический индекс BM25 (rag_lexical.py), ранжирования сливаются через RRF.
+Модуль лежит копией в каталогах функций, которые его используют (это проверяет bench/cold_start.py).
+'''
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence, Set, Tuple
+import numpy as np
+from runtime import db_cursor, upstream_request, gptunnel_url, json_dumps
+from rag_lexical import LexicalIndex, build_lexical, terms, rrf
+
+RAG_INDEX_DIR_DEFAULT = '/tmp/rag-index'
+EMBEDDING_MODEL = 'text-embedding-3-small'
+EMBEDDING_BATCH_SIZE = 64
+
+FLAT_MAX_VECTORS = 20000
+KMEANS_ITERATIONS = 8
+KMEANS_SAMPLE_PER_LIST = 64
+DEFAULT_NPROBE = 16
+ASSIGN_BATCH = 32768
+
+RAG_TOP_K = 5
+# Кандидатов из каждого ранжирования (векторного и BM25) для слияния RRF
+RAG_CANDIDATES = 20
+INDEX_CHECK_TTL = 30
+QUERY_CACHE_MAX_ITEMS = 1024
+
+FORMAT_VERSION = 2
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+def assign_lists(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    '''
+    Номер ближайшего центроида для каждого вектора; пачками, чтобы не держать матрицу n x nlist
+    '''
+    result = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), ASSIGN_BATCH):
+        block = np.asarray(vectors[start:start + ASSIGN_BATCH], dtype=np.float32)
+        result[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return result
+
+def train_centroids(vectors: np.ndarray, nlist: int, seed: int = 0) -> np.ndarray:
+    '''
+    Сферический k-means на выборке: центроиды нормированы, близость — скалярное произведение
+    '''
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(vectors), nlist * KMEANS_SAMPLE_PER_LIST)
+    sample = np.asarray(vectors[np.sort(rng.choice(len(vectors), sample_size, replace=False))], dtype=np.float32)
+    centroids = sample[rng.choice(sample_size, nlist, replace=False)].copy()
+    for _ in range(KMEANS_ITERATIONS):
+        assignment = assign_lists(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, sample)
+        counts = np.bincount(assignment, minlength=nlist)
+        empty = counts == 0
+        if empty.any():
+            sums[empty] = sample[rng.choice(sample_size, int(empty.sum()), replace=False)]
+        centroids = normalize(sums)
+    return centroids
+
+def build_index(
+    path: str, ids: np.ndarray, vectors: np.ndarray, texts: Sequence[str],
+    meta: Dict[str, Any], nlist: Optional[int] = None
+) -> None:
+    '''
+    Записывает индекс в каталог path. Запись идёт во временный каталог с атомарной подменой:
+    читатели старой версии продолжают работать со своими mmap.
+    '''
+    vectors = normalize(vectors)
+    count = len(ids)
+    if nlist is None:
+        nlist = int(np.sqrt(count)) if count > FLAT_MAX_VECTORS else 0
+    if nlist:
+        centroids = train_centroids(vectors, nlist)
+        assignment = assign_lists(vectors, centroids)
+        order = np.argsort(assignment, kind='stable')
+        offsets = np.zeros(nlist + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignment, minlength=nlist), out=offsets[1:])
+    else:
+        centroids = np.zeros((0, vectors.shape[1]), dtype=np.float32)
+        order = np.arange(count)
+        offsets = np.array([0, count], dtype=np.int64)
+
+    # Скалярное квантование: измерение d хранится как round(v / scale[d]), |v| <= 127 * scale[d]
+    scales = np.maximum(np.abs(vectors).max(axis=0), 1e-6) / 127
+    quantized = np.empty(vectors.shape, dtype=np.int8)
+    for start in range(0, count, ASSIGN_BATCH):
+        rows = order[start:start + ASSIGN_BATCH]
+        quantized[start:start + len(rows)] = np.round(vectors[rows] / scales)
+
+    encoded = [texts[i].encode('utf-8') for i in order]
+    text_offsets = np.zeros(count + 1, dtype=np.int64)
+    np.cumsum([len(t) for t in encoded], out=text_offsets[1:])
+
+    tmp_path = f'{path}.tmp-{os.getpid()}-{threading.get_ident()}'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    np.save(os.path.join(tmp_path, 'vectors.npy'), quantized)
+    np.save(os.path.join(tmp_path, 'scales.npy'), scales.astype(np.float32))
+    np.save(os.path.join(tmp_path, 'ids.npy'), np.asarray(ids, dtype=np.int64)[order])
+    np.save(os.path.join(tmp_path, 'centroids.npy'), centroids)
+    np.save(os.path.join(tmp_path, 'offsets.npy'), offsets)
+    np.save(os.path.join(tmp_path, 'text_offsets.npy'), text_offsets)
+    with open(os.path.join(tmp_path, 'texts.bin'), 'wb') as f:
+        for text in encoded:
+            f.write(text)
+    lexical_meta = build_lexical(tmp_path, (texts[i] for i in order))
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump({
+            **meta, **lexical_meta, 'format': FORMAT_VERSION, 'count': count, 'dim': int(vectors.shape[1]), 'nlist': nlist
+        }, f)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+
+class VectorIndex:
+    '''
+    Индекс, открытый через mmap: в памяти процесса только центроиды, масштабы и границы списков.
+    Лексический индекс (BM25) открывается при первом обращении к lexical.
+    '''
+    __slots__ = ('path', 'meta', 'vectors', 'scales', 'ids', 'centroids', 'offsets', 'text_offsets', 'texts', '_lexical')
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.vectors = np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r')
+        self.scales = np.load(os.path.join(path, 'scales.npy'))
+        self.ids = np.load(os.path.join(path, 'ids.npy'), mmap_mode='r')
+        self.centroids = np.load(os.path.join(path, 'centroids.npy'))
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'))
+        self.text_offsets = np.load(os.path.join(path, 'text_offsets.npy'), mmap_mode='r')
+        self.texts = np.memmap(os.path.join(path, 'texts.bin'), dtype=np.uint8, mode='r') if self.text_offsets[-1] else None
+        self._lexical: Optional[LexicalIndex] = None
+
+    @property
+    def lexical(self) -> LexicalIndex:
+        if self._lexical is None:
+            self._lexical = LexicalIndex(self.path, self.meta.get('avgDocLength', 0.0))
+        return self._lexical
+
+    @property
+    def size(self) -> int:
+        return len(self.ids)
+
+    def text(self, position: int) -> str:
+        start, end = int(self.text_offsets[position]), int(self.text_offsets[position + 1])
+        return bytes(self.texts[start:end]).decode('utf-8') if self.texts is not None else ''
+
+    def search(self, query: np.ndarray, k: int = RAG_TOP_K, nprobe: int = DEFAULT_NPROBE) -> List[Tuple[int, float, int]]:
+        '''
+        k ближайших чанков: (id чанка, косинусная близость, позиция в индексе)
+        '''
+        if not self.size:
+            return []
+        query = normalize(query)
+        if len(self.centroids):
+            nprobe = min(nprobe, len(self.centroids))
+            lists = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+            ranges = [(int(self.offsets[i]), int(self.offsets[i + 1])) for i in np.sort(lists)]
+            positions = np.concatenate([np.arange(start, end) for start, end in ranges])
+            block = np.concatenate([self.vectors[start:end] for start, end in ranges])
+        else:
+            positions = np.arange(self.size)
+            block = self.vectors
+        if not len(positions):
+            return []
+        # Масштаб переносится на запрос: v . q = sum(int8[d] * scale[d] * q[d])
+        scores = np.asarray(block, dtype=np.float32) @ (query * self.scales)
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(self.ids[positions[i]]), float(scores[i]), int(positions[i])) for i in top]
+
+def embed_texts(api_key: str, texts: List[str], model: str = EMBEDDING_MODEL) -> np.ndarray:
+    '''
+    Эмбеддинги GPTunnel /v1/embeddings пачками по EMBEDDING_BATCH_SIZE
+    '''
+    result = []
+    for start in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+        response = json.loads(upstream_request(
+            gptunnel_url('/v1/embeddings'),
+            data=json_dumps({'model': model, 'input': texts[start:start + EMBEDDING_BATCH_SIZE]}).encode('utf-8'),
+            headers={'Content-Type': 'application/json', 'Authorization': f'Bearer {api_key}'},
+            method='POST',
+            timeout=30
+        ))
+        data = sorted(response.get('data', []), key=lambda item: item.get('index', 0))
+        result.extend(item['embedding'] for item in data)
+    return np.asarray(result, dtype=np.float32)
+
+# Состояние чанков базы: пока оно не меняется, индекс в каталоге контейнера актуален
+INDEX_VERSIONS_SQL = '''
+    SELECT database_id, COUNT(*), MAX(id), MAX(model)
+    FROM rag_chunks
+    WHERE database_id = ANY(%s) AND embedding IS NOT NULL
+    GROUP BY database_id
+'''
+
+LOAD_CHUNKS_SQL = '''
+    SELECT id, embedding, content FROM rag_chunks
+    WHERE database_id = %s AND embedding IS NOT NULL
+    ORDER BY id
+'''
+
+INSERT_CHUNKS_SQL = '''
+    INSERT INTO rag_chunks (database_id, file_id, position, content, embedding, model)
+    SELECT %(database_id)s, %(file_id)s, position, content, embedding, %(model)s
+    FROM unnest(%(positions)s::int[], %(contents)s::text[], %(embeddings)s::bytea[]) AS c(position, content, embedding)
+'''
+
+def index_dir() -> str:
+    return os.environ.get('RAG_INDEX_DIR', RAG_INDEX_DIR_DEFAULT)
+
+def database_dir(database_id: str) -> str:
+    return os.path.join(index_dir(), hashlib.md5(database_id.encode('utf-8')).hexdigest())
+
+def encode_embeddings(embeddings: np.ndarray) -> List[bytes]:
+    '''
+    Значения rag_chunks.embedding: float32 little-endian
+    '''
+    return [np.asarray(e, dtype='<f4').tobytes() for e in embeddings]
+
+def store_chunks(
+    database_url: str, database_id: str, file_id: Optional[str], contents: List[str],
+    embeddings: np.ndarray, model: str = EMBEDDING_MODEL, first_position: int = 0
+) -> None:
+    '''
+    Сохраняет чанки с эмбеддингами (float32) одним INSERT; индексы контейнеров перестроятся сами
+    '''
+    if not contents:
+        return
+    with db_cursor(database_url) as cursor:
+        cursor.execute(INSERT_CHUNKS_SQL, {
+            'database_id': database_id,
+            'file_id': file_id,
+            'model': model,
+            'positions': list(range(first_position, first_position + len(contents))),
+            'contents': contents,
+            'embeddings': encode_embeddings(embeddings)
+        })
+
+def build_database_index(database_url: str, database_id: str, version: str, model: str) -> VectorIndex:
+    ids: List[int] = []
+    vectors: List[np.ndarray] = []
+    texts: List[str] = []
+    with db_cursor(database_url) as cursor:
+        cursor.execute(LOAD_CHUNKS_SQL, (database_id,))
+        while True:
+            rows = cursor.fetchmany(2000)
+            if not rows:
+                break
+            for chunk_id, embedding, content in rows:
+                ids.append(chunk_id)
+                vectors.append(np.frombuffer(bytes(embedding), dtype='<f4'))
+                texts.append(content)
+    base = database_dir(database_id)
+    path = os.path.join(base, version)
+    os.makedirs(base, exist_ok=True)
+    build_index(path, np.asarray(ids, dtype=np.int64), np.vstack(vectors), texts, {'databaseId': database_id, 'version': version, 'model': model})
+    # Старые версии не нужны: открытые mmap остаются валидными и после удаления файлов
+    for name in os.listdir(base):
+        if name != version and '.tmp-' not in name:
+            shutil.rmtree(os.path.join(base, name), ignore_errors=True)
+    return VectorIndex(path)
+
+# database_id -> (VectorIndex, версия); версии из БД проверяются не чаще раза в INDEX_CHECK_TTL
+_indexes: Dict[str, Tuple[VectorIndex, str]] = {}
+_versions: Dict[str, Tuple[Optional[Tuple[str, str]], float]] = {}
+_query_cache: Dict[Tuple[str, str], np.ndarray] = {}
+
+_build_lock = threading.Lock()
+_building: Set[str] = set()
+
+def _build_in_background(database_id: str, target: Callable[..., Any], *args: Any) -> None:
+    with _build_lock:
+        if database_id in _building:
+            return
+        _building.add(database_id)
+
+    def run() -> None:
+        try:
+            started = time.monotonic()
+            index = target(*args)
+            _indexes[database_id] = (index, index.meta['version'])
+            print(f"[RAG] Built index for {database_id}: {index.size} chunks in {int((time.monotonic() - started) * 1000)}ms")
+        except Exception as e:
+            print(f"[RAG] Index build for {database_id} failed: {str(e)}")
+        finally:
+            with _build_lock:
+                _building.discard(database_id)
+
+    threading.Thread(target=run, name=f'rag-build-{database_id}', daemon=True).start()
+
+def refresh_versions(database_url: str, database_ids: List[str]) -> None:
+    now = time.monotonic()
+    stale = [d for d in database_ids if _versions.get(d, (None, 0.0))[1] <= now]
+    if not stale:
+        return
+    with db_cursor(database_url) as cursor:
+        cursor.execute(INDEX_VERSIONS_SQL, (stale,))
+        rows = {row[0]: row for row in cursor.fetchall()}
+    for database_id in stale:
+        row = rows.get(database_id)
+        version = (f'{row[1]}-{row[2]}', row[3] or EMBEDDING_MODEL) if row else None
+        _versions[database_id] = (version, now + INDEX_CHECK_TTL)
+
+def ready_indexes(database_url: str, database_ids: List[str], wait: bool = False) -> List[VectorIndex]:
+    '''
+    Индексы баз, готовые к поиску. Отсутствующий или устаревший индекс строится в фоне,
+    пока запросы обслуживает прежняя версия (или поиск по базе пропускается); wait строит сразу.
+    '''
+    refresh_versions(database_url, database_ids)
+    result = []
+    for database_id in database_ids:
+        version = _versions.get(database_id, (None, 0.0))[0]
+        if version is None:
+            continue
+        loaded = _indexes.get(database_id)
+        if loaded is None:
+            path = os.path.join(database_dir(database_id), version[0])
+            if os.path.exists(os.path.join(path, 'meta.json')):
+                index = VectorIndex(path)
+                # Индекс старого формата на диске контейнера перестраивается, как устаревший
+                if index.meta.get('format') == FORMAT_VERSION:
+                    loaded = (index, version[0])
+                    _indexes[database_id] = loaded
+        if loaded is None or loaded[1] != version[0]:
+            if wait:
+                index = build_database_index(database_url, database_id, version[0], version[1])
+                loaded = (index, version[0])
+                _indexes[database_id] = loaded
+            else:
+                _build_in_background(database_id, build_database_index, database_url, database_id, version[0], version[1])
+        if loaded is not None:
+            result.append(loaded[0])
+    return result
+
+def query_embedding(api_key: str, text: str, model: str) -> np.ndarray:
+    key = (model, text)
+    cached = _query_cache.pop(key, None)
+    if cached is None:
+        cached = normalize(embed_texts(api_key, [text], model)[0])
+        if len(_query_cache) >= QUERY_CACHE_MAX_ITEMS:
+            _query_cache.pop(next(iter(_query_cache)), None)
+    _query_cache[key] = cached
+    return cached
+
+def retrieve(database_url: str, api_key: str, database_ids: List[str], query: str, k: int = RAG_TOP_K) -> List[Dict[str, Any]]:
+    '''
+    Top-k фрагментов по всем базам ассистента: [{id, databaseId, score, text}], лучшие первыми.
+    Векторный поиск и BM25 сливаются через RRF (score — сумма 1 / (RRF_K + ранг)); если эмбеддинг
+    запроса получить не удалось, поиск остаётся лексическим.
+    '''
+    indexes = ready_indexes(database_url, database_ids)
+    hits: List[Dict[str, Any]] = []
+    embeddings: Dict[str, Optional[np.ndarray]] = {}
+    query_terms = terms(query)
+    for index in indexes:
+        model = index.meta.get('model', EMBEDDING_MODEL)
+        if model not in embeddings:
+            try:
+                embeddings[model] = query_embedding(api_key, query, model)
+            except Exception as e:
+                print(f"[RAG] Query embedding failed, lexical search only: {str(e)}")
+                embeddings[model] = None
+        embedding = embeddings[model]
+        vector_ranking = []
+        if embedding is not None and embedding.shape[0] == index.meta['dim']:
+            vector_ranking = [position for _, _, position in index.search(embedding, RAG_CANDIDATES)]
+        lexical_ranking = [position for position, _ in index.lexical.search(query_terms, RAG_CANDIDATES)]
+        fused = sorted(rrf([vector_ranking, lexical_ranking]).items(), key=lambda item: -item[1])
+        for position, score in fused[:k]:
+            hits.append({
+                'id': int(index.ids[position]), 'databaseId': index.meta['databaseId'], 'score': score, 'text': index.text(position)
+            })
+    hits.sort(key=lambda hit: -hit['score'])
+    return hits[:k]
+
+RAG_CONTEXT_MAX_CHARS = 6000
+
+def format_context(hits: List[Dict[str, Any]], max_chars: int = RAG_CONTEXT_MAX_CHARS) -> str:
+    '''
+    Системное сообщение с найденными фрагментами, не длиннее max_chars
+    '''
+    parts = ['Фрагменты базы знаний, относящиеся к вопросу пользователя. Отвечай, опираясь на них:']
+    used = len(parts[0])
+    for number, hit in enumerate(hits, 1):
+        part = f'[{number}] {hit["text"].strip()}'
+        if used + len(part) > max_chars:
+            part = part[:max(0, max_chars - used)]
+        if not part:
+            break
+        parts.append(part)
+        used += len(part)
+    return '\n\n'.join(parts)
@@ -0,0 +1,326 @@
+'''
+Лексический индекс RAG-баз (BM25) рядом с векторным индексом rag_index.py: точные токены
+(улицы, цены, номера домов), которые эмбеддинги размывают. Русские слова приводятся к основе
+стеммером Snowball, числа и латиница индексируются как есть.
+
+Хранение компактное и читается через mmap: отсортированные 64-битные хэши термов (поиск терма —
+searchsorted без загрузки словаря), смещения списков и сами списки документов — дельты позиций
+и частоты, закодированные varint. Индекс открывается лениво, при первом лексическом запросе к базе.
+Модуль лежит копией в каталогах функций, которые его используют (это проверяет bench/cold_start.py).
+'''
+import hashlib
+import math
+import os
+import re
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+import numpy as np
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Сколько элементов списков документов разбирается на запрос: термы идут от редких к частым,
+# частые (встречающиеся в большой доле базы) отбрасываются, когда бюджет исчерпан
+LEXICAL_MAX_POSTINGS = 200000
+# Терм из большей части базы («улица», «цена» в прайс-листе) почти не влияет на BM25, а разбирать его
+# список дороже всего: такие термы пропускаются, если в запросе есть более редкие
+LEXICAL_MIN_IDF = 0.5
+RRF_K = 60
+STEM_CACHE_MAX_ITEMS = 100000
+
+TOKEN_RE = re.compile(r'\w+')
+CYRILLIC_RE = re.compile(r'^[а-я]+$')
+
+STOPWORDS = frozenset('''
+а без более бы был была были было быть в вам вас весь во вот все всего всех вы где да даже для до его ее
+если есть еще же за здесь и из или им их к как ко когда кто ли либо мне может мы на над надо наш не него
+нее нет ни них но ну о об однако он она они оно от очень по под при с со так также такой там те тем то
+того тоже той только том ты у уже хотя чего чей чем что чтобы чье чья эта эти это я
+'''.split())
+
+# Snowball Russian: https://snowballstem.org/algorithms/russian/stemmer.html
+VOWELS = frozenset('аеиоуыэюя')
+PERFECTIVE_GERUND_1 = ('вшись', 'вши', 'в')
+PERFECTIVE_GERUND_2 = ('ившись', 'ывшись', 'ивши', 'ывши', 'ив', 'ыв')
+ADJECTIVE = (
+    'ими', 'ыми', 'его', 'ого', 'ему', 'ому', 'ее', 'ие', 'ые', 'ое', 'ей', 'ий', 'ый', 'ой', 'ем', 'им', 'ым',
+    'ом', 'их', 'ых', 'ую', 'юю', 'ая', 'яя', 'ою', 'ею'
+)
+PARTICIPLE_1 = ('ем', 'нн', 'вш', 'ющ', 'щ')
+PARTICIPLE_2 = ('ивш', 'ывш', 'ующ')
+REFLEXIVE = ('ся', 'сь')
+VERB_1 = ('ете', 'йте', 'ешь', 'нно', 'ла', 'на', 'ли', 'ем', 'ло', 'но', 'ет', 'ют', 'ны', 'ть', 'й', 'л', 'н')
+VERB_2 = (
+    'ейте', 'уйте', 'ила', 'ыла', 'ена', 'ите', 'или', 'ыли', 'ило', 'ыло', 'ено', 'ует', 'уют', 'ены', 'ить',
+    'ыть', 'ишь', 'ей', 'уй', 'ил', 'ыл', 'им', 'ым', 'ен', 'ят', 'ит', 'ыт', 'ую', 'ю'
+)
+NOUN = (
+    'иями', 'ями', 'ами', 'ией', 'иям', 'ием', 'иях', 'ев', 'ов', 'ие', 'ье', 'еи', 'ии', 'ей', 'ой', 'ий', 'ям',
+    'ем', 'ам', 'ом', 'ах', 'ях', 'ию', 'ью', 'ия', 'ья', 'а', 'е', 'и', 'й', 'о', 'у', 'ы', 'ь', 'ю', 'я'
+)
+DERIVATIONAL = ('ость', 'ост')
+SUPERLATIVE = ('ейше', 'ейш')
+
+def _longest(word: str, suffixes: Tuple[str, ...]) -> Optional[str]:
+    best = None
+    for suffix in suffixes:
+        if word.endswith(suffix) and (best is None or len(suffix) > len(best)):
+            best = suffix
+    return best
+
+def _strip_grouped(rv: str, group_1: Tuple[str, ...], group_2: Tuple[str, ...]) -> Optional[str]:
+    '''
+    Самое длинное окончание из двух групп; окончаниям группы 1 должна предшествовать а или я
+    '''
+    suffix_1 = _longest(rv, group_1)
+    if suffix_1 is not None and not rv[:-len(suffix_1)].endswith(('а', 'я')):
+        suffix_1 = None
+    suffix_2 = _longest(rv, group_2)
+    if suffix_1 is None and suffix_2 is None:
+        return None
+    if suffix_2 is None or (suffix_1 is not None and len(suffix_1) > len(suffix_2)):
+        return rv[:-len(suffix_1)]
+    return rv[:-len(suffix_2)]
+
+def _regions(word: str) -> Tuple[int, int]:
+    '''
+    Начала RV (после первой гласной) и R2 алгоритма Snowball
+    '''
+    rv = r1 = r2 = len(word)
+    for i, char in enumerate(word):
+        if char in VOWELS:
+            rv = i + 1
+            break
+    for i in range(1, len(word)):
+        if word[i - 1] in VOWELS and word[i] not in VOWELS:
+            r1 = i + 1
+            break
+    for i in range(r1 + 1, len(word)):
+        if word[i - 1] in VOWELS and word[i] not in VOWELS:
+            r2 = i + 1
+            break
+    return rv, r2
+
+def stem_word(word: str) -> str:
+    '''
+    Основа русского слова в нижнем регистре (ё уже заменена на е)
+    '''
+    rv_start, r2_start = _regions(word)
+    prefix, rv = word[:rv_start], word[rv_start:]
+
+    # Шаг 1: деепричастие, иначе возвратная частица и затем прилагательное, глагол или существительное
+    stripped = _strip_grouped(rv, PERFECTIVE_GERUND_1, PERFECTIVE_GERUND_2)
+    if stripped is not None:
+        rv = stripped
+    else:
+        suffix = _longest(rv, REFLEXIVE)
+        if suffix:
+            rv = rv[:-len(suffix)]
+        suffix = _longest(rv, ADJECTIVE)
+        if suffix:
+            rv = rv[:-len(suffix)]
+            stripped = _strip_grouped(rv, PARTICIPLE_1, PARTICIPLE_2)
+            if stripped is not None:
+                rv = stripped
+        else:
+            stripped = _strip_grouped(rv, VERB_1, VERB_2)
+            if stripped is not None:
+                rv = stripped
+            else:
+                suffix = _longest(rv, NOUN)
+                if suffix:
+                    rv = rv[:-len(suffix)]
+
+    # Шаг 2
+    if rv.endswith('и'):
+        rv = rv[:-1]
+
+    # Шаг 3: словообразовательное окончание в R2
+    suffix = _longest(rv, DERIVATIONAL)
+    if suffix and rv_start + len(rv) - len(suffix) >= r2_start:
+        rv = rv[:-len(suffix)]
+
+    # Шаг 4
+    if rv.endswith('нн'):
+        rv = rv[:-1]
+    else:
+        suffix = _longest(rv, SUPERLATIVE)
+        if suffix:
+            rv = rv[:-len(suffix)]
+            if rv.endswith('нн'):
+                rv = rv[:-1]
+        elif rv.endswith('ь'):
+            rv = rv[:-1]
+    return prefix + rv
+
+_stem_cache: Dict[str, str] = {}
+
+def terms(text: str) -> List[str]:
+    '''
+    Термы текста: основы русских слов без стоп-слов, числа и прочие слова как есть
+    '''
+    result = []
+    for token in TOKEN_RE.findall(text.lower().replace('ё', 'е')):
+        if token in STOPWORDS:
+            continue
+        if CYRILLIC_RE.match(token) and len(token) > 2:
+            stem = _stem_cache.get(token)
+            if stem is None:
+                stem = stem_word(token)
+                if len(_stem_cache) >= STEM_CACHE_MAX_ITEMS:
+                    _stem_cache.pop(next(iter(_stem_cache)), None)
+                _stem_cache[token] = stem
+            token = stem
+        result.append(token)
+    return result
+
+def term_hash(term: str) -> int:
+    return int.from_bytes(hashlib.blake2b(term.encode('utf-8'), digest_size=8).digest(), 'little')
+
+def encode_varints(values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    varint (7 бит на байт, старший бит — продолжение) для массива uint32; (байты, смещение каждого значения)
+    '''
+    values = values.astype(np.uint64)
+    lengths = np.ones(len(values), dtype=np.int64)
+    for bits in (7, 14, 21, 28):
+        lengths += values >= (1 << bits)
+    starts = np.cumsum(lengths) - lengths
+    out = np.empty(int(lengths.sum()), dtype=np.uint8)
+    for byte in range(5):
+        mask = lengths > byte
+        if not mask.any():
+            break
+        chunk = (values[mask] >> np.uint64(7 * byte)) & np.uint64(0x7F)
+        chunk |= np.where(lengths[mask] > byte + 1, np.uint64(0x80), np.uint64(0))
+        out[starts[mask] + byte] = chunk.astype(np.uint8)
+    return out, starts
+
+def decode_varints(data: np.ndarray) -> np.ndarray:
+    if not len(data):
+        return np.zeros(0, dtype=np.int64)
+    data = np.asarray(data, dtype=np.uint8)
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.empty(len(ends), dtype=np.int64)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    group = np.repeat(np.arange(len(ends)), ends - starts + 1)
+    shifts = (7 * (np.arange(len(data)) - starts[group])).astype(np.uint64)
+    return np.add.reduceat((data & 0x7F).astype(np.uint64) << shifts, starts).astype(np.int64)
+
+def build_lexical(path: str, texts: Iterable[str]) -> Dict[str, float]:
+    '''
+    Пишет lex_*.npy и lex_postings.bin в каталог индекса; texts — в порядке позиций векторного индекса.
+    Возвращает поля для meta.json.
+    '''
+    vocabulary: Dict[str, int] = {}
+    term_ids: List[np.ndarray] = []
+    tfs: List[np.ndarray] = []
+    doc_lengths: List[int] = []
+    for text in texts:
+        doc_terms = terms(text)
+        doc_lengths.append(len(doc_terms))
+        counts: Dict[int, int] = {}
+        for term in doc_terms:
+            term_id = vocabulary.setdefault(term, len(vocabulary))
+            counts[term_id] = counts.get(term_id, 0) + 1
+        term_ids.append(np.fromiter(counts.keys(), dtype=np.uint32, count=len(counts)))
+        tfs.append(np.fromiter(counts.values(), dtype=np.uint32, count=len(counts)))
+    doc_count = len(doc_lengths)
+    per_doc = np.fromiter((len(ids) for ids in term_ids), dtype=np.int64, count=doc_count)
+    all_terms = np.concatenate(term_ids) if term_ids else np.zeros(0, dtype=np.uint32)
+    all_tfs = np.concatenate(tfs) if tfs else np.zeros(0, dtype=np.uint32)
+    all_docs = np.repeat(np.arange(doc_count, dtype=np.uint32), per_doc)
+    del term_ids, tfs
+
+    # Термы нумеруются в порядке своих хэшей: номер терма — его место в lex_terms.npy
+    hashes = np.fromiter((term_hash(term) for term in vocabulary), dtype=np.uint64, count=len(vocabulary))
+    hash_order = np.argsort(hashes, kind='stable')
+    rank = np.empty(len(vocabulary), dtype=np.uint32)
+    rank[hash_order] = np.arange(len(vocabulary), dtype=np.uint32)
+    all_terms = rank[all_terms]
+    order = np.argsort(all_terms, kind='stable')
+    all_terms, all_docs, all_tfs = all_terms[order], all_docs[order], all_tfs[order]
+    del order
+
+    df = np.bincount(all_terms, minlength=len(vocabulary)).astype(np.uint32)
+    segment_starts = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+    np.cumsum(df, out=segment_starts[1:])
+    deltas = all_docs.astype(np.int64)
+    deltas[1:] -= all_docs[:-1].astype(np.int64)
+    nonempty = segment_starts[:-1][df > 0]
+    deltas[nonempty] = all_docs[nonempty]
+    interleaved = np.empty(2 * len(deltas), dtype=np.uint32)
+    interleaved[0::2] = deltas
+    interleaved[1::2] = all_tfs
+    encoded, value_starts = encode_varints(interleaved)
+    byte_offsets = np.append(value_starts[0::2], len(encoded))[segment_starts]
+
+    np.save(os.path.join(path, 'lex_terms.npy'), hashes[hash_order])
+    np.save(os.path.join(path, 'lex_df.npy'), df)
+    np.save(os.path.join(path, 'lex_offsets.npy'), byte_offsets.astype(np.int64))
+    np.save(os.path.join(path, 'lex_doclen.npy'), np.asarray(doc_lengths, dtype=np.uint32))
+    encoded.tofile(os.path.join(path, 'lex_postings.bin'))
+    return {'lexicalTerms': len(vocabulary), 'avgDocLength': float(np.mean(doc_lengths)) if doc_lengths else 0.0}
+
+class LexicalIndex:
+    '''
+    BM25 по mmap-файлам индекса; позиции документов совпадают с позициями векторного индекса
+    '''
+    __slots__ = ('term_hashes', 'df', 'offsets', 'doc_lengths', 'postings', 'avgdl')
+
+    def __init__(self, path: str, avgdl: float):
+        self.term_hashes = np.load(os.path.join(path, 'lex_terms.npy'), mmap_mode='r')
+        self.df = np.load(os.path.join(path, 'lex_df.npy'), mmap_mode='r')
+        self.offsets = np.load(os.path.join(path, 'lex_offsets.npy'), mmap_mode='r')
+        self.doc_lengths = np.load(os.path.join(path, 'lex_doclen.npy'), mmap_mode='r')
+        postings_path = os.path.join(path, 'lex_postings.bin')
+        self.postings = np.memmap(postings_path, dtype=np.uint8, mode='r') if os.path.getsize(postings_path) else np.zeros(0, dtype=np.uint8)
+        self.avgdl = avgdl or 1.0
+
+    def search(self, query_terms: Sequence[str], k: int) -> List[Tuple[int, float]]:
+        '''
+        k лучших документов по BM25: (позиция, score)
+        '''
+        doc_count = len(self.doc_lengths)
+        if not doc_count or not len(self.term_hashes) or not query_terms:
+            return []
+        hashes = np.array(sorted({term_hash(term) for term in query_terms}), dtype=np.uint64)
+        found = np.searchsorted(self.term_hashes, hashes)
+        found = found[found < len(self.term_hashes)]
+        found = [int(i) for i in found if self.term_hashes[i] in hashes]
+        found.sort(key=lambda i: int(self.df[i]))
+        docs_parts: List[np.ndarray] = []
+        score_parts: List[np.ndarray] = []
+        budget = LEXICAL_MAX_POSTINGS
+        for term in found:
+            df = int(self.df[term])
+            idf = math.log(1 + (doc_count - df + 0.5) / (df + 0.5))
+            if docs_parts and (df > budget or idf < LEXICAL_MIN_IDF):
+                break
+            budget -= df
+            values = decode_varints(self.postings[int(self.offsets[term]):int(self.offsets[term + 1])])
+            docs = np.cumsum(values[0::2])
+            tf = values[1::2].astype(np.float32)
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * np.asarray(self.doc_lengths[docs], dtype=np.float32) / self.avgdl)
+            docs_parts.append(docs)
+            score_parts.append(idf * tf * (BM25_K1 + 1) / (tf + norm))
+        if not docs_parts:
+            return []
+        docs = np.concatenate(docs_parts)
+        scores = np.concatenate(score_parts)
+        if len(docs_parts) > 1:
+            docs, inverse = np.unique(docs, return_inverse=True)
+            scores = np.bincount(inverse, weights=scores)
+        k = min(k, len(docs))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(docs[i]), float(scores[i])) for i in top]
+
+def rrf(rankings: Sequence[Sequence[int]], k: int = RRF_K) -> Dict[int, float]:
+    '''
+    Reciprocal rank fusion: ключ -> сумма 1 / (k + ранг) по всем ранжированиям
+    '''
+    fused: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking, 1):
+            fused[key] = fused.get(key, 0.0) + 1.0 / (k + rank)
+    return fused
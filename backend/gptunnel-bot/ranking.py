@@ -0,0 +1,205 @@
+'''
+Ранжирование результатов поиска жилья из ответа API интеграции. Признаки объектов (цена, рейтинг,
+удалённость, вместимость, тип) собираются в массивы numpy один раз на закэшированный ответ
+(ключ search_cache) и живут в кэше контейнера между тёплыми вызовами: страницы, пересортировки
+и фильтры того же поиска считаются масками и взвешенной суммой без повторного разбора JSON.
+Нужная страница выбирается через argpartition — полная сортировка тысяч объектов не нужна.
+Веса задаются на интеграцию (api_integrations.ranking_weights); без весов порядок остаётся порядком API.
+'''
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+import numpy as np
+
+FEATURES_CACHE_TTL = 600
+FEATURES_CACHE_MAX_ITEMS = 64
+
+# Поля ответа API по приоритету: QQRenta отдаёт external_reviews_rating, координаты и guests,
+# у других интеграций бывают rating и готовое distance_to_center
+RATING_FIELDS = ('external_reviews_rating', 'rating')
+CAPACITY_FIELDS = ('max_guests', 'guests', 'capacity')
+
+# Явные сортировки продолжения поиска (slots.follow_up_intent): признак и направление
+SORTS = {
+    'price_asc': ('price', False),
+    'price_desc': ('price', True),
+    'rating': ('rating', True),
+    'distance': ('distance', False)
+}
+
+EARTH_RADIUS_KM = 6371.0
+
+def _number(value: Any) -> float:
+    if isinstance(value, bool):
+        return np.nan
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            return float(value.replace(',', '.'))
+        except ValueError:
+            return np.nan
+    return np.nan
+
+def _first_number(item: Dict[str, Any], fields: Sequence[str]) -> float:
+    for field in fields:
+        value = _number(item.get(field))
+        if not np.isnan(value):
+            return value
+    return np.nan
+
+def _distances(items: List[Any]) -> np.ndarray:
+    '''
+    Километры до центра: distance_to_center из ответа, иначе расстояние от latitude/longitude
+    до медианы координат выдачи — для поиска по городу это и есть его центр
+    '''
+    given = np.array([_number(item.get('distance_to_center')) for item in items], dtype=np.float64)
+    lat = np.array([_number(item.get('latitude')) for item in items], dtype=np.float64)
+    lon = np.array([_number(item.get('longitude')) for item in items], dtype=np.float64)
+    located = np.isfinite(lat) & np.isfinite(lon)
+    if not located.any():
+        return given
+    lat, lon = np.radians(lat), np.radians(lon)
+    center_lat, center_lon = np.median(lat[located]), np.median(lon[located])
+    # Гаверсинус; на масштабе города погрешность пренебрежимо мала
+    a = np.sin((lat - center_lat) / 2) ** 2 + np.cos(lat) * np.cos(center_lat) * np.sin((lon - center_lon) / 2) ** 2
+    computed = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+    return np.where(np.isfinite(given), given, computed)
+
+class ResultFeatures:
+    '''
+    Признаки одного ответа API: массивы float64 (NaN — значения нет) и тип объекта в нижнем регистре
+    '''
+    __slots__ = ('items', 'fingerprint', 'price', 'rating', 'distance', 'capacity', 'category', 'expires_at')
+    
+    def __init__(self, items: List[Any]):
+        self.items = items
+        self.fingerprint = result_fingerprint(items)
+        records = [item if isinstance(item, dict) else {} for item in items]
+        self.price = np.array([_number(item.get('price')) for item in records], dtype=np.float64)
+        self.rating = np.array([_first_number(item, RATING_FIELDS) for item in records], dtype=np.float64)
+        self.distance = _distances(records)
+        self.capacity = np.array([_first_number(item, CAPACITY_FIELDS) for item in records], dtype=np.float64)
+        self.category = np.array([str(item.get('category') or '').lower() for item in records], dtype=object)
+        self.expires_at = time.monotonic() + FEATURES_CACHE_TTL
+
+def result_fingerprint(items: List[Any]) -> Tuple[int, Any, Any]:
+    # Тот же ключ search_cache после истечения записи может прийти с другим ответом API
+    first, last = (items[0], items[-1]) if items else (None, None)
+    return (
+        len(items),
+        first.get('id') if isinstance(first, dict) else None,
+        last.get('id') if isinstance(last, dict) else None
+    )
+
+# cache_key -> признаки его ответа
+_features: Dict[str, ResultFeatures] = {}
+
+def result_features(items: List[Any], cache_key: Optional[str]) -> ResultFeatures:
+    entry = _features.get(cache_key) if cache_key else None
+    if entry and entry.expires_at > time.monotonic() and entry.fingerprint == result_fingerprint(items):
+        return entry
+    entry = ResultFeatures(items)
+    if cache_key:
+        if len(_features) >= FEATURES_CACHE_MAX_ITEMS:
+            _features.pop(next(iter(_features)), None)
+        _features[cache_key] = entry
+    return entry
+
+def _unit(values: np.ndarray) -> np.ndarray:
+    # Min-max в [0, 1] по текущей выборке; объект без значения получает 0
+    known = np.isfinite(values)
+    if not known.any():
+        return np.zeros_like(values)
+    low, high = values[known].min(), values[known].max()
+    if high == low:
+        return np.where(known, 0.5, 0.0)
+    return np.where(known, (values - low) / (high - low), 0.0)
+
+def weighted_scores(
+    features: ResultFeatures, rows: np.ndarray, weights: Dict[str, float], guests: Optional[float]
+) -> np.ndarray:
+    '''
+    Сумма весов на нормированные признаки: дешевле, выше рейтинг, ближе к центру — лучше.
+    Вместимость: 1, когда объект рассчитан ровно на guests гостей, меньше — когда он заметно больше,
+    0 — когда все не поместятся
+    '''
+    scores = np.zeros(len(rows), dtype=np.float64)
+    if weights.get('price'):
+        price = _unit(features.price[rows])
+        scores += weights['price'] * np.where(np.isfinite(features.price[rows]), 1.0 - price, 0.0)
+    if weights.get('rating'):
+        scores += weights['rating'] * _unit(features.rating[rows])
+    if weights.get('distance'):
+        distance = _unit(features.distance[rows])
+        scores += weights['distance'] * np.where(np.isfinite(features.distance[rows]), 1.0 - distance, 0.0)
+    if weights.get('capacity') and guests:
+        capacity = features.capacity[rows]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fit = np.where(capacity >= guests, guests / capacity, 0.0)
+        scores += weights['capacity'] * fit
+    return scores
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    '''
+    Позиции k лучших score по убыванию, равные — в порядке API. argpartition отбирает k кандидатов
+    за O(n); на границе отбора равные значения добираются по порядку, чтобы страницы не пересекались
+    '''
+    count = len(scores)
+    keys = -scores
+    if k < count:
+        chosen = np.argpartition(keys, k - 1)[:k]
+        boundary = keys[chosen].max()
+        ahead = chosen[keys[chosen] < boundary]
+        tied = np.flatnonzero(keys == boundary)[:k - len(ahead)]
+        chosen = np.concatenate((ahead, tied))
+    else:
+        chosen = np.arange(count)
+    return chosen[np.lexsort((chosen, keys[chosen]))]
+
+def rank_results(
+    items: List[Any], cache_key: Optional[str], weights: Optional[Dict[str, float]] = None, *,
+    max_price: Any = None, exclude_types: Optional[List[str]] = None, guests: Any = None,
+    sort: Optional[str] = None, offset: int = 0, limit: Optional[int] = None
+) -> Tuple[List[Any], int]:
+    '''
+    Страница выдачи после клиентских фильтров (max_price, exclude_types) и ранжирования:
+    явная сортировка sort, иначе веса интеграции, иначе порядок API. Возвращает объекты страницы
+    и число объектов, прошедших фильтры
+    '''
+    features = result_features(items, cache_key)
+    mask = np.ones(len(items), dtype=bool)
+    limit_price = _number(max_price)
+    if max_price and np.isfinite(limit_price):
+        # Объекты без цены не отбрасываются
+        mask &= ~(features.price > limit_price)
+    if exclude_types:
+        mask &= ~np.isin(features.category, [str(name).lower() for name in exclude_types])
+    guests_count = _number(guests)
+    rows = np.flatnonzero(mask)
+    total = len(rows)
+    end = total if limit is None else min(offset + limit, total)
+    if offset >= end:
+        return [], total
+    
+    if sort in SORTS:
+        name, descending = SORTS[sort]
+        values = getattr(features, name)[rows]
+        # Объекты без значения признака — в конце при любом направлении
+        scores = np.where(np.isfinite(values), values if descending else -values, -np.inf)
+        order = rows[top_k(scores, end)]
+    elif weights:
+        order = rows[top_k(weighted_scores(features, rows, weights, guests_count if guests_count > 0 else None), end)]
+    else:
+        order = rows[:end]
+    return [items[index] for index in order[offset:]], total
+
+def presort_results(api_data: Any, weights: Dict[str, float], guests: Any = None) -> Any:
+    '''
+    Ответ API с результатами, уже упорядоченными по весам интеграции, — для записи в search_cache,
+    когда интеграция ранжирует при кэшировании (presort)
+    '''
+    items = api_data.get('results') if isinstance(api_data, dict) else api_data
+    if not isinstance(items, list) or not items:
+        return api_data
+    ranked, _ = rank_results(items, None, weights, guests=guests)
+    return {**api_data, 'results': ranked} if isinstance(api_data, dict) else ranked
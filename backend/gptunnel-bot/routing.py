@@ -0,0 +1,189 @@
+'''
+Маршрутизация запросов между моделями GPTunnel: порядок моделей-кандидатов по политике
+ассистента (самая дешёвая в рамках SLO, самая быстрая, цепочка fallback) на основе скользящей
+статистики api_requests и каталога моделей (model_catalog.py), плюс локальный cooldown моделей, которые только
+что ответили ошибкой. Статистика обновляется в фоне: маршрут строится без обращений к БД.
+Модуль лежит копией в каталогах функций, которые его используют (это проверяет bench/cold_start.py).
+'''
+import json
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Set
+from runtime import db_cursor
+from model_catalog import get_catalog
+
+STRATEGIES = ('cheapest', 'fastest', 'fallback')
+
+STATS_WINDOW_MINUTES = 15
+STATS_TTL = 30
+FAILURE_COOLDOWN = 30
+
+# На эти ответы запрос переходит к следующей модели маршрута; остальные 4xx — ошибка клиента
+# (ключ, payload), её повтор на другой модели ничего не даст
+FAILOVER_STATUSES = frozenset((408, 429, 500, 502, 503, 504))
+
+# Меньше MIN_SAMPLES запросов за окно — статистике модели не верим, считаем её здоровой
+MIN_SAMPLES = 5
+DEFAULT_MAX_ERROR_RATE = 0.2
+
+class RoutingPolicy:
+    '''
+    Политика из assistants.routing_policy:
+    {"strategy": "cheapest" | "fastest" | "fallback", "models": [...], "maxLatencyMs": 4000,
+     "maxErrorRate": 0.2, "timeoutMs": 20000}
+    models — кандидаты в порядке предпочтения, он же порядок fallback и разрешение равенств.
+    '''
+    __slots__ = ('strategy', 'models', 'max_latency_ms', 'max_error_rate', 'timeout_ms')
+
+    def __init__(
+        self, models: List[str], strategy: str = 'fallback', max_latency_ms: Optional[float] = None,
+        max_error_rate: float = DEFAULT_MAX_ERROR_RATE, timeout_ms: Optional[float] = None
+    ):
+        self.models = models
+        self.strategy = strategy if strategy in STRATEGIES else 'fallback'
+        self.max_latency_ms = max_latency_ms
+        self.max_error_rate = max_error_rate
+        self.timeout_ms = timeout_ms
+
+    @classmethod
+    def from_config(cls, config: Any) -> Optional['RoutingPolicy']:
+        '''
+        Политика из JSONB-значения; None, если маршрутизация не настроена или конфиг некорректен
+        '''
+        if isinstance(config, str):
+            try:
+                config = json.loads(config)
+            except ValueError:
+                return None
+        if not isinstance(config, dict):
+            return None
+        models = [m for m in config.get('models') or [] if isinstance(m, str) and m]
+        if not models:
+            return None
+        try:
+            return cls(
+                models,
+                strategy=config.get('strategy', 'fallback'),
+                max_latency_ms=float(config['maxLatencyMs']) if config.get('maxLatencyMs') else None,
+                max_error_rate=float(config.get('maxErrorRate', DEFAULT_MAX_ERROR_RATE)),
+                timeout_ms=float(config['timeoutMs']) if config.get('timeoutMs') else None
+            )
+        except (TypeError, ValueError):
+            return None
+
+    def timeout(self, default: float) -> float:
+        return self.timeout_ms / 1000 if self.timeout_ms else default
+
+class ModelStats:
+    __slots__ = ('requests', 'p95_latency_ms', 'error_rate', 'cost_per_1k_tokens')
+
+    def __init__(self, row: tuple):
+        self.requests = int(row[1])
+        self.p95_latency_ms = float(row[2]) if row[2] is not None else None
+        self.error_rate = float(row[3] or 0)
+        self.cost_per_1k_tokens = float(row[4]) if row[4] is not None else None
+
+# Ответы без статуса (сетевая ошибка, таймаут) считаются ошибками
+MODEL_STATS_SQL = '''
+    SELECT model,
+           COUNT(*),
+           percentile_cont(0.95) WITHIN GROUP (ORDER BY latency_ms) FILTER (WHERE status_code < 400),
+           AVG(CASE WHEN status_code IS NULL OR status_code >= 400 THEN 1.0 ELSE 0.0 END),
+           SUM(total_cost) FILTER (WHERE status_code < 400) * 1000
+               / NULLIF(SUM(tokens_total) FILTER (WHERE status_code < 400), 0)
+    FROM api_requests
+    WHERE created_at > CURRENT_TIMESTAMP - %s * INTERVAL '1 minute' AND model IS NOT NULL
+    GROUP BY model
+'''
+
+_stats: Dict[str, ModelStats] = {}
+_stats_expires = 0.0
+_cooldown_until: Dict[str, float] = {}
+
+_refresh_lock = threading.Lock()
+_refreshing: Set[str] = set()
+
+def _refresh_in_background(name: str, target: Callable[..., None], *args: Any) -> None:
+    with _refresh_lock:
+        if name in _refreshing:
+            return
+        _refreshing.add(name)
+
+    def run() -> None:
+        try:
+            target(*args)
+        except Exception as e:
+            print(f"[ROUTING] {name} refresh failed: {str(e)}")
+        finally:
+            with _refresh_lock:
+                _refreshing.discard(name)
+
+    threading.Thread(target=run, name=f'routing-{name}', daemon=True).start()
+
+def refresh_stats(database_url: str) -> None:
+    global _stats, _stats_expires
+    _stats_expires = time.monotonic() + STATS_TTL
+    with db_cursor(database_url) as cursor:
+        cursor.execute(MODEL_STATS_SQL, (STATS_WINDOW_MINUTES,))
+        rows = cursor.fetchall()
+    _stats = {row[0]: ModelStats(row) for row in rows}
+
+def model_stats(database_url: str) -> Dict[str, ModelStats]:
+    '''
+    Статистика моделей за последние STATS_WINDOW_MINUTES минут; устаревшая обновляется в фоне
+    '''
+    if _stats_expires <= time.monotonic():
+        _refresh_in_background('stats', refresh_stats, database_url)
+    return _stats
+
+def record_failure(model: Optional[str]) -> None:
+    if model:
+        _cooldown_until[model] = time.monotonic() + FAILURE_COOLDOWN
+
+def record_success(model: Optional[str]) -> None:
+    if model:
+        _cooldown_until.pop(model, None)
+
+def plan_route(policy: RoutingPolicy, database_url: str, api_key: str) -> List[str]:
+    '''
+    Порядок попыток: сначала здоровые модели, отсортированные по стратегии, затем остальные —
+    как запасные. Модели вне каталога GPTunnel пропускаются; пока цена модели не измерена
+    по api_requests, cheapest сравнивает цены из каталога.
+    '''
+    stats = model_stats(database_url)
+    # Маршрут не ждёт каталог: в холодном контейнере он загружается в фоне
+    catalog = get_catalog(database_url, api_key, wait=False)
+    models = catalog.models if catalog is not None and catalog.models else None
+    candidates = [m for m in policy.models if models is None or m in models] or list(policy.models)
+    now = time.monotonic()
+    unknown = float('inf')
+
+    def reliable(model: str) -> Optional[ModelStats]:
+        entry = stats.get(model)
+        return entry if entry is not None and entry.requests >= MIN_SAMPLES else None
+
+    def healthy(model: str) -> bool:
+        if _cooldown_until.get(model, 0) > now:
+            return False
+        entry = reliable(model)
+        return entry is None or entry.error_rate <= policy.max_error_rate
+
+    def latency(model: str) -> float:
+        entry = reliable(model)
+        return entry.p95_latency_ms if entry and entry.p95_latency_ms is not None else unknown
+
+    def cost(model: str) -> tuple:
+        entry = reliable(model)
+        measured = entry.cost_per_1k_tokens if entry and entry.cost_per_1k_tokens is not None else unknown
+        listed = models[model].price if models and model in models else None
+        return measured, listed if listed is not None else unknown
+
+    # Сортировки устойчивые: при равенстве сохраняется порядок из политики
+    route = list(candidates)
+    if policy.strategy == 'cheapest':
+        slo = policy.max_latency_ms
+        route.sort(key=lambda m: (slo is not None and latency(m) != unknown and latency(m) > slo, cost(m)))
+    elif policy.strategy == 'fastest':
+        route.sort(key=latency)
+    route.sort(key=lambda m: not healthy(m))
+    return route
@@ -0,0 +1,371 @@
+'''
+Извлечение параметров поиска жилья (город, дата заезда, ночи, гости, бюджет) из сообщений
+пользователя правилами и словарями, без модели. Понимает абсолютные и относительные даты
+(«15 ноября», «с 15 по 18.11», «завтра», «через неделю», «в пятницу»), числительные словами
+(«три ночи», «на двоих», «неделю») и падежные формы городов из справочника.
+
+Разбор консервативен: слот с несколькими разными значениями не заполняется. Каждое правило
+вырезает из текста свой фрагмент; слова, которые не разобрало ни одно правило и которых нет
+среди служебных, говорят о том, чего разбор не понял (фильтры, уточнения, вопросы).
+Их отсутствие — условие уверенного разбора, по которому gptunnel-bot ищет без вызова модели.
+'''
+import re
+from datetime import date, timedelta
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+SEARCH_SLOTS = ('city', 'checkin', 'nights', 'guests')
+# Слоты, которые разбор умеет заполнять: обязательные параметры схемы функции должны быть среди них
+PARSED_SLOTS = SEARCH_SLOTS + ('max_price',)
+
+MAX_NIGHTS = 60
+MAX_GUESTS = 20
+
+MONTHS = {
+    'января': 1, 'февраля': 2, 'марта': 3, 'апреля': 4, 'мая': 5, 'июня': 6,
+    'июля': 7, 'августа': 8, 'сентября': 9, 'октября': 10, 'ноября': 11, 'декабря': 12
+}
+WEEKDAYS = {'понедельник': 0, 'вторник': 1, 'среду': 2, 'четверг': 3, 'пятницу': 4, 'субботу': 5, 'воскресенье': 6}
+
+NUMBERS = {
+    'один': 1, 'одна': 1, 'одну': 1, 'одного': 1, 'два': 2, 'две': 2, 'двух': 2, 'три': 3, 'трех': 3,
+    'четыре': 4, 'четырех': 4, 'пять': 5, 'пяти': 5, 'шесть': 6, 'шести': 6, 'семь': 7, 'семи': 7,
+    'восемь': 8, 'восьми': 8, 'девять': 9, 'девяти': 9, 'десять': 10, 'десяти': 10,
+    'двое': 2, 'трое': 3, 'четверо': 4, 'пятеро': 5, 'шестеро': 6
+}
+COLLECTIVE_GUESTS = {
+    'одного': 1, 'двоих': 2, 'троих': 3, 'четверых': 4, 'пятерых': 5, 'шестерых': 6,
+    'вдвоем': 2, 'втроем': 3, 'вчетвером': 4, 'впятером': 5
+}
+
+# Названия городов, как их передаёт модель; падежные формы строятся в city_forms
+CITIES = (
+    'Москва', 'Санкт-Петербург', 'Казань', 'Сочи', 'Адлер', 'Калининград', 'Екатеринбург', 'Новосибирск',
+    'Краснодар', 'Анапа', 'Геленджик', 'Туапсе', 'Ялта', 'Алушта', 'Севастополь', 'Симферополь', 'Евпатория',
+    'Феодосия', 'Судак', 'Керчь', 'Владивосток', 'Самара', 'Уфа', 'Пермь', 'Тюмень', 'Омск', 'Томск',
+    'Красноярск', 'Иркутск', 'Хабаровск', 'Воронеж', 'Волгоград', 'Саратов', 'Ярославль', 'Кострома',
+    'Тверь', 'Тула', 'Рязань', 'Владимир', 'Суздаль', 'Псков', 'Смоленск', 'Мурманск', 'Архангельск',
+    'Петрозаводск', 'Выборг', 'Кисловодск', 'Пятигорск', 'Железноводск', 'Махачкала', 'Дербент',
+    'Нальчик', 'Владикавказ', 'Грозный', 'Астрахань', 'Оренбург', 'Челябинск', 'Ижевск', 'Киров',
+    'Чебоксары', 'Ульяновск', 'Пенза', 'Липецк', 'Белгород', 'Курск', 'Брянск', 'Калуга', 'Иваново',
+    'Вологда', 'Сургут', 'Барнаул', 'Кемерово', 'Новокузнецк', 'Шерегеш', 'Байкальск', 'Домбай', 'Архыз',
+    'Кемер', 'Светлогорск', 'Зеленоградск', 'Новороссийск', 'Ейск', 'Ставрополь', 'Тамбов', 'Орск'
+)
+# Составные названия и разговорные варианты: форма -> город
+CITY_ALIASES = {
+    'питер': 'Санкт-Петербург', 'питере': 'Санкт-Петербург', 'спб': 'Санкт-Петербург', 'петербург': 'Санкт-Петербург',
+    'петербурге': 'Санкт-Петербург', 'мск': 'Москва', 'екб': 'Екатеринбург', 'нск': 'Новосибирск',
+    'нижний новгород': 'Нижний Новгород', 'нижнем новгороде': 'Нижний Новгород', 'нижний': 'Нижний Новгород',
+    'нижнем': 'Нижний Новгород', 'великий новгород': 'Великий Новгород', 'великом новгороде': 'Великий Новгород',
+    'ростов-на-дону': 'Ростов-на-Дону', 'ростове-на-дону': 'Ростов-на-Дону', 'ростов': 'Ростов-на-Дону',
+    'ростове': 'Ростов-на-Дону', 'красная поляна': 'Красная Поляна', 'красной поляне': 'Красная Поляна',
+    'красную поляну': 'Красная Поляна', 'минеральные воды': 'Минеральные Воды', 'минеральных водах': 'Минеральные Воды',
+    'ессентуки': 'Ессентуки', 'ессентуках': 'Ессентуки', 'набережные челны': 'Набережные Челны',
+    'набережных челнах': 'Набережные Челны', 'грозном': 'Грозный'
+}
+# Латиница, которую модель иногда подставляет вместо русского названия
+CITY_LATIN = {
+    'moscow': 'Москва', 'moskva': 'Москва', 'saint petersburg': 'Санкт-Петербург', 'st petersburg': 'Санкт-Петербург',
+    'sankt-peterburg': 'Санкт-Петербург', 'saint-petersburg': 'Санкт-Петербург', 'kazan': 'Казань', 'sochi': 'Сочи',
+    'adler': 'Адлер', 'kaliningrad': 'Калининград', 'yekaterinburg': 'Екатеринбург', 'ekaterinburg': 'Екатеринбург',
+    'novosibirsk': 'Новосибирск', 'krasnodar': 'Краснодар', 'anapa': 'Анапа', 'gelendzhik': 'Геленджик',
+    'yalta': 'Ялта', 'sevastopol': 'Севастополь', 'vladivostok': 'Владивосток', 'samara': 'Самара',
+    'nizhny novgorod': 'Нижний Новгород', 'kislovodsk': 'Кисловодск', 'murmansk': 'Мурманск'
+}
+CITY_MAX_WORDS = 2
+CITY_PREFIX_RE = re.compile(r'^(?:г|город) ')
+
+HARD_CONSONANTS_I = set('гкхжшчщ')
+
+# Слова запроса, которые ничего не меняют в параметрах поиска
+FILLER_WORDS = set('''
+    найди найдите найти подбери подберите подобрать покажи покажите показать поищи поищите ищу ищем
+    нужна нужно нужен нужны хочу хотим хотел хотела бы можно пожалуйста мне нам нас я мы снять сниму
+    забронировать бронь жилье жилья квартиру квартира квартиры квартир апартаменты апартаментов номер
+    номера гостиницу гостиница гостиницы отель отели отеля отелей вариант варианты вариантов размещение
+    в во на с со по для и а теперь тогда еще давай привет здравствуйте добрый день город городе
+    заезд заезда заездом дата дату гостей гостя гость ночи ночей ночь дня
+'''.split())
+
+def city_forms(name: str) -> List[str]:
+    '''
+    Именительный и косвенные падежи однословного названия по окончанию: -а, -я (-ия), -ь, согласная;
+    названия на гласные (Сочи, Туапсе, Кемерово) не склоняются
+    '''
+    word = name.lower().replace('ё', 'е')
+    stem, last = word[:-1], word[-1]
+    if last == 'а':
+        plural = 'и' if stem[-1:] in HARD_CONSONANTS_I else 'ы'
+        return [word, stem + 'е', stem + 'у', stem + plural, stem + 'ой']
+    if last == 'я':
+        locative = 'и' if stem.endswith('и') else 'е'
+        return [word, stem + locative, stem + 'ю', stem + 'и', stem + 'ей']
+    if last == 'ь':
+        return [word, stem + 'и', stem + 'ью']
+    if last in 'оиуеэы':
+        return [word]
+    return [word, word + 'е', word + 'а', word + 'у', word + 'ом']
+
+def build_gazetteer() -> Dict[str, str]:
+    gazetteer: Dict[str, str] = {}
+    for city in CITIES:
+        for form in city_forms(city):
+            gazetteer.setdefault(form, city)
+    gazetteer.update(CITY_ALIASES)
+    return gazetteer
+
+GAZETTEER = build_gazetteer()
+
+def canonical_city(name: str) -> Optional[str]:
+    '''
+    Название города из справочника для произвольного написания (падеж, регистр, латиница, «г. »),
+    None — город неизвестен
+    '''
+    key = CITY_PREFIX_RE.sub('', ' '.join(name.lower().replace('ё', 'е').replace('.', ' ').split()))
+    return GAZETTEER.get(key) or CITY_LATIN.get(key)
+
+MONTH_SRC = '|'.join(MONTHS)
+NUMBER_SRC = r'\d{1,2}|' + '|'.join(sorted(NUMBERS, key=len, reverse=True))
+DATE_SRC = rf'\d{{4}}-\d{{2}}-\d{{2}}|\d{{1,2}}\.\d{{1,2}}(?:\.(?:\d{{4}}|\d{{2}}))?|\d{{1,2}}(?:-?го)?\s+(?:{MONTH_SRC})(?:\s+\d{{4}}(?:\s*(?:года|г)\b\.?)?)?'
+
+ISO_DATE_RE = re.compile(r'(\d{4})-(\d{2})-(\d{2})')
+DOT_DATE_RE = re.compile(r'(\d{1,2})\.(\d{1,2})(?:\.(\d{4}|\d{2}))?')
+MONTH_DATE_RE = re.compile(rf'(\d{{1,2}})(?:-?го)?\s+({MONTH_SRC})(?:\s+(\d{{4}}))?')
+WORD_RE = re.compile(r'[а-яa-z]+(?:-[а-яa-z]+)*|\d+')
+
+def number(word: str) -> int:
+    return int(word) if word.isdigit() else NUMBERS[word]
+
+def resolve_date(today: date, day: int, month: int, year: Optional[int]) -> Optional[date]:
+    '''
+    Дата без года — ближайшая не в прошлом; двузначный год — 20xx
+    '''
+    if year is not None and year < 100:
+        year += 2000
+    try:
+        resolved = date(year or today.year, month, day)
+        if year is None and resolved < today:
+            resolved = date(today.year + 1, month, day)
+    except ValueError:
+        return None
+    return resolved
+
+def parse_date(text: str, today: date) -> Optional[date]:
+    match = ISO_DATE_RE.fullmatch(text)
+    if match:
+        year, month, day = match.groups()
+        return resolve_date(today, int(day), int(month), int(year))
+    match = DOT_DATE_RE.fullmatch(text)
+    if match:
+        day, month, year = match.groups()
+        return resolve_date(today, int(day), int(month), int(year) if year else None)
+    match = MONTH_DATE_RE.match(text)
+    if match:
+        day, month, year = match.groups()
+        return resolve_date(today, int(day), MONTHS[month], int(year) if year else None)
+    return None
+
+# Правило: регулярка и функция (match, today) -> слоты фрагмента; None — фрагмент не разобран
+Rule = Tuple['re.Pattern[str]', Callable[['re.Match[str]', date], Optional[Dict[str, Any]]]]
+
+def _stay(checkin: Optional[date], checkout: Optional[date]) -> Optional[Dict[str, Any]]:
+    if not checkin or not checkout or not 0 < (checkout - checkin).days <= MAX_NIGHTS:
+        return None
+    return {'checkin': checkin, 'nights': (checkout - checkin).days}
+
+def _day_range(match: 're.Match[str]', today: date) -> Optional[Dict[str, Any]]:
+    # «с 15 по 18 ноября»: месяц и год первой даты берутся у второй
+    checkout = parse_date(match.group(2), today)
+    if not checkout:
+        return None
+    try:
+        checkin = checkout.replace(day=int(match.group(1)))
+    except ValueError:
+        return None
+    return _stay(checkin, checkout)
+
+def _date_range(match: 're.Match[str]', today: date) -> Optional[Dict[str, Any]]:
+    return _stay(parse_date(match.group(1), today), parse_date(match.group(2), today))
+
+def _relative_day(match: 're.Match[str]', today: date) -> Dict[str, Any]:
+    return {'checkin': today + timedelta(days=('сегодня', 'завтра', 'послезавтра').index(match.group(1)))}
+
+def _in_days(match: 're.Match[str]', today: date) -> Dict[str, Any]:
+    count = number(match.group(1)) if match.group(1) else 1
+    return {'checkin': today + timedelta(days=count * (7 if match.group(2).startswith('недел') else 1))}
+
+def _weekday(match: 're.Match[str]', today: date) -> Dict[str, Any]:
+    # Ближайший такой день недели после сегодняшнего
+    return {'checkin': today + timedelta(days=(WEEKDAYS[match.group(1)] - today.weekday() - 1) % 7 + 1)}
+
+def _price(match: 're.Match[str]', today: date) -> Optional[Dict[str, Any]]:
+    value = int(re.sub(r'\s', '', match.group(1))) * (1000 if match.group(2) else 1)
+    return {'max_price': value} if value > 0 else None
+
+RULES: List[Rule] = [
+    (re.compile(rf'(?:\bс\s+)?(?<![\d.])({DATE_SRC})\s*(?:по|-|—|до)\s*({DATE_SRC})'), _date_range),
+    (re.compile(rf'(?:\bс\s+)?(?<![\d.])(\d{{1,2}})\s*(?:по|-|—|до)\s*({DATE_SRC})'), _day_range),
+    (re.compile(r'\b(сегодня|завтра|послезавтра)\b'), _relative_day),
+    (re.compile(rf'\bчерез\s+(?:({NUMBER_SRC})\s+)?(день|дня|дней|неделю|недели|недель)\b'), _in_days),
+    (re.compile(r'\bв\s+(?:эту\s+|ближайш(?:ую|ий|ее)\s+)?(' + '|'.join(WEEKDAYS) + r')\b'), _weekday),
+    (re.compile(
+        rf'\b(?:до|не\s+дороже|дешевле|не\s+более|максимум|бюджет)\s+(\d{{1,3}}(?:\s\d{{3}})+|\d+)(?![\d.]|\s*(?:{MONTH_SRC}))'
+        r'\s*(к\b|тыс\b\.?|тысяч\w*)?\s*(?:руб\w*\.?|р\b\.?|₽)?(?:\s+(?:за|в)\s+(?:ночь|сутки))?'
+    ), _price),
+    (re.compile(rf'(?:\bс\s+|\bна\s+)?(?<![\d.])({DATE_SRC})'), lambda m, today: {'checkin': parse_date(m.group(1), today)}),
+    (re.compile(rf'\b({NUMBER_SRC})\s+(?:ночь|ночи|ночей|сутки|суток)\b'), lambda m, today: {'nights': number(m.group(1))}),
+    (re.compile(r'\b(?:на\s+)?(?:одну\s+)?ночь\b'), lambda m, today: {'nights': 1}),
+    (re.compile(rf'\b(?:на\s+)?(?:({NUMBER_SRC})\s+недел[иь]|(?:одну\s+)?неделю)\b'), lambda m, today: {'nights': 7 * (number(m.group(1)) if m.group(1) else 1)}),
+    (re.compile(r'\bна\s+выходные\b'), lambda m, today: {'nights': 2}),
+    (re.compile(
+        rf'\b({NUMBER_SRC})\s+(?:гост(?:ь|я|ей)|человек[а]?|чел\b\.?|взросл(?:ый|ых|ого)|персон[ыа]?)'
+    ), lambda m, today: {'guests': number(m.group(1))}),
+    (re.compile(r'\b(?:(?:для|на)\s+(' + '|'.join(COLLECTIVE_GUESTS) + r'))\b|\b(вдвоем|втроем|вчетвером|впятером)\b'),
+     lambda m, today: {'guests': COLLECTIVE_GUESTS[m.group(1) or m.group(2)]}),
+    (re.compile(r'\b(двое|трое|четверо|пятеро|шестеро)\b'), lambda m, today: {'guests': NUMBERS[m.group(1)]})
+]
+
+class SlotParse:
+    '''
+    Результат разбора одной реплики: найденные слоты, слоты с противоречивыми значениями
+    и нераспознанные слова
+    '''
+    __slots__ = ('slots', 'conflicts', 'unknown')
+
+    def __init__(self) -> None:
+        self.slots: Dict[str, Any] = {}
+        self.conflicts: Set[str] = set()
+        self.unknown: List[str] = []
+
+    def add(self, name: str, value: Any) -> None:
+        if name in self.slots and self.slots[name] != value:
+            self.conflicts.add(name)
+        self.slots[name] = value
+
+    def valid(self) -> Dict[str, Any]:
+        return {name: value for name, value in self.slots.items() if name not in self.conflicts}
+
+def _cut(text: str, start: int, end: int) -> str:
+    return text[:start] + ' ' * (end - start) + text[end:]
+
+def parse_slots(text: str, today: date) -> SlotParse:
+    parse = SlotParse()
+    text = text.lower().replace('ё', 'е')
+    for pattern, handle in RULES:
+        for match in list(pattern.finditer(text)):
+            found = handle(match, today)
+            if not found or None in found.values():
+                continue
+            for name, value in found.items():
+                parse.add(name, value)
+            text = _cut(text, match.start(), match.end())
+    words = [(m.group(0), m.start(), m.end()) for m in WORD_RE.finditer(text)]
+    for size in range(CITY_MAX_WORDS, 0, -1):
+        for i in range(len(words) - size + 1):
+            city = GAZETTEER.get(' '.join(word for word, _, _ in words[i:i + size]))
+            if city and all(word for word, _, _ in words[i:i + size]):
+                parse.add('city', city)
+                for j in range(i, i + size):
+                    words[j] = ('', words[j][1], words[j][2])
+    parse.unknown = [word for word, _, _ in words if word and word not in FILLER_WORDS]
+    checkin = parse.slots.get('checkin')
+    if checkin is not None and checkin < today:
+        parse.conflicts.add('checkin')
+    if not 0 < parse.slots.get('nights', 1) <= MAX_NIGHTS:
+        parse.conflicts.add('nights')
+    if not 0 < parse.slots.get('guests', 1) <= MAX_GUESTS:
+        parse.conflicts.add('guests')
+    return parse
+
+def _user_texts(history: Optional[Iterable[Any]]) -> List[str]:
+    return [
+        m['content'] for m in history or ()
+        if isinstance(m, dict) and m.get('role', 'user') == 'user' and isinstance(m.get('content'), str)
+    ]
+
+def _as_args(slots: Dict[str, Any], names: Iterable[str]) -> Dict[str, Any]:
+    args = {name: slots[name] for name in names if name in slots}
+    if 'checkin' in args:
+        args['checkin'] = args['checkin'].isoformat()
+    return args
+
+def extract_search_slots(
+    message: str, history: Optional[List[Dict[str, Any]]] = None, today: Optional[date] = None
+) -> Optional[Dict[str, Any]]:
+    '''
+    Догадка об аргументах поиска {city, checkin, nights, guests} по сообщению и предыдущим репликам
+    пользователя (более поздняя важнее), если все слоты однозначно найдены, иначе None.
+    Нераспознанные слова не мешают: догадку всё равно проверит tool_call модели.
+    '''
+    today = today or date.today()
+    slots: Dict[str, Any] = {}
+    for text in _user_texts(history) + [message]:
+        slots.update(parse_slots(text, today).valid())
+    if not all(name in slots for name in SEARCH_SLOTS):
+        return None
+    return _as_args(slots, SEARCH_SLOTS)
+
+def confident_search_slots(
+    message: str, history: Optional[List[Dict[str, Any]]], parameters: Any, today: Optional[date] = None
+) -> Optional[Dict[str, Any]]:
+    '''
+    Аргументы поиска, которые можно отправить в API без модели, или None. Уверенный разбор:
+    схема функции не требует слотов, которых разбор не знает; в сообщении нет нераспознанных слов
+    и противоречий, и оно само задаёт хотя бы один слот; все обязательные слоты заполнены.
+    Как в промпте ассистента: недостающее берётся из прошлых реплик, но новый город начинает поиск заново.
+    '''
+    if not isinstance(parameters, dict):
+        return None
+    today = today or date.today()
+    properties = parameters.get('properties') or {}
+    required = set(parameters.get('required') or SEARCH_SLOTS)
+    if not required <= set(PARSED_SLOTS):
+        return None
+    current = parse_slots(message, today)
+    if current.unknown or current.conflicts or not current.slots:
+        return None
+    if 'max_price' in current.slots and 'max_price' not in properties:
+        return None
+    slots: Dict[str, Any] = {}
+    if 'city' not in current.slots:
+        for text in _user_texts(history):
+            previous = parse_slots(text, today)
+            if 'city' in previous.slots:
+                slots = {}
+            slots.update(previous.valid())
+    slots.update(current.slots)
+    if not all(name in slots for name in required | set(SEARCH_SLOTS)):
+        return None
+    return _as_args(slots, [name for name in PARSED_SLOTS if name in properties or name in SEARCH_SLOTS])
+
+# Продолжение прошлого поиска: следующая страница или пересортировка уже найденного
+FOLLOW_UP_RULES: List[Tuple['re.Pattern[str]', str]] = [
+    (re.compile(r'\b(?:еще|дальше|следующ\w*|больше|другие|остальные)\b'), 'more'),
+    (re.compile(r'\b(?:подешевле|дешевле|(?:самые\s+|самый\s+|самое\s+)?дешев\w*|недорог\w*|бюджетн\w*|по\s+цене)\b'), 'price_asc'),
+    (re.compile(r'\b(?:подороже|дороже|(?:самые\s+|самый\s+|самое\s+)?дорог\w*)\b'), 'price_desc'),
+    (re.compile(r'\b(?:(?:с\s+)?(?:лучш\w*|высок\w*)\s+(?:рейтинг\w*|оценк\w*|отзыв\w*)|по\s+рейтингу|по\s+отзывам)\b'), 'rating'),
+    (re.compile(r'\b(?:по)?ближе\s+к\s+центру\b|\bпо\s+расстоянию\b'), 'distance')
+]
+FOLLOW_UP_WORDS = set('''
+    из этих них есть что нибудь то сначала самые самый самое покажи покажите варианты вариантов вариант
+    посмотреть посмотрим отсортируй отсортировать сортировка страница страницу
+'''.split())
+
+def follow_up_intent(message: str) -> Optional[str]:
+    '''
+    'more' — следующая страница результатов прошлого поиска, иначе имя сортировки (price_asc, price_desc,
+    rating, distance); None, если сообщение говорит что-то ещё. Числа в сообщении означают новые
+    параметры поиска («дешевле 5000»), поэтому продолжением не считаются.
+    '''
+    text = message.lower().replace('ё', 'е')
+    if re.search(r'\d', text):
+        return None
+    intents = set()
+    for pattern, intent in FOLLOW_UP_RULES:
+        for match in list(pattern.finditer(text)):
+            intents.add(intent)
+            text = _cut(text, match.start(), match.end())
+    if len(intents) != 1:
+        return None
+    if any(word not in FILLER_WORDS and word not in FOLLOW_UP_WORDS for word in WORD_RE.findall(text)):
+        return None
+    return intents.pop()
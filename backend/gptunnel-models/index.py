@@ -1,74 +1,25 @@
-import json
 import os
+import urllib.error
 from typing import Dict, Any
-import requests
+from runtime import http_handler, raw_response, error_response
+from model_catalog import get_catalog
 
+@http_handler('GET', allow_headers='Content-Type, If-None-Match')
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
-    Business: Получение списка доступных моделей из GPTunnel API
+    Business: Получение списка доступных моделей из GPTunnel API через каталог контейнера
     Args: event с httpMethod
     Returns: HTTP response со списком моделей
     '''
-    method: str = event.get('httpMethod', 'GET')
-    
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
-    
-    if method != 'GET':
-        return {
-            'statusCode': 405,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Method not allowed'}),
-            'isBase64Encoded': False
-        }
-    
     gptunnel_api_key = os.environ.get('GPTUNNEL_API_KEY')
     if not gptunnel_api_key:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'GPTunnel API не настроен'}),
-            'isBase64Encoded': False
-        }
+        return error_response(500, 'GPTunnel API не настроен')
     
     try:
-        response = requests.get(
-            'https://gptunnel.ru/v1/models',
-            headers={
-                'Authorization': f'Bearer {gptunnel_api_key}',
-                'Content-Type': 'application/json'
-            },
-            timeout=10
-        )
-        
-        return {
-            'statusCode': response.status_code,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': response.text,
-            'isBase64Encoded': False
-        }
-        
-    except requests.RequestException as e:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': f'Ошибка GPTunnel API: {str(e)}'}),
-            'isBase64Encoded': False
-        }
+        return get_catalog(os.environ.get('DATABASE_URL'), gptunnel_api_key).response(event)
+    except urllib.error.HTTPError as e:
+        return raw_response(e.code, e.read().decode('utf-8', 'replace'))
+    except urllib.error.URLError as e:
+        return error_response(500, f'Ошибка GPTunnel API: {str(e.reason)}')
     except Exception as e:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': str(e)}),
-            'isBase64Encoded': False
-        }
+        return error_response(500, str(e))
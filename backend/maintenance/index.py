@@ -0,0 +1,161 @@
+import json
+import os
+import time
+from typing import Dict, Any, Callable, Tuple
+from runtime import http_handler, json_response, error_response, db_cursor, timer_payload
+
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_SESSION_TTL_DAYS = 30
+DEFAULT_TIME_BUDGET_SECONDS = 20
+MAINTAINED_TABLES = ('search_cache', 'moderation_verdicts', 'chat_sessions')
+
+# Функция вызывается без авторизации: из тела HTTP-запроса срок хранения сессий можно только
+# увеличить, бюджет — только уменьшить, а VACUUM запускается лишь из payload таймер-триггера
+HTTP_MIN_SESSION_TTL_DAYS = DEFAULT_SESSION_TTL_DAYS
+HTTP_MAX_TIME_BUDGET_SECONDS = DEFAULT_TIME_BUDGET_SECONDS
+
+# Каждая пачка — отдельная транзакция (соединение из пула в autocommit): блокировки короткие,
+# а SKIP LOCKED не даёт ждать строки, которые прямо сейчас обновляет gptunnel-bot
+DELETE_EXPIRED_CACHE_SQL = '''
+    DELETE FROM search_cache
+    WHERE id IN (
+        SELECT id FROM search_cache
+        WHERE expires_at < CURRENT_TIMESTAMP
+        ORDER BY expires_at
+        LIMIT %(batch_size)s
+        FOR UPDATE SKIP LOCKED
+    )
+'''
+
+DELETE_EXPIRED_VERDICTS_SQL = '''
+    DELETE FROM moderation_verdicts
+    WHERE text_hash IN (
+        SELECT text_hash FROM moderation_verdicts
+        WHERE expires_at < CURRENT_TIMESTAMP
+        ORDER BY expires_at
+        LIMIT %(batch_size)s
+        FOR UPDATE SKIP LOCKED
+    )
+'''
+
+ARCHIVE_STALE_SESSIONS_SQL = '''
+    WITH stale AS (
+        DELETE FROM chat_sessions
+        WHERE id IN (
+            SELECT id FROM chat_sessions
+            WHERE updated_at < CURRENT_TIMESTAMP - %(ttl_days)s * INTERVAL '1 day'
+            ORDER BY updated_at
+            LIMIT %(batch_size)s
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id, assistant_id, user_id, chat_id, message_count, created_at, updated_at
+    ), archived AS (
+        INSERT INTO chat_sessions_archive (id, assistant_id, user_id, chat_id, message_count, created_at, updated_at)
+        SELECT id, assistant_id, user_id, chat_id, message_count, created_at, updated_at FROM stale
+        ON CONFLICT (id) DO NOTHING
+    )
+    -- rowcount INSERT ... ON CONFLICT DO NOTHING не считает уже архивированные id; пачку меряем удалёнными
+    SELECT COUNT(*) FROM stale
+'''
+
+def read_options(event: Dict[str, Any]) -> Tuple[Dict[str, Any], bool]:
+    '''
+    Параметры из payload таймер-триггера или из тела запроса и признак того, что событие от триггера
+    '''
+    payload = timer_payload(event)
+    if payload is not None:
+        return payload, True
+    body = json.loads(event.get('body') or '{}')
+    return (body if isinstance(body, dict) else {}), False
+
+def run_batches(database_url: str, sql: str, params: Dict[str, Any], deadline: float) -> Tuple[int, int]:
+    '''
+    Повторяет пачку, пока она не окажется неполной или не выйдет бюджет времени
+    '''
+    total = 0
+    batches = 0
+    while time.monotonic() < deadline:
+        with db_cursor(database_url) as cursor:
+            cursor.execute(sql, params)
+            # Запрос с итоговым SELECT сам сообщает размер пачки
+            affected = cursor.fetchone()[0] if cursor.description else cursor.rowcount
+        total += affected
+        batches += 1
+        if affected < params['batch_size']:
+            break
+    return total, batches
+
+def vacuum_tables(database_url: str) -> Dict[str, Any]:
+    '''
+    VACUUM ANALYZE после крупной чистки: освобождает место в индексах сразу, не дожидаясь autovacuum
+    '''
+    result: Dict[str, Any] = {}
+    for table in MAINTAINED_TABLES:
+        started = time.monotonic()
+        try:
+            with db_cursor(database_url) as cursor:
+                cursor.execute(f'VACUUM (ANALYZE) {table}')
+            result[table] = {'elapsedMs': int((time.monotonic() - started) * 1000)}
+        except Exception as e:
+            result[table] = {'error': str(e)}
+    return result
+
+def timed(step: Callable[[], Tuple[int, int]]) -> Tuple[int, int, int]:
+    started = time.monotonic()
+    rows, batches = step()
+    return rows, batches, int((time.monotonic() - started) * 1000)
+
+@http_handler('POST')    
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''
+    Business: Плановое обслуживание БД — удаление истёкшего кэша поиска и модерации, архивация старых сессий
+    Args: event от таймер-триггера или POST с body {batchSize, sessionTtlDays, timeBudgetSeconds, vacuum}
+          (из HTTP sessionTtlDays не меньше 30, timeBudgetSeconds не больше 20, vacuum только от таймера);
+          context с request_id
+    Returns: HTTP response с числом обработанных строк и временем работы
+    '''
+    database_url = os.environ.get('DATABASE_URL')
+    if not database_url:
+        return error_response(500, 'Database not configured')
+    
+    try:
+        options, from_timer = read_options(event)
+        batch_size = max(1, min(int(options.get('batchSize', DEFAULT_BATCH_SIZE)), 10000))
+        ttl_days = max(1, int(options.get('sessionTtlDays', DEFAULT_SESSION_TTL_DAYS)))
+        time_budget = max(1, int(options.get('timeBudgetSeconds', DEFAULT_TIME_BUDGET_SECONDS)))
+    except (ValueError, TypeError) as e:
+        return error_response(400, f'Invalid maintenance options: {str(e)}')
+    
+    if not from_timer:
+        ttl_days = max(ttl_days, HTTP_MIN_SESSION_TTL_DAYS)
+        time_budget = min(time_budget, HTTP_MAX_TIME_BUDGET_SECONDS)
+    
+    started = time.monotonic()
+    deadline = started + time_budget
+    
+    try:
+        cache_rows, cache_batches, cache_ms = timed(
+            lambda: run_batches(database_url, DELETE_EXPIRED_CACHE_SQL, {'batch_size': batch_size}, deadline)
+        )
+        verdict_rows, verdict_batches, verdict_ms = timed(
+            lambda: run_batches(database_url, DELETE_EXPIRED_VERDICTS_SQL, {'batch_size': batch_size}, deadline)
+        )
+        session_rows, session_batches, session_ms = timed(
+            lambda: run_batches(database_url, ARCHIVE_STALE_SESSIONS_SQL, {'batch_size': batch_size, 'ttl_days': ttl_days}, deadline)
+        )
+    except Exception as e:
+        return error_response(500, str(e))
+    
+    vacuum = vacuum_tables(database_url) if from_timer and options.get('vacuum') else None
+    
+    elapsed_ms = int((time.monotonic() - started) * 1000)
+    print(f"[MAINTENANCE] search_cache deleted={cache_rows}, moderation_verdicts deleted={verdict_rows}, chat_sessions archived={session_rows}, elapsed={elapsed_ms}ms")
+    
+    return json_response(200, {
+        'searchCache': {'deleted': cache_rows, 'batches': cache_batches, 'elapsedMs': cache_ms},
+        'moderationVerdicts': {'deleted': verdict_rows, 'batches': verdict_batches, 'elapsedMs': verdict_ms},
+        'chatSessions': {'archived': session_rows, 'batches': session_batches, 'elapsedMs': session_ms, 'ttlDays': ttl_days},
+        'vacuum': vacuum,
+        'elapsedMs': elapsed_ms,
+        'timeBudgetExceeded': time.monotonic() >= deadline
+    })
@@ -1,8 +1,122 @@
 import json
 import os
+import time
 import requests
-from typing import Dict, Any
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional, Tuple
+from runtime import (
+    http_handler, http_session, raw_response, json_response, error_response, gptunnel_url, warmup_step
+)
 
+LISTING_CACHE_TTL = int(os.environ.get('RAG_LISTING_CACHE_TTL', '30'))
+LISTING_CACHE_MAX_ITEMS = 256
+
+# Успешные ответы GPTunnel на листинги: databaseId ('' — список баз) -> (body, expires_at).
+# Живёт между тёплыми вызовами; POST/DELETE этого обработчика сбрасывают затронутую базу,
+# изменения из других контейнеров видны не позже чем через LISTING_CACHE_TTL
+_listing_cache: Dict[str, Tuple[str, float]] = {}
+
+# Списки файлов всех баз для агрегированного листинга запрашиваются параллельно через общую сессию
+_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='rag-io')
+
+def warm_up(report: Dict[str, Any]) -> None:
+    '''
+    Прогрев по таймеру продолжает отложенные и брошенные задания загрузки документов
+    '''
+    database_url = os.environ.get('DATABASE_URL')
+    gptunnel_api_key = os.environ.get('GPTUNNEL_API_KEY')
+    if database_url and gptunnel_api_key:
+        from rag_ingest import resume_stalled
+        warmup_step(report, 'ingest', resume_stalled, database_url, gptunnel_api_key)
+
+def added_file_id(response_text: str) -> Optional[str]:
+    '''
+    id файла из ответа GPTunnel /v1/database/file/add (поле id на верхнем уровне или в file/data)
+    '''
+    try:
+        data = json.loads(response_text)
+    except ValueError:
+        return None
+    for entry in (data, data.get('file'), data.get('data')) if isinstance(data, dict) else ():
+        if isinstance(entry, dict) and entry.get('id'):
+            return str(entry['id'])
+    return None
+
+def fetch_listing(gptunnel_api_key: str, database_id: str = '') -> Tuple[int, str, str]:
+    '''
+    Список баз (database_id пустой) или файлов базы: (статус, тело, HIT|MISS)
+    '''
+    entry = _listing_cache.get(database_id)
+    if entry and entry[1] > time.monotonic():
+        return 200, entry[0], 'HIT'
+    if database_id:
+        response = http_session().get(
+            gptunnel_url('/v1/database/file/list'),
+            params={'databaseId': database_id},
+            headers={'Authorization': gptunnel_api_key},
+            timeout=30
+        )
+    else:
+        response = http_session().get(
+            gptunnel_url('/v1/database/list'),
+            headers={'Authorization': gptunnel_api_key},
+            timeout=30
+        )
+    if response.status_code == 200:
+        _listing_cache.pop(database_id, None)
+        if len(_listing_cache) >= LISTING_CACHE_MAX_ITEMS:
+            _listing_cache.pop(next(iter(_listing_cache)))
+        _listing_cache[database_id] = (response.text, time.monotonic() + LISTING_CACHE_TTL)
+    return response.status_code, response.text, 'MISS'
+
+def invalidate_listing(database_id: str) -> None:
+    # Список баз тоже сбрасывается: в нём могут быть счётчики файлов
+    _listing_cache.pop(database_id, None)
+    _listing_cache.pop('', None)
+
+def listing_items(body: str) -> Optional[List[Any]]:
+    '''
+    Элементы листинга GPTunnel: массив на верхнем уровне или в data/databases/files
+    '''
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return None
+    if isinstance(data, dict):
+        data = next((data[key] for key in ('data', 'databases', 'files') if isinstance(data.get(key), list)), None)
+    return data if isinstance(data, list) else None
+
+def database_files(gptunnel_api_key: str, database_id: str) -> Tuple[Optional[List[Any]], str]:
+    # Ошибка по одной базе не ломает листинг остальных: её files остаётся null
+    try:
+        status, body, cache_status = fetch_listing(gptunnel_api_key, database_id)
+    except requests.RequestException as e:
+        print(f"[DEBUG] GET /v1/database/file/list?databaseId={database_id} failed: {str(e)}")
+        return None, 'MISS'
+    return (listing_items(body) if status == 200 else None), cache_status
+
+def aggregated_listing(gptunnel_api_key: str) -> Dict[str, Any]:
+    '''
+    Все базы с файлами и filesCount за один вызов: списки файлов запрашиваются параллельно
+    '''
+    status, body, cache_status = fetch_listing(gptunnel_api_key)
+    databases = listing_items(body) if status == 200 else None
+    if databases is None:
+        return raw_response(status, body)
+    ids = [str(database['id']) for database in databases if isinstance(database, dict) and database.get('id')]
+    listings = dict(zip(ids, _executor.map(lambda database_id: database_files(gptunnel_api_key, database_id), ids)))
+    result = []
+    for database in databases:
+        if isinstance(database, dict) and database.get('id'):
+            files, files_cache_status = listings[str(database['id'])]
+            if files_cache_status == 'MISS':
+                cache_status = 'MISS'
+            database = {**database, 'files': files, 'filesCount': len(files) if files is not None else database.get('filesCount')}
+        result.append(database)
+    print(f"[DEBUG] Aggregated listing: {len(ids)} databases, cache {cache_status}")
+    return json_response(200, result, headers={'X-Cache': cache_status})
+
+@http_handler('GET, POST, DELETE', warmup=warm_up)
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Проксирование запросов к GPTunnel RAG API
@@ -12,27 +126,9 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     method: str = event.get('httpMethod', 'GET')
     
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
-    
     gptunnel_api_key = os.environ.get('GPTUNNEL_API_KEY')
     if not gptunnel_api_key:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'GPTUNNEL_API_KEY не настроен. Добавьте секрет во вкладке Настройки'}),
-            'isBase64Encoded': False
-        }
+        return error_response(500, 'GPTUNNEL_API_KEY не настроен. Добавьте секрет во вкладке Настройки')
     
     headers = {
         'Authorization': gptunnel_api_key,
@@ -40,44 +136,38 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     }
     
     try:
+        database_url = os.environ.get('DATABASE_URL')
+        
         if method == 'GET':
             query_params = event.get('queryStringParameters', {}) or {}
             database_id = query_params.get('databaseId')
+            job_id = query_params.get('jobId')
             
-            if database_id:
+            if job_id:
+                if not database_url or not job_id.isdigit():
+                    return error_response(404, 'Задание не найдено')
+                from rag_ingest import job_status
+                job = job_status(database_url, int(job_id))
+                if not job:
+                    return error_response(404, 'Задание не найдено')
+                return json_response(200, job)
+            elif query_params.get('include') == 'files':
+                return aggregated_listing(gptunnel_api_key)
+            elif database_id:
                 print(f"[DEBUG] Getting files for database: {database_id}")
-                response = requests.get(
-                    'https://gptunnel.ru/v1/database/file/list',
-                    params={'databaseId': database_id},
-                    headers={'Authorization': gptunnel_api_key},
-                    timeout=30
-                )
+                status, body, cache_status = fetch_listing(gptunnel_api_key, database_id)
                 
-                print(f"[DEBUG] GET /v1/database/file/list?databaseId={database_id} - Status: {response.status_code}")
-                print(f"[DEBUG] Response body: {response.text[:500]}")
+                print(f"[DEBUG] GET /v1/database/file/list?databaseId={database_id} - Status: {status}, cache {cache_status}")
+                print(f"[DEBUG] Response body: {body[:500]}")
                 
-                return {
-                    'statusCode': response.status_code,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': response.text,
-                    'isBase64Encoded': False
-                }
+                return raw_response(status, body)
             else:
-                response = requests.get(
-                    'https://gptunnel.ru/v1/database/list',
-                    headers={'Authorization': gptunnel_api_key},
-                    timeout=30
-                )
+                status, body, cache_status = fetch_listing(gptunnel_api_key)
                 
-                print(f"[DEBUG] GET /v1/database/list - Status: {response.status_code}")
-                print(f"[DEBUG] Response body: {response.text}")
+                print(f"[DEBUG] GET /v1/database/list - Status: {status}, cache {cache_status}")
+                print(f"[DEBUG] Response body: {body}")
                 
-                return {
-                    'statusCode': response.status_code,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': response.text,
-                    'isBase64Encoded': False
-                }
+                return raw_response(status, body)
         
         elif method == 'POST':
             body_str = event.get('body', '{}')
@@ -85,18 +175,24 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             
             print(f"[DEBUG] Received from frontend: {json.dumps(body_data, ensure_ascii=False)[:300]}")
             
+            # Продолжение отложенной загрузки: фронтенд опрашивает задание, пока оно не done
+            if body_data.get('jobId'):
+                if not database_url:
+                    return error_response(404, 'Задание не найдено')
+                from rag_ingest import run_job
+                job = run_job(database_url, gptunnel_api_key, int(body_data['jobId']))
+                if not job:
+                    return error_response(404, 'Задание не найдено')
+                return json_response(200, job)
+            
             database_id = body_data.get('databaseId')
             source_type = body_data.get('sourceType', 'text')
             content = body_data.get('content', '')
+            file_url = body_data.get('fileUrl')
             name = body_data.get('name', 'Без названия')
             
             if not database_id:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Требуется databaseId. Сначала создайте базу данных в GPTunnel'}),
-                    'isBase64Encoded': False
-                }
+                return error_response(400, 'Требуется databaseId. Сначала создайте базу данных в GPTunnel')
             
             # Конвертация типов источников из нашего формата в формат GPTunnel
             source_type_mapping = {
@@ -111,6 +207,9 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             }
             
             gptunnel_source_type = source_type_mapping.get(source_type, 'text')
+            # Документ по ссылке GPTunnel скачивает сам, как источник url; base64 при этом не пересылается
+            if file_url and gptunnel_source_type == 'file':
+                gptunnel_source_type = 'url'
             
             # Формируем payload для GPTunnel
             add_file_payload = {
@@ -121,7 +220,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             
             # Добавляем content в зависимости от типа
             if gptunnel_source_type == 'url':
-                add_file_payload['url'] = content
+                add_file_payload['url'] = file_url or content
             elif gptunnel_source_type == 'text':
                 add_file_payload['text'] = content
             elif gptunnel_source_type == 'file':
@@ -130,8 +229,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             
             print(f"[DEBUG] Sending to GPTunnel: {json.dumps(add_file_payload, ensure_ascii=False)[:300]}")
             
-            response = requests.post(
-                'https://gptunnel.ru/v1/database/file/add',
+            response = http_session().post(
+                gptunnel_url('/v1/database/file/add'),
                 headers=headers,
                 json=add_file_payload,
                 timeout=60
@@ -140,12 +239,34 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             print(f"[DEBUG] GPTunnel response status: {response.status_code}")
             print(f"[DEBUG] GPTunnel response body: {response.text[:500]}")
             
-            return {
-                'statusCode': response.status_code,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': response.text,
-                'isBase64Encoded': False
-            }
+            if response.status_code < 400:
+                invalidate_listing(database_id)
+            
+            # Документ потоково разбирается в локальный индекс rag_chunks, из которого gptunnel-bot
+            # достаёт контекст сам. Что не успело за вызов, продолжается по jobId или таймером.
+            # Ошибка загрузки не ломает добавление файла в GPTunnel
+            # Без id файла GPTunnel чанки нельзя ни удалить вместе с файлом, ни отличить от чанков других
+            # файлов при дедупликации, поэтому такой файл в локальный индекс не загружается
+            added_id = added_file_id(response.text) if database_url and response.status_code < 400 else None
+            if database_url and response.status_code < 400 and (content or file_url) and not added_id:
+                print("[DEBUG] Local RAG ingest skipped: no file id in GPTunnel response")
+            if added_id and (content or file_url):
+                try:
+                    from rag_ingest import create_job, decode_content, run_job
+                    source_url = file_url or (content if source_type == 'api' else None)
+                    # Источник из тела запроса сохраняется в задании: продолжить его может любой контейнер
+                    source = None if source_url else decode_content(source_type, content)
+                    job_id = create_job(database_url, database_id, added_id, name, source_type, source_url, source)
+                    job = run_job(database_url, gptunnel_api_key, job_id)
+                    print(f"[DEBUG] Local RAG ingest job {job_id}: {job['status'] if job else None}")
+                    result = json.loads(response.text)
+                    if isinstance(result, dict):
+                        result['ingestJob'] = job
+                        return json_response(response.status_code, result)
+                except Exception as e:
+                    print(f"[DEBUG] Local RAG ingest failed: {str(e)}")
+            
+            return raw_response(response.status_code, response.text)
         
         elif method == 'DELETE':
             body_str = event.get('body', '{}')
@@ -155,17 +276,12 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             database_id = body_data.get('databaseId')
             
             if not file_id or not database_id:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Требуется fileId и databaseId'}),
-                    'isBase64Encoded': False
-                }
+                return error_response(400, 'Требуется fileId и databaseId')
             
             print(f"[DEBUG] Deleting file {file_id} from database {database_id}")
             
-            response = requests.post(
-                'https://gptunnel.ru/v1/database/file/delete',
+            response = http_session().post(
+                gptunnel_url('/v1/database/file/delete'),
                 headers=headers,
                 json={
                     'databaseId': database_id,
@@ -177,25 +293,19 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             print(f"[DEBUG] DELETE response status: {response.status_code}")
             print(f"[DEBUG] DELETE response body: {response.text[:500]}")
             
-            return {
-                'statusCode': response.status_code,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': response.text,
-                'isBase64Encoded': False
-            }
-        
-        else:
-            return {
-                'statusCode': 405,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Method not allowed'}),
-                'isBase64Encoded': False
-            }
+            if response.status_code < 400:
+                invalidate_listing(database_id)
+            
+            if database_url and response.status_code < 400:
+                try:
+                    from rag_dedup import delete_file_chunks
+                    from rag_ingest import cancel_jobs
+                    cancel_jobs(database_url, database_id, file_id)
+                    print(f"[DEBUG] Local RAG index: {delete_file_chunks(database_url, database_id, file_id)} chunks removed")
+                except Exception as e:
+                    print(f"[DEBUG] Local RAG cleanup failed: {str(e)}")
+            
+            return raw_response(response.status_code, response.text)
     
     except requests.RequestException as e:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': f'Ошибка запроса к GPTunnel: {str(e)}'}),
-            'isBase64Encoded': False
-        }
\ No newline at end of file
+        return error_response(500, f'Ошибка запроса к GPTunnel: {str(e)}')
\ No newline at end of file
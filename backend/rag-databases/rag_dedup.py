@@ -0,0 +1,142 @@
+'''
+Поиск почти-дубликатов чанков при загрузке в RAG-базы: MinHash по словесным шинглам и LSH
+по полосам сигнатуры. Сигнатура и хэши полос хранятся в rag_chunks (GIN-индекс по lsh_bands),
+так что индекс сигнатур базы переживает контейнеры и пополняется каждой загрузкой. Хэши полос
+солятся databaseId: совпадение полос возможно только внутри одной базы.
+'''
+import hashlib
+import re
+import zlib
+from typing import Dict, List, Optional, Sequence, Tuple
+import numpy as np
+from runtime import db_cursor
+
+MINHASH_PERMUTATIONS = 64
+LSH_BANDS = 16
+LSH_ROWS = MINHASH_PERMUTATIONS // LSH_BANDS
+SHINGLE_WORDS = 5
+# Доля совпавших значений сигнатуры (оценка Jaccard по шинглам), с которой чанк считается дубликатом
+DEDUP_THRESHOLD = 0.85
+
+WORD_RE = re.compile(r'\w+')
+# Простое число больше 2^32: (a * h + b) mod P для 32-битных h, a, b не переполняет uint64
+MINHASH_PRIME = np.uint64(4294967311)
+
+def _permutation_coefficients(name: str) -> np.ndarray:
+    # Коэффициенты выводятся из фиксированных строк, а не из ГСЧ: сигнатуры в БД должны совпадать
+    # у всех контейнеров и версий numpy
+    return np.array([
+        int.from_bytes(hashlib.blake2b(f'minhash-{name}-{i}'.encode(), digest_size=4).digest(), 'little') | 1
+        for i in range(MINHASH_PERMUTATIONS)
+    ], dtype=np.uint64)
+
+MINHASH_A = _permutation_coefficients('a')
+MINHASH_B = _permutation_coefficients('b')
+
+def shingles(text: str) -> List[int]:
+    '''
+    crc32 словесных n-грамм нормализованного текста; короткий текст — одна n-грамма
+    '''
+    words = WORD_RE.findall(text.lower())
+    if len(words) <= SHINGLE_WORDS:
+        return [zlib.crc32(' '.join(words).encode('utf-8'))]
+    return list({zlib.crc32(' '.join(words[i:i + SHINGLE_WORDS]).encode('utf-8')) for i in range(len(words) - SHINGLE_WORDS + 1)})
+
+def minhash(text: str) -> np.ndarray:
+    hashes = np.asarray(shingles(text), dtype=np.uint64)[:, None]
+    return ((MINHASH_A * hashes + MINHASH_B) % MINHASH_PRIME).min(axis=0).astype(np.uint32)
+
+def band_hashes(signature: np.ndarray, database_id: str) -> List[int]:
+    '''
+    Хэш каждой полосы из LSH_ROWS значений как знаковый int64 (элементы rag_chunks.lsh_bands)
+    '''
+    salt = hashlib.blake2b(database_id.encode('utf-8'), digest_size=16).digest()
+    rows = np.ascontiguousarray(signature, dtype='<u4').reshape(LSH_BANDS, LSH_ROWS)
+    return [
+        int.from_bytes(hashlib.blake2b(bytes([band]) + rows[band].tobytes(), digest_size=8, key=salt).digest(), 'little', signed=True)
+        for band in range(LSH_BANDS)
+    ]
+
+def similarity(a: np.ndarray, b: np.ndarray) -> float:
+    return float(np.count_nonzero(a == b)) / MINHASH_PERMUTATIONS
+
+class Signature:
+    __slots__ = ('minhash', 'bands')
+
+    def __init__(self, text: str, database_id: str):
+        self.minhash = minhash(text)
+        self.bands = band_hashes(self.minhash, database_id)
+
+    def to_bytes(self) -> bytes:
+        return self.minhash.astype('<u4').tobytes()
+
+    def bands_literal(self) -> str:
+        # Массивы разной длины не передаются через unnest, поэтому полосы идут текстом '{...}'::bigint[]
+        return '{' + ','.join(str(band) for band in self.bands) + '}'
+
+CANDIDATES_SQL = '''
+    SELECT id, file_id, minhash FROM rag_chunks
+    WHERE lsh_bands && %s::bigint[] AND database_id = %s AND minhash IS NOT NULL
+'''
+
+def find_duplicates(
+    database_url: str, database_id: str, file_id: Optional[str], texts: Sequence[str]
+) -> Tuple[List[Signature], Dict[int, Optional[int]]]:
+    '''
+    Сигнатуры чанков пачки и их дубликаты: индекс чанка -> id оригинала из другого файла базы
+    (на него записывается ссылка) или None, если оригинал в том же файле или ранее в этой пачке.
+    Один запрос к БД на пачку: кандидаты — чанки базы с общей полосой LSH, дубликат — кандидат
+    с оценкой сходства не ниже DEDUP_THRESHOLD.
+    '''
+    signatures = [Signature(text, database_id) for text in texts]
+    duplicates: Dict[int, Optional[int]] = {}
+    # Без id файла нельзя отличить свои чанки от чужих и записать ссылку на оригинал
+    if not signatures or file_id is None:
+        return signatures, duplicates
+    with db_cursor(database_url) as cursor:
+        cursor.execute(CANDIDATES_SQL, (sorted({band for s in signatures for band in s.bands}), database_id))
+        rows = cursor.fetchall()
+    candidates: Dict[int, List[Tuple[Optional[int], np.ndarray]]] = {}
+    for chunk_id, chunk_file_id, stored in rows:
+        candidate = (None if chunk_file_id == file_id else chunk_id, np.frombuffer(bytes(stored), dtype='<u4'))
+        for band in band_hashes(candidate[1], database_id):
+            candidates.setdefault(band, []).append(candidate)
+    for index, signature in enumerate(signatures):
+        best = 0.0
+        original: Optional[int] = None
+        for band in signature.bands:
+            for chunk_id, other in candidates.get(band, ()):
+                score = similarity(signature.minhash, other)
+                if score >= DEDUP_THRESHOLD and score > best:
+                    best, original = score, chunk_id
+        if best:
+            duplicates[index] = original
+            continue
+        # Уникальный чанк становится кандидатом для следующих чанков пачки
+        for band in signature.bands:
+            candidates.setdefault(band, []).append((None, signature.minhash))
+    return signatures, duplicates
+
+# Чанки удаляемого файла, на которые ссылаются дубликаты из других файлов, не удаляются,
+# а переходят к первому такому файлу (его ссылка больше не нужна)
+DELETE_FILE_CHUNKS_SQL = '''
+    WITH heirs AS (
+        SELECT DISTINCT ON (d.chunk_id) d.id, d.chunk_id, d.file_id
+        FROM rag_chunk_duplicates d JOIN rag_chunks c ON c.id = d.chunk_id
+        WHERE c.database_id = %(database_id)s AND c.file_id = %(file_id)s AND d.file_id IS DISTINCT FROM %(file_id)s
+        ORDER BY d.chunk_id, d.id
+    ), released AS (
+        DELETE FROM rag_chunk_duplicates
+        WHERE id IN (SELECT id FROM heirs) OR (database_id = %(database_id)s AND file_id = %(file_id)s)
+    ), moved AS (
+        UPDATE rag_chunks c SET file_id = heirs.file_id FROM heirs WHERE c.id = heirs.chunk_id
+        RETURNING c.id
+    )
+    DELETE FROM rag_chunks
+    WHERE database_id = %(database_id)s AND file_id = %(file_id)s AND id NOT IN (SELECT id FROM moved)
+'''
+
+def delete_file_chunks(database_url: str, database_id: str, file_id: str) -> int:
+    with db_cursor(database_url) as cursor:
+        cursor.execute(DELETE_FILE_CHUNKS_SQL, {'database_id': database_id, 'file_id': file_id})
+        return cursor.rowcount
@@ -0,0 +1,530 @@
+'''
+Потоковая загрузка документов в RAG-базы: PDF, DOCX, CSV, XLSX и текст разбираются
+по единицам (страница, абзац, строка таблицы), не загружая документ целиком в память,
+режутся на чанки по токенам с перекрытием и пачками отправляются в эмбеддинги и rag_chunks.
+Почти-дубликаты уже загруженных в базу чанков (rag_dedup.py) пропускаются до эмбеддингов.
+Каждая пачка сохраняется вместе с контрольной точкой задания (rag_ingest_jobs) одной командой:
+вызов, которому не хватило времени, оставляет задание в pending, и его продолжает следующий
+запрос с jobId или прогрев по таймеру — с той же единицы и тем же состоянием чанкера.
+Источник из тела запроса хранится в самом задании (rag_ingest_jobs.source), поэтому продолжить
+его может любой контейнер; /tmp — только локальная копия для разборщиков.
+'''
+import base64
+import contextlib
+import csv
+import itertools
+import os
+import re
+import time
+import uuid
+import zipfile
+import zlib
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from xml.etree.ElementTree import iterparse
+from runtime import db_cursor, http_session, json_dumps
+from rag_index import EMBEDDING_MODEL, EMBEDDING_BATCH_SIZE, embed_texts, encode_embeddings
+from rag_dedup import find_duplicates
+
+INGEST_SOURCE_DIR_DEFAULT = '/tmp/rag-ingest'
+INGEST_TIME_BUDGET = 20.0
+INGEST_LEASE_SECONDS = 120
+INGEST_MAX_BYTES = 200 * 1024 * 1024
+DOWNLOAD_BLOCK_SIZE = 1024 * 1024
+
+CHUNK_TOKENS = 300
+CHUNK_OVERLAP_TOKENS = 50
+MIN_CHUNK_TOKENS = 100
+# После короткой единицы (строка таблицы) чанк закрывается, только если её crc32 делится на это число:
+# границы зависят от содержимого, а не от смещения, и одинаковые фрагменты разных файлов
+# режутся одинаково — иначе дедупликация их не узнает
+BOUNDARY_DIVISOR = 4
+# Абзац без пустых строк (выгрузка логов, минифицированный JSON) режется на единицы не длиннее этого
+TEXT_UNIT_MAX_CHARS = 20000
+
+# Типы источников фронтенда -> разборщик; api — ответ URL как текст
+SOURCE_PARSERS = {
+    'text': 'text', 'json': 'text', 'xml': 'text', 'api': 'text',
+    'pdf': 'pdf', 'docx': 'docx', 'csv': 'csv', 'excel': 'xlsx'
+}
+
+# Приближение токенизатора эмбеддингов: слово или отдельный знак вместе с пробелами перед ним.
+# Склейка кусков восстанавливает исходный текст, поэтому чанк — это точный фрагмент документа
+PIECE_RE = re.compile(r'\s*(?:\w+|[^\w\s])')
+
+class Chunker:
+    '''
+    Чанки до CHUNK_TOKENS кусков. Длинная единица режется окнами с перекрытием CHUNK_OVERLAP_TOKENS,
+    на границе единиц чанк закрывается без перекрытия: после длинной единицы всегда, после
+    короткой — по содержимому (BOUNDARY_DIVISOR), когда набралось хотя бы MIN_CHUNK_TOKENS.
+    Состояние (хвост, ещё не ставший чанком) сохраняется в контрольную точку задания.
+    '''
+    __slots__ = ('pieces', 'emitted', 'chunk_tokens', 'overlap_tokens', 'min_tokens')
+
+    def __init__(self, pieces: Optional[List[str]] = None, emitted: int = 0,
+                 chunk_tokens: int = CHUNK_TOKENS, overlap_tokens: int = CHUNK_OVERLAP_TOKENS,
+                 min_tokens: int = MIN_CHUNK_TOKENS):
+        self.pieces = pieces or []
+        # Сколько первых кусков pieces уже вошли в предыдущий чанк (перекрытие)
+        self.emitted = emitted
+        self.chunk_tokens = chunk_tokens
+        self.overlap_tokens = overlap_tokens
+        self.min_tokens = min_tokens
+
+    def feed(self, text: str) -> List[str]:
+        if not text or not text.strip():
+            return []
+        unit = PIECE_RE.findall(f'\n{text}' if self.pieces else text)
+        self.pieces.extend(unit)
+        chunks = []
+        while len(self.pieces) >= self.chunk_tokens:
+            chunks.append(''.join(self.pieces[:self.chunk_tokens]).strip())
+            del self.pieces[:self.chunk_tokens - self.overlap_tokens]
+            self.emitted = self.overlap_tokens
+        fresh = len(self.pieces) - self.emitted
+        if len(unit) >= self.min_tokens or (fresh >= self.min_tokens and zlib.crc32(text.encode('utf-8')) % BOUNDARY_DIVISOR == 0):
+            chunks.extend(self.flush())
+        return chunks
+
+    def flush(self) -> List[str]:
+        chunks = [''.join(self.pieces).strip()] if len(self.pieces) > self.emitted else []
+        self.pieces = []
+        self.emitted = 0
+        return chunks
+
+    def state(self) -> Dict[str, Any]:
+        return {'pieces': self.pieces, 'emitted': self.emitted}
+
+def row_text(header: Optional[List[str]], row: List[str]) -> str:
+    '''
+    Строка таблицы как «Колонка: значение; ...»: чанк с частью прайс-листа понятен без шапки
+    '''
+    header = header or []
+    parts = []
+    for index, value in enumerate(row):
+        value = (value or '').strip()
+        if not value:
+            continue
+        name = header[index].strip() if index < len(header) and header[index] else ''
+        parts.append(f'{name}: {value}' if name else value)
+    return '; '.join(parts)
+
+def iter_text(path: str) -> Iterator[str]:
+    '''
+    Абзацы текстового файла (разделитель — пустая строка)
+    '''
+    with open(path, encoding='utf-8', errors='replace') as f:
+        paragraph: List[str] = []
+        size = 0
+        for line in f:
+            if not line.strip() or size > TEXT_UNIT_MAX_CHARS:
+                if paragraph:
+                    yield ''.join(paragraph)
+                paragraph, size = [], 0
+            if line.strip():
+                while len(line) > TEXT_UNIT_MAX_CHARS:
+                    yield line[:TEXT_UNIT_MAX_CHARS]
+                    line = line[TEXT_UNIT_MAX_CHARS:]
+                paragraph.append(line)
+                size += len(line)
+        if paragraph:
+            yield ''.join(paragraph)
+
+def iter_csv(path: str) -> Iterator[str]:
+    with open(path, encoding='utf-8-sig', errors='replace', newline='') as f:
+        try:
+            dialect: Any = csv.Sniffer().sniff(f.read(65536), delimiters=',;\t|')
+        except csv.Error:
+            dialect = csv.excel
+        f.seek(0)
+        reader = csv.reader(f, dialect)
+        header = next(reader, None)
+        for row in reader:
+            text = row_text(header, row)
+            if text:
+                yield text
+
+XLSX_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+XLSX_SHEET_RE = re.compile(r'^xl/worksheets/sheet(\d+)\.xml$')
+
+def column_index(cell_ref: str) -> int:
+    index = 0
+    for char in cell_ref:
+        if not char.isalpha():
+            break
+        index = index * 26 + ord(char.upper()) - ord('A') + 1
+    return index - 1
+
+def iter_xlsx(path: str) -> Iterator[str]:
+    '''
+    Строки всех листов книги; XML листов читается iterparse, разобранные строки сразу удаляются
+    '''
+    with zipfile.ZipFile(path) as archive:
+        shared: List[str] = []
+        if 'xl/sharedStrings.xml' in archive.namelist():
+            with archive.open('xl/sharedStrings.xml') as f:
+                for _, elem in iterparse(f):
+                    if elem.tag == f'{XLSX_NS}si':
+                        shared.append(''.join(t.text or '' for t in elem.iter(f'{XLSX_NS}t')))
+                        elem.clear()
+        sheets = sorted(
+            (int(match.group(1)), name) for name in archive.namelist() for match in [XLSX_SHEET_RE.match(name)] if match
+        )
+        for _, sheet in sheets:
+            header = None
+            sheet_data = None
+            with archive.open(sheet) as f:
+                for event, elem in iterparse(f, events=('start', 'end')):
+                    if event == 'start':
+                        if elem.tag == f'{XLSX_NS}sheetData':
+                            sheet_data = elem
+                        continue
+                    if elem.tag != f'{XLSX_NS}row':
+                        continue
+                    row: List[str] = []
+                    for position, cell in enumerate(elem.iter(f'{XLSX_NS}c')):
+                        index = column_index(cell.get('r', '')) if cell.get('r') else position
+                        if cell.get('t') == 'inlineStr':
+                            value = ''.join(t.text or '' for t in cell.iter(f'{XLSX_NS}t'))
+                        else:
+                            raw = cell.findtext(f'{XLSX_NS}v') or ''
+                            value = shared[int(raw)] if cell.get('t') == 's' and raw.isdigit() and int(raw) < len(shared) else raw
+                        if index >= len(row):
+                            row.extend([''] * (index + 1 - len(row)))
+                        row[index] = value
+                    if sheet_data is not None:
+                        sheet_data.clear()
+                    if header is None:
+                        header = row
+                        continue
+                    text = row_text(header, row)
+                    if text:
+                        yield text
+
+DOCX_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+
+def iter_docx(path: str) -> Iterator[str]:
+    '''
+    Абзацы word/document.xml (в том числе в ячейках таблиц); обработанные блоки body удаляются
+    '''
+    with zipfile.ZipFile(path) as archive, archive.open('word/document.xml') as f:
+        body = None
+        depth = 0
+        for event, elem in iterparse(f, events=('start', 'end')):
+            if event == 'start':
+                depth += 1
+                if elem.tag == f'{DOCX_NS}body':
+                    body = elem
+                continue
+            depth -= 1
+            if elem.tag == f'{DOCX_NS}p':
+                text = ''.join(
+                    node.text or '' if node.tag == f'{DOCX_NS}t' else '\t'
+                    for node in elem.iter() if node.tag in (f'{DOCX_NS}t', f'{DOCX_NS}tab')
+                )
+                if text.strip():
+                    yield text
+            # document (1) > body (2) > p | tbl (3): законченный блок верхнего уровня больше не нужен
+            if depth == 2 and body is not None:
+                body.clear()
+
+def parse_source(parser: str, path: str, start: int) -> Tuple[Optional[int], Iterator[str]]:
+    '''
+    (число единиц, если известно заранее; единицы начиная со start)
+    '''
+    if parser == 'pdf':
+        # pypdf нужен только для PDF: остальные форматы разбираются стандартной библиотекой
+        from pypdf import PdfReader
+        reader = PdfReader(path)
+        total = len(reader.pages)
+        return total, (reader.pages[i].extract_text() or '' for i in range(start, total))
+    iterators = {'text': iter_text, 'csv': iter_csv, 'xlsx': iter_xlsx, 'docx': iter_docx}
+    return None, itertools.islice(iterators[parser](path), start, None)
+
+def source_dir() -> str:
+    return os.environ.get('RAG_INGEST_SOURCE_DIR', INGEST_SOURCE_DIR_DEFAULT)
+
+def source_path(job_id: int) -> str:
+    return os.path.join(source_dir(), f'job-{job_id}')
+
+def save_source(path: str, data: bytes) -> None:
+    '''
+    Источник из задания на диск контейнера: разборщикам PDF и ZIP нужен файл с произвольным доступом
+    '''
+    os.makedirs(source_dir(), exist_ok=True)
+    tmp_path = f'{path}.part'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def remove_source(job_id: int) -> None:
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(source_path(job_id))
+
+def download_source(url: str, path: str) -> None:
+    '''
+    Скачивает источник блоками на диск; больше INGEST_MAX_BYTES — ValueError
+    '''
+    os.makedirs(source_dir(), exist_ok=True)
+    tmp_path = f'{path}.part'
+    size = 0
+    with http_session().get(url, stream=True, timeout=30) as response:
+        response.raise_for_status()
+        with open(tmp_path, 'wb') as f:
+            for block in response.iter_content(DOWNLOAD_BLOCK_SIZE):
+                size += len(block)
+                if size > INGEST_MAX_BYTES:
+                    f.close()
+                    os.remove(tmp_path)
+                    raise ValueError(f'Файл больше {INGEST_MAX_BYTES // (1024 * 1024)} МБ')
+                f.write(block)
+    os.replace(tmp_path, path)
+
+def decode_content(source_type: str, content: str) -> bytes:
+    '''
+    Текстовые источники приходят строкой, бинарные (pdf, docx, csv, excel) — в base64
+    (допускается data URL, как его отдаёт FileReader)
+    '''
+    if SOURCE_PARSERS.get(source_type, 'text') == 'text':
+        return content.encode('utf-8')
+    if content.startswith('data:') and ',' in content:
+        content = content.split(',', 1)[1]
+    return base64.b64decode(content, validate=False)
+
+CREATE_JOB_SQL = '''
+    INSERT INTO rag_ingest_jobs (database_id, file_id, name, source_type, source_url, source)
+    VALUES (%s, %s, %s, %s, %s, %s)
+    RETURNING id
+'''
+
+# Источник читается из базы, только если в этом контейнере ещё нет его копии
+JOB_SOURCE_SQL = '''
+    SELECT source FROM rag_ingest_jobs WHERE id = %s
+'''
+
+# Задание берёт тот, кто первым обновил lease; упавший вызов отдаёт его через INGEST_LEASE_SECONDS
+CLAIM_JOB_SQL = '''
+    UPDATE rag_ingest_jobs
+    SET status = 'running', lease = %(lease)s, error = NULL, updated_at = CURRENT_TIMESTAMP
+    WHERE id = %(id)s AND (
+        status = 'pending'
+        OR (status = 'running' AND updated_at < CURRENT_TIMESTAMP - %(lease_seconds)s * INTERVAL '1 second')
+    )
+    RETURNING database_id, file_id, source_type, source_url, units_done, chunks_done, checkpoint
+'''
+
+# Чанки пачки, ссылки на оригиналы пропущенных дубликатов и контрольная точка после пачки —
+# одной командой: либо всё, либо ничего. Если задание перехватили или отменили (lease сменился),
+# пачка не пишется и запрос вернёт 0
+SAVE_BATCH_SQL = '''
+    WITH job AS (
+        UPDATE rag_ingest_jobs
+        SET units_done = %(units_done)s, units_total = %(units_total)s,
+            chunks_done = chunks_done + cardinality(%(contents)s::text[]),
+            duplicates_skipped = duplicates_skipped + %(duplicates)s,
+            duplicate_chars = duplicate_chars + %(duplicate_chars)s,
+            checkpoint = %(checkpoint)s, status = %(status)s, updated_at = CURRENT_TIMESTAMP,
+            source = CASE WHEN %(status)s = 'done' THEN NULL ELSE source END
+        WHERE id = %(id)s AND lease = %(lease)s
+        RETURNING database_id, file_id
+    ), inserted AS (
+        INSERT INTO rag_chunks (database_id, file_id, position, content, embedding, model, minhash, lsh_bands)
+        SELECT job.database_id, job.file_id, c.position, c.content, c.embedding, %(model)s, c.minhash, c.lsh_bands::bigint[]
+        FROM job, unnest(
+            %(positions)s::int[], %(contents)s::text[], %(embeddings)s::bytea[], %(minhashes)s::bytea[], %(lsh_bands)s::text[]
+        ) AS c(position, content, embedding, minhash, lsh_bands)
+        RETURNING 1
+    ), referenced AS (
+        INSERT INTO rag_chunk_duplicates (database_id, chunk_id, file_id)
+        SELECT job.database_id, d.chunk_id, job.file_id
+        FROM job, unnest(%(duplicate_of)s::bigint[]) AS d(chunk_id)
+        ON CONFLICT (chunk_id, file_id) DO NOTHING
+    )
+    SELECT (SELECT COUNT(*) FROM job), (SELECT COUNT(*) FROM inserted)
+'''
+
+FAIL_JOB_SQL = '''
+    UPDATE rag_ingest_jobs SET status = 'failed', error = %s, source = NULL, updated_at = CURRENT_TIMESTAMP
+    WHERE id = %s AND lease = %s
+'''
+
+JOB_STATUS_SQL = '''
+    SELECT id, database_id, file_id, name, source_type, status, units_done, units_total, chunks_done, error,
+           created_at, updated_at, duplicates_skipped, duplicate_chars
+    FROM rag_ingest_jobs WHERE id = %s
+'''
+
+STALLED_JOBS_SQL = '''
+    SELECT id FROM rag_ingest_jobs
+    WHERE status = 'pending'
+       OR (status = 'running' AND updated_at < CURRENT_TIMESTAMP - %s * INTERVAL '1 second')
+    ORDER BY updated_at
+    LIMIT %s
+'''
+
+CANCEL_JOBS_SQL = '''
+    UPDATE rag_ingest_jobs SET status = 'cancelled', lease = NULL, source = NULL, updated_at = CURRENT_TIMESTAMP
+    WHERE database_id = %s AND file_id = %s AND status IN ('pending', 'running')
+'''
+
+def create_job(
+    database_url: str, database_id: str, file_id: Optional[str], name: str,
+    source_type: str, source_url: Optional[str] = None, source: Optional[bytes] = None
+) -> int:
+    '''
+    Задание загрузки; источник — по source_url или содержимое source, сохранённое в самом задании
+    '''
+    with db_cursor(database_url) as cursor:
+        cursor.execute(CREATE_JOB_SQL, (database_id, file_id, name[:255], source_type, source_url, source))
+        return cursor.fetchone()[0]
+
+def job_status(database_url: str, job_id: int) -> Optional[Dict[str, Any]]:
+    with db_cursor(database_url) as cursor:
+        cursor.execute(JOB_STATUS_SQL, (job_id,))
+        row = cursor.fetchone()
+    if not row:
+        return None
+    units_total = row[7]
+    return {
+        'id': row[0],
+        'databaseId': row[1],
+        'fileId': row[2],
+        'name': row[3],
+        'sourceType': row[4],
+        'status': row[5],
+        'unitsDone': row[6],
+        'unitsTotal': units_total,
+        'chunks': row[8],
+        # Сколько чанков не пришлось эмбеддить и хранить: почти-дубликаты уже загруженных
+        'dedup': {
+            'duplicates': row[12],
+            'savedChars': row[13],
+            'ratio': round(row[12] / (row[8] + row[12]), 3) if row[8] + row[12] else 0.0
+        },
+        'progress': 1.0 if row[5] == 'done' else (round(row[6] / units_total, 3) if units_total else None),
+        'error': row[9],
+        'createdAt': row[10].isoformat() if row[10] else None,
+        'updatedAt': row[11].isoformat() if row[11] else None
+    }
+
+def cancel_jobs(database_url: str, database_id: str, file_id: str) -> int:
+    with db_cursor(database_url) as cursor:
+        cursor.execute(CANCEL_JOBS_SQL, (database_id, file_id))
+        return cursor.rowcount
+
+def ingest_budget() -> float:
+    return float(os.environ.get('RAG_INGEST_TIME_BUDGET', INGEST_TIME_BUDGET))
+
+def run_job(database_url: str, api_key: str, job_id: int, budget: Optional[float] = None) -> Optional[Dict[str, Any]]:
+    '''
+    Продолжает задание с контрольной точки, пока не кончится budget секунд; возвращает его статус.
+    Задание, которое сейчас выполняет другой вызов, не трогает.
+    '''
+    deadline = time.monotonic() + (ingest_budget() if budget is None else budget)
+    lease = str(uuid.uuid4())
+    with db_cursor(database_url) as cursor:
+        cursor.execute(CLAIM_JOB_SQL, {'id': job_id, 'lease': lease, 'lease_seconds': INGEST_LEASE_SECONDS})
+        row = cursor.fetchone()
+    if row:
+        database_id, file_id, source_type, source_url, units_done, chunks_done, checkpoint = row
+        try:
+            ingest(
+                database_url, api_key, job_id, lease, database_id, file_id, source_type, source_url,
+                units_done, checkpoint or {}, deadline
+            )
+        except Exception as e:
+            print(f"[INGEST] Job {job_id} ({database_id}) failed: {str(e)}")
+            with db_cursor(database_url) as cursor:
+                cursor.execute(FAIL_JOB_SQL, (str(e)[:1000], job_id, lease))
+    status = job_status(database_url, job_id)
+    # Задание завершили здесь или в другом контейнере (в том числе отменили) — локальная копия больше не нужна
+    if status and status['status'] in ('done', 'failed', 'cancelled'):
+        remove_source(job_id)
+    return status
+
+def ingest(
+    database_url: str, api_key: str, job_id: int, lease: str, database_id: str, file_id: Optional[str],
+    source_type: str, source_url: Optional[str], units_done: int, checkpoint: Dict[str, Any], deadline: float
+) -> None:
+    path = source_path(job_id)
+    if not os.path.exists(path):
+        if source_url:
+            download_source(source_url, path)
+        else:
+            with db_cursor(database_url) as cursor:
+                cursor.execute(JOB_SOURCE_SQL, (job_id,))
+                row = cursor.fetchone()
+            if not row or row[0] is None:
+                raise ValueError('Источник задания недоступен, загрузите файл заново')
+            save_source(path, bytes(row[0]))
+    parser = SOURCE_PARSERS.get(source_type, 'text')
+    try:
+        units_total, units = parse_source(parser, path, units_done)
+    except zipfile.BadZipFile:
+        raise ValueError('Файл не является документом .docx/.xlsx')
+    chunker = Chunker(checkpoint.get('pieces'), checkpoint.get('emitted', 0))
+    position = checkpoint.get('position', 0)
+    batch: List[str] = []
+
+    def save(status: str) -> bool:
+        nonlocal position, batch
+        # Почти-дубликаты не эмбеддятся и не сохраняются; на оригинал из другого файла пишется ссылка
+        signatures, duplicates = find_duplicates(database_url, database_id, file_id, batch)
+        unique = [i for i in range(len(batch)) if i not in duplicates]
+        contents = [batch[i] for i in unique]
+        embeddings = embed_texts(api_key, contents) if contents else []
+        with db_cursor(database_url) as cursor:
+            cursor.execute(SAVE_BATCH_SQL, {
+                'id': job_id,
+                'lease': lease,
+                'status': status,
+                'units_done': units_done,
+                'units_total': units_total,
+                'checkpoint': json_dumps({**chunker.state(), 'position': position + len(contents)}),
+                'model': EMBEDDING_MODEL,
+                'positions': list(range(position, position + len(contents))),
+                'contents': contents,
+                'embeddings': encode_embeddings(embeddings),
+                'minhashes': [signatures[i].to_bytes() for i in unique],
+                'lsh_bands': [signatures[i].bands_literal() for i in unique],
+                'duplicates': len(duplicates),
+                'duplicate_chars': sum(len(batch[i]) for i in duplicates),
+                'duplicate_of': sorted({chunk_id for chunk_id in duplicates.values() if chunk_id is not None})
+            })
+            owned = cursor.fetchone()[0] == 1
+        position += len(contents)
+        batch = []
+        return owned
+
+    for unit in units:
+        units_done += 1
+        batch.extend(chunker.feed(unit))
+        paused = time.monotonic() > deadline
+        if len(batch) >= EMBEDDING_BATCH_SIZE or paused:
+            if not save('pending' if paused else 'running'):
+                print(f"[INGEST] Job {job_id} lease lost, stopping")
+                return
+            if paused:
+                print(f"[INGEST] Job {job_id} paused at unit {units_done}, {position} chunks")
+                return
+    batch.extend(chunker.flush())
+    if save('done'):
+        remove_source(job_id)
+        print(f"[INGEST] Job {job_id} done: {units_done} units, {position} chunks")
+
+def resume_stalled(database_url: str, api_key: str, budget: Optional[float] = None, limit: int = 3) -> List[Dict[str, Any]]:
+    '''
+    Продолжает отложенные и брошенные задания (прогрев по таймеру), пока хватает budget
+    '''
+    deadline = time.monotonic() + (ingest_budget() if budget is None else budget)
+    with db_cursor(database_url) as cursor:
+        cursor.execute(STALLED_JOBS_SQL, (INGEST_LEASE_SECONDS, limit))
+        job_ids = [row[0] for row in cursor.fetchall()]
+    results = []
+    for job_id in job_ids:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        status = run_job(database_url, api_key, job_id, remaining)
+        if status:
+            results.append({'id': job_id, 'status': status['status'], 'chunks': status['chunks']})
+    return results
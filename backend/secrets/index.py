@@ -1,10 +1,13 @@
 import json
 import os
+import urllib.error
 from typing import Dict, Any
 import psycopg2
 from psycopg2.extras import RealDictCursor
-import requests
+from runtime import http_handler, http_session, lazy_requests, json_response, error_response, gptunnel_url
+from model_catalog import fetch_catalog, store_catalog
 
+@http_handler('GET, POST, PUT, DELETE')
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Управление секретами проекта (чтение, добавление, обновление)
@@ -14,27 +17,9 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     method: str = event.get('httpMethod', 'GET')
     
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
-    
     database_url = os.environ.get('DATABASE_URL')
     if not database_url:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Database not configured'}),
-            'isBase64Encoded': False
-        }
+        return error_response(500, 'Database not configured')
     
     conn = psycopg2.connect(database_url)
     cursor = conn.cursor(cursor_factory=RealDictCursor)
@@ -49,44 +34,25 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 result = cursor.fetchone()
                 
                 if not result or not result['secret_value']:
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'GPTUNNEL_API_KEY not found'}),
-                        'isBase64Encoded': False
-                    }
+                    return error_response(400, 'GPTUNNEL_API_KEY not found')
                 
                 api_key = result['secret_value']
                 
+                requests = lazy_requests()
                 try:
-                    response = requests.get(
-                        'https://gptunnel.ru/v1/balance',
+                    response = http_session().get(
+                        gptunnel_url('/v1/balance'),
                         headers={'Authorization': f'Bearer {api_key}'},
                         timeout=30
                     )
                     
                     if response.status_code != 200:
-                        return {
-                            'statusCode': response.status_code,
-                            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                            'body': json.dumps({'error': f'GPTunnel API error: {response.status_code}'}),
-                            'isBase64Encoded': False
-                        }
+                        return error_response(response.status_code, f'GPTunnel API error: {response.status_code}')
                     
                     balance_data = response.json()
-                    return {
-                        'statusCode': 200,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'balance': balance_data.get('balance', 0)}),
-                        'isBase64Encoded': False
-                    }
+                    return json_response(200, {'balance': balance_data.get('balance', 0)})
                 except requests.RequestException as e:
-                    return {
-                        'statusCode': 500,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': f'Request failed: {str(e)}'}),
-                        'isBase64Encoded': False
-                    }
+                    return error_response(500, f'Request failed: {str(e)}')
             
             cursor.execute("SELECT secret_name, created_at, updated_at FROM secrets ORDER BY secret_name")
             secrets = cursor.fetchall()
@@ -100,12 +66,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'updated_at': secret['updated_at'].isoformat() if secret['updated_at'] else None
                 })
             
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps(result),
-                'isBase64Encoded': False
-            }
+            return json_response(200, result)
         
         elif method == 'POST':
             body = json.loads(event.get('body', '{}'))
@@ -113,37 +74,19 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             value = body.get('value', '').strip()
             
             if not name or not value:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Имя и значение обязательны'}),
-                    'isBase64Encoded': False
-                }
+                return error_response(400, 'Имя и значение обязательны')
             
             should_validate = name == 'GPTUNNEL_API_KEY'
+            catalog_entries = None
             
             if should_validate:
+                # Проверка ключа запросом каталога: ответ сразу становится каталогом моделей
                 try:
-                    response = requests.get(
-                        'https://gptunnel.ru/v1/models',
-                        headers={'Authorization': f'Bearer {value}'},
-                        timeout=10
-                    )
-                    
-                    if response.status_code != 200:
-                        return {
-                            'statusCode': 400,
-                            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                            'body': json.dumps({'error': f'Неверный API ключ (код {response.status_code})'}),
-                            'isBase64Encoded': False
-                        }
-                except requests.RequestException as e:
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': f'Ошибка проверки ключа: {str(e)}'}),
-                        'isBase64Encoded': False
-                    }
+                    catalog_entries = fetch_catalog(value)
+                except urllib.error.HTTPError as e:
+                    return error_response(400, f'Неверный API ключ (код {e.code})')
+                except (urllib.error.URLError, ValueError) as e:
+                    return error_response(400, f'Ошибка проверки ключа: {str(e)}')
             
             cursor.execute('''
                 INSERT INTO secrets (secret_name, secret_value)
@@ -156,54 +99,35 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             
             result = cursor.fetchone()
             
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({
+            if catalog_entries:
+                try:
+                    store_catalog(database_url, catalog_entries)
+                except Exception as e:
+                    print(f"[SECRETS] Failed to store model catalog: {str(e)}")
+            
+            return json_response(200, {
                     'success': True,
                     'name': result['secret_name'],
                     'created_at': result['created_at'].isoformat() if result['created_at'] else None,
                     'updated_at': result['updated_at'].isoformat() if result['updated_at'] else None
-                }),
-                'isBase64Encoded': False
-            }
+                })
         
         elif method == 'DELETE':
             query_params = event.get('queryStringParameters') or {}
             name = query_params.get('name', '').strip()
             
             if not name:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Имя секрета обязательно'}),
-                    'isBase64Encoded': False
-                }
+                return error_response(400, 'Имя секрета обязательно')
             
             cursor.execute('DELETE FROM secrets WHERE secret_name = %s', (name,))
             conn.commit()
             
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'success': True}),
-                'isBase64Encoded': False
-            }
+            return json_response(200, {'success': True})
         
-        return {
-            'statusCode': 405,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Method not allowed'}),
-            'isBase64Encoded': False
-        }
+        return error_response(405, 'Method not allowed')
         
     except Exception as e:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': str(e)}),
-            'isBase64Encoded': False
-        }
+        return error_response(500, str(e))
     finally:
         cursor.close()
         conn.close()
\ No newline at end of file
@@ -2,55 +2,25 @@ import json
 import os
 import psycopg2
 from typing import Dict, Any
+from runtime import http_handler, json_response, error_response
 
+@http_handler('POST')
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Синхронизация RAG баз данных с таблицей api_integrations
     Args: event с httpMethod, body (rag_id, action: create/update/delete, integration_data)
     Returns: HTTP response с результатом синхронизации
     '''
-    method: str = event.get('httpMethod', 'GET')
-    
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': ''
-        }
-    
-    if method != 'POST':
-        return {
-            'statusCode': 405,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Method not allowed'}),
-            'isBase64Encoded': False
-        }
-    
     body_data = json.loads(event.get('body', '{}'))
     action = body_data.get('action')
     rag_id = body_data.get('rag_id')
     
     if not action or not rag_id:
-        return {
-            'statusCode': 400,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Missing action or rag_id'}),
-            'isBase64Encoded': False
-        }
+        return error_response(400, 'Missing action or rag_id')
     
     database_url = os.environ.get('DATABASE_URL')
     if not database_url:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Database not configured'}),
-            'isBase64Encoded': False
-        }
+        return error_response(500, 'Database not configured')
     
     conn = psycopg2.connect(database_url)
     cur = conn.cursor()
@@ -75,12 +45,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             ))
             conn.commit()
             
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'success': True, 'message': 'Integration created'}),
-                'isBase64Encoded': False
-            }
+            return json_response(200, {'success': True, 'message': 'Integration created'})
         
         elif action == 'update':
             integration_data = body_data.get('integration_data', {})
@@ -108,12 +73,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             ))
             conn.commit()
             
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'success': True, 'message': 'Integration updated'}),
-                'isBase64Encoded': False
-            }
+            return json_response(200, {'success': True, 'message': 'Integration updated'})
         
         elif action == 'delete':
             cur.execute(
@@ -122,20 +82,10 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             )
             conn.commit()
             
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'success': True, 'message': 'Integration deleted'}),
-                'isBase64Encoded': False
-            }
+            return json_response(200, {'success': True, 'message': 'Integration deleted'})
         
         else:
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Invalid action'}),
-                'isBase64Encoded': False
-            }
+            return error_response(400, 'Invalid action')
     
     finally:
         cur.close()
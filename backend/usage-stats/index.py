@@ -1,9 +1,10 @@
-import json
 import os
 from typing import Dict, Any
 import psycopg2
 from psycopg2.extras import RealDictCursor
+from runtime import http_handler, json_response, error_response
 
+@http_handler('GET')
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Получение статистики использования токенов и запросов
@@ -11,37 +12,9 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
           context с request_id
     Returns: HTTP response со статистикой использования
     '''
-    method: str = event.get('httpMethod', 'GET')
-    
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
-    
-    if method != 'GET':
-        return {
-            'statusCode': 405,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Method not allowed'}),
-            'isBase64Encoded': False
-        }
-    
     database_url = os.environ.get('DATABASE_URL')
     if not database_url:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Database not configured'}),
-            'isBase64Encoded': False
-        }
+        return error_response(500, 'Database not configured')
     
     query_params = event.get('queryStringParameters') or {}
     days = int(query_params.get('days', 30))
@@ -61,9 +34,9 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 total_completion_tokens,
                 COALESCE(total_cost, 0) as total_cost
             FROM usage_stats
-            WHERE date >= CURRENT_DATE - INTERVAL '%s days'
+            WHERE date >= CURRENT_DATE - %s * INTERVAL '1 day'
             ORDER BY date DESC, endpoint, model
-        ''' % days)
+        ''', (days,))
         
         stats = cursor.fetchall()
         
@@ -83,17 +56,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         cursor.close()
         conn.close()
         
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps(result),
-            'isBase64Encoded': False
-        }
+        return json_response(200, result)
         
     except Exception as e:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': str(e)}),
-            'isBase64Encoded': False
-        }
\ No newline at end of file
+        return error_response(500, str(e))
\ No newline at end of file
@@ -1,203 +1,189 @@
 import json
 import os
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional, Tuple
 import requests
-import psycopg2
 import time
+from runtime import http_handler, http_session, authenticate_client, raw_response, error_response, gptunnel_url, db_cursor, execute_prepared
+from routing import FAILOVER_STATUSES, RoutingPolicy, plan_route, record_failure, record_success
 
-def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+ASSISTANT_CACHE_TTL = 60
+ASSISTANT_CACHE_MAX_ITEMS = 256
+REQUEST_TIMEOUT = 30
+
+AssistantRoute = Tuple[str, Optional[str], Optional[RoutingPolicy]]
+
+# assistant_id -> ((type, assistant_code, routing_policy) или None, expires_at); живёт между тёплыми вызовами
+_assistant_route_cache: Dict[str, Tuple[Optional[AssistantRoute], float]] = {}
+
+def load_assistant_route(database_url: str, assistant_id: str) -> Optional[AssistantRoute]:
     '''
-    Business: Создание chat completions через GPTunnel
-    Args: event с httpMethod, body
-          context с request_id
-    Returns: HTTP response с ответом модели
+    Тип ассистента, его код в GPTunnel и политика маршрутизации: из кэша контейнера или prepared statement
     '''
-    method: str = event.get('httpMethod', 'POST')
+    entry = _assistant_route_cache.get(assistant_id)
+    if entry and entry[1] > time.monotonic():
+        return entry[0]
     
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
+    with db_cursor(database_url) as cursor:
+        execute_prepared(
+            cursor, 'assistant_route', ('text',),
+            'SELECT type, assistant_code, routing_policy FROM assistants WHERE id = $1', (assistant_id,)
+        )
+        row = cursor.fetchone()
+    assistant_info = (row[0], row[1], RoutingPolicy.from_config(row[2])) if row else None
     
-    if method != 'POST':
-        return {
-            'statusCode': 405,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Method not allowed'}),
-            'isBase64Encoded': False
-        }
+    if len(_assistant_route_cache) >= ASSISTANT_CACHE_MAX_ITEMS:
+        _assistant_route_cache.pop(next(iter(_assistant_route_cache)), None)
+    _assistant_route_cache[assistant_id] = (assistant_info, time.monotonic() + ASSISTANT_CACHE_TTL)
+    return assistant_info
+
+ACCOUNTING_SQL = '''
+    INSERT INTO api_requests (endpoint, method, model, status_code, latency_ms, tokens_prompt, tokens_completion, tokens_total, total_cost)
+    SELECT '/v1/chat/completions', 'POST', model, status_code, latency_ms, tokens_prompt, tokens_completion, tokens_total, total_cost
+    FROM unnest(
+        %(models)s::varchar[], %(statuses)s::int[], %(latencies)s::int[], %(prompt)s::int[],
+        %(completion)s::int[], %(total)s::int[], %(costs)s::numeric[]
+    ) AS a(model, status_code, latency_ms, tokens_prompt, tokens_completion, tokens_total, total_cost);
     
+    INSERT INTO usage_stats (endpoint, model, request_count, total_tokens, total_prompt_tokens, total_completion_tokens, total_cost)
+    VALUES ('/v1/chat/completions', %(model)s, 1, %(tokens_total)s, %(tokens_prompt)s, %(tokens_completion)s, %(total_cost)s)
+    ON CONFLICT (endpoint, model, COALESCE(assistant_id, ''), date)
+    DO UPDATE SET 
+        request_count = usage_stats.request_count + 1,
+        total_tokens = usage_stats.total_tokens + EXCLUDED.total_tokens,
+        total_prompt_tokens = usage_stats.total_prompt_tokens + EXCLUDED.total_prompt_tokens,
+        total_completion_tokens = usage_stats.total_completion_tokens + EXCLUDED.total_completion_tokens,
+        total_cost = usage_stats.total_cost + EXCLUDED.total_cost,
+        updated_at = CURRENT_TIMESTAMP
+'''
+
+def record_request(database_url: str, model: str, attempts: List[Tuple[Any, ...]]) -> None:
+    '''
+    Учёт одним round trip: строка api_requests на каждую попытку (статистика маршрутизации)
+    и агрегат usage_stats по модели, которая ответила
+    '''
+    models, statuses, latencies, prompt, completion, total, costs = (list(column) for column in zip(*attempts))
+    try:
+        with db_cursor(database_url) as cursor:
+            cursor.execute(ACCOUNTING_SQL, {
+                'models': models, 'statuses': statuses, 'latencies': latencies,
+                'prompt': prompt, 'completion': completion, 'total': total, 'costs': costs,
+                'model': model, 'tokens_prompt': prompt[-1], 'tokens_completion': completion[-1],
+                'tokens_total': total[-1], 'total_cost': costs[-1]
+            })
+    except Exception as e:
+        print(f"[CHAT] Failed to record request: {str(e)}")
+
+@http_handler('POST')
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''
+    Business: Создание chat completions через GPTunnel; по политике ассистента или списку models
+              модель выбирается по статистике, а при ошибке или таймауте запрос уходит следующей
+    Args: event с httpMethod, body (model или models, assistant_id)
+          context с request_id
+    Returns: HTTP response с ответом модели
+    '''
     database_url = os.environ.get('DATABASE_URL')
     if not database_url:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Database not configured'}),
-            'isBase64Encoded': False
-        }
-    
-    auth_header = event.get('headers', {}).get('authorization', '')
-    if not auth_header.startswith('Bearer '):
-        return {
-            'statusCode': 401,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Missing or invalid authorization header'}),
-            'isBase64Encoded': False
-        }
+        return error_response(500, 'Database not configured')
     
-    client_api_key = auth_header[7:]
-    
-    try:
-        import hashlib
-        
-        # Hash the provided key to compare with stored hash
-        key_hash = hashlib.sha256(client_api_key.encode()).hexdigest()
-        
-        conn = psycopg2.connect(database_url)
-        cursor = conn.cursor()
-        cursor.execute('SELECT active FROM api_keys WHERE key_hash = %s', (key_hash,))
-        result = cursor.fetchone()
-        cursor.close()
-        conn.close()
-        
-        if not result:
-            return {
-                'statusCode': 401,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Invalid API key'}),
-                'isBase64Encoded': False
-            }
-        
-        if not result[0]:
-            return {
-                'statusCode': 403,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'API key is disabled'}),
-                'isBase64Encoded': False
-            }
-    except Exception as e:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': f'Authentication error: {str(e)}'}),
-            'isBase64Encoded': False
-        }
+    auth_error = authenticate_client(event, database_url)
+    if auth_error:
+        return auth_error
     
     gptunnel_api_key = os.environ.get('GPTUNNEL_API_KEY')
     if not gptunnel_api_key:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'GPTunnel API не настроен'}),
-            'isBase64Encoded': False
-        }
+        return error_response(500, 'GPTunnel API не настроен')
     
     try:
         body_data = json.loads(event.get('body', '{}'))
         model = body_data.get('model', 'unknown')
+        # models — список моделей для fallback в самом запросе (как в OpenRouter)
+        policy = RoutingPolicy.from_config({'models': body_data.pop('models', None)})
         
         # Определяем URL для запроса в зависимости от типа ассистента
-        gptunnel_url = 'https://gptunnel.ru/v1/chat/completions'
+        endpoint = gptunnel_url('/v1/chat/completions')
         assistant_id = body_data.get('assistant_id') or body_data.get('assistant')
         
         if assistant_id:
-            # Проверяем тип ассистента в БД
-            conn = psycopg2.connect(database_url)
-            cursor = conn.cursor()
-            cursor.execute('SELECT type, assistant_code FROM assistants WHERE id = %s', (assistant_id,))
-            assistant_info = cursor.fetchone()
-            cursor.close()
-            conn.close()
+            assistant_info = load_assistant_route(database_url, assistant_id)
             
             if assistant_info:
-                assistant_type, assistant_code = assistant_info
+                assistant_type, assistant_code, assistant_policy = assistant_info
                 if assistant_type == 'external' and assistant_code:
-                    gptunnel_url = 'https://gptunnel.ru/v1/assistant/chat'
+                    endpoint = gptunnel_url('/v1/assistant/chat')
                     # Заменяем assistant_id на код из GPTunnel
                     body_data['assistant_id'] = assistant_code
+                    policy = None
+                else:
+                    policy = policy or assistant_policy
         
-        start_time = time.time()
-        response = requests.post(
-            gptunnel_url,
-            headers={
-                'Authorization': f'Bearer {gptunnel_api_key}',
-                'Content-Type': 'application/json'
-            },
-            json=body_data,
-            timeout=30
-        )
-        latency_ms = int((time.time() - start_time) * 1000)
+        # Без политики — одна попытка с моделью из запроса, как прежде
+        route: List[Optional[str]] = [None]
+        timeout: float = REQUEST_TIMEOUT
+        if policy:
+            route = list(plan_route(policy, database_url, gptunnel_api_key))
+            timeout = policy.timeout(REQUEST_TIMEOUT)
         
-        tokens_prompt = 0
-        tokens_completion = 0
-        tokens_total = 0
-        total_cost = 0.0
+        attempts: List[Tuple[Any, ...]] = []
+        response = None
+        last_error: Optional[requests.RequestException] = None
         
-        if response.status_code == 200:
+        for attempt, route_model in enumerate(route):
+            if route_model is not None:
+                body_data['model'] = route_model
+            attempt_model = body_data.get('model', model)
+            start_time = time.time()
             try:
-                response_json = response.json()
-                usage = response_json.get('usage', {})
-                tokens_prompt = usage.get('prompt_tokens', 0)
-                tokens_completion = usage.get('completion_tokens', 0)
-                tokens_total = usage.get('total_tokens', 0)
-                total_cost = usage.get('total_cost', 0.0)
-            except:
-                pass
+                response = http_session().post(
+                    endpoint,
+                    headers={
+                        'Authorization': f'Bearer {gptunnel_api_key}',
+                        'Content-Type': 'application/json'
+                    },
+                    json=body_data,
+                    timeout=timeout
+                )
+            except requests.RequestException as e:
+                # response остаётся последним настоящим ответом GPTunnel (например, 503 прошлой модели):
+                # если маршрут кончится сетевой ошибкой, клиент получит его, а не синтетический 500
+                last_error = e
+                attempts.append((attempt_model, None, int((time.time() - start_time) * 1000), 0, 0, 0, 0.0))
+                record_failure(route_model)
+                print(f"[CHAT] model={attempt_model} attempt {attempt + 1}/{len(route)} failed: {str(e)}")
+                continue
+            latency_ms = int((time.time() - start_time) * 1000)
+            
+            tokens_prompt = 0
+            tokens_completion = 0
+            tokens_total = 0
+            total_cost = 0.0
+            
+            if response.status_code == 200:
+                try:
+                    response_json = response.json()
+                    usage = response_json.get('usage', {})
+                    tokens_prompt = usage.get('prompt_tokens', 0)
+                    tokens_completion = usage.get('completion_tokens', 0)
+                    tokens_total = usage.get('total_tokens', 0)
+                    total_cost = usage.get('total_cost', 0.0)
+                except:
+                    pass
+            
+            attempts.append((attempt_model, response.status_code, latency_ms, tokens_prompt, tokens_completion, tokens_total, total_cost))
+            if response.status_code in FAILOVER_STATUSES:
+                record_failure(route_model)
+                print(f"[CHAT] model={attempt_model} attempt {attempt + 1}/{len(route)} returned {response.status_code}")
+                continue
+            record_success(route_model)
+            break
         
-        if database_url:
-            try:
-                conn = psycopg2.connect(database_url)
-                cursor = conn.cursor()
-                cursor.execute('''
-                    INSERT INTO api_requests (endpoint, method, status_code, latency_ms, tokens_prompt, tokens_completion, tokens_total, model)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                ''', ('/v1/chat/completions', 'POST', response.status_code, latency_ms, tokens_prompt, tokens_completion, tokens_total, model))
-                
-                cursor.execute('''
-                    INSERT INTO usage_stats (endpoint, model, request_count, total_tokens, total_prompt_tokens, total_completion_tokens, total_cost)
-                    VALUES (%s, %s, 1, %s, %s, %s, %s)
-                    ON CONFLICT (endpoint, model, date) 
-                    DO UPDATE SET 
-                        request_count = usage_stats.request_count + 1,
-                        total_tokens = usage_stats.total_tokens + EXCLUDED.total_tokens,
-                        total_prompt_tokens = usage_stats.total_prompt_tokens + EXCLUDED.total_prompt_tokens,
-                        total_completion_tokens = usage_stats.total_completion_tokens + EXCLUDED.total_completion_tokens,
-                        total_cost = usage_stats.total_cost + EXCLUDED.total_cost,
-                        updated_at = CURRENT_TIMESTAMP
-                ''', ('/v1/chat/completions', model, tokens_total, tokens_prompt, tokens_completion, total_cost))
-                
-                conn.commit()
-                cursor.close()
-                conn.close()
-            except:
-                pass
+        record_request(database_url, attempts[-1][0], attempts)
         
-        return {
-            'statusCode': response.status_code,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': response.text,
-            'isBase64Encoded': False
-        }
+        if response is None:
+            return error_response(500, f'Ошибка GPTunnel API: {str(last_error)}')
+        return raw_response(response.status_code, response.text)
         
     except requests.RequestException as e:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': f'Ошибка GPTunnel API: {str(e)}'}),
-            'isBase64Encoded': False
-        }
+        return error_response(500, f'Ошибка GPTunnel API: {str(e)}')
     except Exception as e:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': str(e)}),
-            'isBase64Encoded': False
-        }
\ No newline at end of file
+        return error_response(500, str(e))
@@ -4,7 +4,9 @@ from typing import Dict, Any
 import requests
 import psycopg2
 import time
+from runtime import http_handler, http_session, authenticate_client, raw_response, error_response, gptunnel_url
 
+@http_handler('POST')
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Создание embeddings через GPTunnel
@@ -12,101 +14,25 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
           context с request_id
     Returns: HTTP response с векторными представлениями
     '''
-    method: str = event.get('httpMethod', 'POST')
-    
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
-    
-    if method != 'POST':
-        return {
-            'statusCode': 405,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Method not allowed'}),
-            'isBase64Encoded': False
-        }
-    
     database_url = os.environ.get('DATABASE_URL')
     if not database_url:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Database not configured'}),
-            'isBase64Encoded': False
-        }
-    
-    auth_header = event.get('headers', {}).get('authorization', '')
-    if not auth_header.startswith('Bearer '):
-        return {
-            'statusCode': 401,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Missing or invalid authorization header'}),
-            'isBase64Encoded': False
-        }
-    
-    client_api_key = auth_header[7:]
+        return error_response(500, 'Database not configured')
     
-    try:
-        import hashlib
-        
-        # Hash the provided key to compare with stored hash
-        key_hash = hashlib.sha256(client_api_key.encode()).hexdigest()
-        
-        conn = psycopg2.connect(database_url)
-        cursor = conn.cursor()
-        cursor.execute('SELECT active FROM api_keys WHERE key_hash = %s', (key_hash,))
-        result = cursor.fetchone()
-        cursor.close()
-        conn.close()
-        
-        if not result:
-            return {
-                'statusCode': 401,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Invalid API key'}),
-                'isBase64Encoded': False
-            }
-        
-        if not result[0]:
-            return {
-                'statusCode': 403,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'API key is disabled'}),
-                'isBase64Encoded': False
-            }
-    except Exception as e:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': f'Authentication error: {str(e)}'}),
-            'isBase64Encoded': False
-        }
+    auth_error = authenticate_client(event, database_url)
+    if auth_error:
+        return auth_error
     
     gptunnel_api_key = os.environ.get('GPTUNNEL_API_KEY')
     if not gptunnel_api_key:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'GPTunnel API не настроен'}),
-            'isBase64Encoded': False
-        }
+        return error_response(500, 'GPTunnel API не настроен')
     
     try:
         body_data = json.loads(event.get('body', '{}'))
         model = body_data.get('model', 'unknown')
         
         start_time = time.time()
-        response = requests.post(
-            'https://gptunnel.ru/v1/embeddings',
+        response = http_session().post(
+            gptunnel_url('/v1/embeddings'),
             headers={
                 'Authorization': f'Bearer {gptunnel_api_key}',
                 'Content-Type': 'application/json'
@@ -154,24 +80,9 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             except:
                 pass
         
-        return {
-            'statusCode': response.status_code,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': response.text,
-            'isBase64Encoded': False
-        }
+        return raw_response(response.status_code, response.text)
         
     except requests.RequestException as e:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': f'Ошибка GPTunnel API: {str(e)}'}),
-            'isBase64Encoded': False
-        }
+        return error_response(500, f'Ошибка GPTunnel API: {str(e)}')
     except Exception as e:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': str(e)}),
-            'isBase64Encoded': False
-        }
\ No newline at end of file
+        return error_response(500, str(e))
\ No newline at end of file
@@ -1,102 +1,29 @@
-import json
 import os
+import urllib.error
 from typing import Dict, Any
-import requests
-import psycopg2
+from runtime import http_handler, raw_response, error_response
+from model_catalog import get_catalog
 
+@http_handler('GET', allow_headers='Content-Type, If-None-Match')
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
-    Business: Получение списка доступных моделей GPTunnel
+    Business: Получение списка доступных моделей GPTunnel из каталога контейнера
+              (таблица model_catalog, фоновое обновление из GPTunnel)
     Args: event с httpMethod
           context с request_id
-    Returns: HTTP response со списком моделей
+    Returns: HTTP response со списком моделей в формате OpenAI
     '''
-    method: str = event.get('httpMethod', 'GET')
-    
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
-    
-    if method != 'GET':
-        return {
-            'statusCode': 405,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Method not allowed'}),
-            'isBase64Encoded': False
-        }
-    
     database_url = os.environ.get('DATABASE_URL')
     if not database_url:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Database not configured'}),
-            'isBase64Encoded': False
-        }
-    
-    try:
-        conn = psycopg2.connect(database_url)
-        cursor = conn.cursor()
-        cursor.execute("SELECT secret_value FROM secrets WHERE secret_name = 'GPTUNNEL_API_KEY' LIMIT 1")
-        result = cursor.fetchone()
-        cursor.close()
-        conn.close()
-        
-        if not result or not result[0]:
-            return {
-                'statusCode': 500,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'GPTUNNEL_API_KEY не настроен'}),
-                'isBase64Encoded': False
-            }
-        
-        gptunnel_api_key = result[0]
-    except Exception as e:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': f'Ошибка загрузки ключа: {str(e)}'}),
-            'isBase64Encoded': False
-        }
-    
-    gptunnel_api_key_env = os.environ.get('GPTUNNEL_API_KEY')
-    if gptunnel_api_key_env:
-        gptunnel_api_key = gptunnel_api_key_env
+        return error_response(500, 'Database not configured')
     
     try:
-        response = requests.get(
-            'https://gptunnel.ru/v1/models',
-            headers={'Authorization': f'Bearer {gptunnel_api_key}'},
-            timeout=30
-        )
-        
-        return {
-            'statusCode': response.status_code,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': response.text,
-            'isBase64Encoded': False
-        }
-        
-    except requests.RequestException as e:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': f'Ошибка GPTunnel API: {str(e)}'}),
-            'isBase64Encoded': False
-        }
+        return get_catalog(database_url).response(event)
+    except LookupError as e:
+        return error_response(500, str(e))
+    except urllib.error.HTTPError as e:
+        return raw_response(e.code, e.read().decode('utf-8', 'replace'))
+    except urllib.error.URLError as e:
+        return error_response(500, f'Ошибка GPTunnel API: {str(e.reason)}')
     except Exception as e:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': str(e)}),
-            'isBase64Encoded': False
-        }
\ No newline at end of file
+        return error_response(500, str(e))
@@ -1,174 +1,311 @@
+import hashlib
 import json
 import os
-from typing import Dict, Any
-import requests
-import psycopg2
+import re
 import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional, Pattern, Tuple
+import requests
+from runtime import http_handler, http_session, authenticate_client, raw_response, json_response, error_response, gptunnel_url, json_dumps, db_cursor
+
+DEFAULT_MODEL = 'text-moderation-latest'
+
+# Размер пачки к GPTunnel: не больше 32 текстов и ~16 тыс. символов, пачки уходят параллельно
+MODERATION_BATCH_SIZE = 32
+MODERATION_BATCH_CHARS = 16000
+
+VERDICT_CACHE_MAX_ITEMS = 4096
+VERDICT_TTL_DAYS = 30
+
+# Текст без букв (цифры, знаки, эмодзи) пропускается без GPTunnel всегда; короткий текст —
+# только если задан MODERATION_TRIVIAL_MAX_LENGTH: даже три буквы бывают оскорблением
+NO_LETTERS_PATTERN = re.compile(r'^[\W\d_]*$')
+
+# Категории ответа /v1/moderations: локальный вердикт отдаёт полную карту, как и GPTunnel
+MODERATION_CATEGORIES = (
+    'harassment', 'harassment/threatening', 'hate', 'hate/threatening', 'illicit', 'illicit/violent',
+    'self-harm', 'self-harm/intent', 'self-harm/instructions', 'sexual', 'sexual/minors',
+    'violence', 'violence/graphic'
+)
+
+_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='moderation-io')
+
+# sha256(модель + текст) -> (модель, элемент results); порядок вставки = порядок использования (LRU)
+_verdict_cache: Dict[str, Tuple[str, Dict[str, Any]]] = {}
+
+# Исходная строка MODERATION_DENY_PATTERNS -> (общая регулярка, имя группы -> категория)
+_deny_filter: Optional[Tuple[str, Optional[Pattern], Dict[str, str]]] = None
+
+def deny_filter() -> Tuple[Optional[Pattern], Dict[str, str]]:
+    '''
+    Локальный запрещающий фильтр из MODERATION_DENY_PATTERNS — JSON {"категория": ["regex", ...]}.
+    Все шаблоны собраны в одну регулярку с именованной группой на категорию: текст проверяется за один проход.
+    '''
+    global _deny_filter
+    raw = os.environ.get('MODERATION_DENY_PATTERNS', '')
+    if _deny_filter is None or _deny_filter[0] != raw:
+        pattern, groups = None, {}
+        try:
+            config = json.loads(raw) if raw else {}
+            parts = []
+            for index, (category, patterns) in enumerate(config.items()):
+                patterns = [patterns] if isinstance(patterns, str) else patterns
+                if patterns:
+                    groups[f'c{index}'] = category
+                    parts.append(f'(?P<c{index}>{"|".join(f"(?:{p})" for p in patterns)})')
+            pattern = re.compile('|'.join(parts), re.IGNORECASE) if parts else None
+        except (ValueError, AttributeError, re.error) as e:
+            print(f"[MODERATION] MODERATION_DENY_PATTERNS ignored: {str(e)}")
+            pattern, groups = None, {}
+        _deny_filter = (raw, pattern, groups)
+    return _deny_filter[1], _deny_filter[2]
+
+def trivial_max_length() -> int:
+    try:
+        return max(int(os.environ.get('MODERATION_TRIVIAL_MAX_LENGTH', '0')), 0)
+    except ValueError:
+        return 0
+
+def local_verdict(category: Optional[str] = None) -> Dict[str, Any]:
+    categories = {name: False for name in MODERATION_CATEGORIES}
+    scores = {name: 0.0 for name in MODERATION_CATEGORIES}
+    if category:
+        categories[category] = True
+        scores[category] = 1.0
+    return {'flagged': category is not None, 'categories': categories, 'category_scores': scores}
+
+def prefilter(text: str, pattern: Optional[Pattern], groups: Dict[str, str]) -> Optional[Dict[str, Any]]:
+    '''
+    Вердикт без GPTunnel для очевидных случаев; None — текст нужно отправить на модерацию
+    '''
+    if pattern is not None:
+        match = pattern.search(text)
+        if match:
+            return local_verdict(groups[match.lastgroup])
+    stripped = text.strip()
+    if NO_LETTERS_PATTERN.match(stripped) or len(stripped) <= trivial_max_length():
+        return local_verdict()
+    return None
+
+def verdict_key(model: str, text: str) -> str:
+    return hashlib.sha256(f'{model}\0{text}'.encode('utf-8')).hexdigest()
+
+def cached_verdict(key: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+    entry = _verdict_cache.pop(key, None)
+    if entry is not None:
+        _verdict_cache[key] = entry
+    return entry
+
+def cache_verdict(key: str, model: str, result: Dict[str, Any]) -> None:
+    if len(_verdict_cache) >= VERDICT_CACHE_MAX_ITEMS:
+        _verdict_cache.pop(next(iter(_verdict_cache)), None)
+    _verdict_cache[key] = (model, result)
+
+def split_batches(texts: List[str]) -> List[List[str]]:
+    batches: List[List[str]] = []
+    batch: List[str] = []
+    chars = 0
+    for text in texts:
+        if batch and (len(batch) >= MODERATION_BATCH_SIZE or chars + len(text) > MODERATION_BATCH_CHARS):
+            batches.append(batch)
+            batch, chars = [], 0
+        batch.append(text)
+        chars += len(text)
+    if batch:
+        batches.append(batch)
+    return batches
+
+def moderate_upstream(api_key: str, body: Dict[str, Any]) -> requests.Response:
+    return http_session().post(
+        gptunnel_url('/v1/moderations'),
+        headers={
+            'Authorization': f'Bearer {api_key}',
+            'Content-Type': 'application/json'
+        },
+        json=body,
+        timeout=30
+    )
+
+ACCOUNTING_SQL = '''
+    INSERT INTO api_requests (endpoint, method, status_code, latency_ms, model)
+    VALUES ('/v1/moderations', 'POST', %(status)s, %(latency_ms)s, %(model)s);
+
+    INSERT INTO usage_stats (endpoint, model, request_count, total_cost)
+    VALUES ('/v1/moderations', %(model)s, 1, %(total_cost)s)
+    ON CONFLICT (endpoint, model, COALESCE(assistant_id, ''), date)
+    DO UPDATE SET
+        request_count = usage_stats.request_count + 1,
+        total_cost = usage_stats.total_cost + EXCLUDED.total_cost,
+        updated_at = CURRENT_TIMESTAMP
+'''
+
+SAVE_VERDICTS_SQL = '''
+    INSERT INTO moderation_verdicts (text_hash, model, result, expires_at)
+    SELECT text_hash, %(model)s, result, CURRENT_TIMESTAMP + %(ttl_days)s * INTERVAL '1 day'
+    FROM unnest(%(hashes)s::varchar[], %(results)s::jsonb[]) AS v(text_hash, result)
+    ON CONFLICT (text_hash) DO NOTHING
+'''
 
+def record_request(
+    database_url: str, status: int, latency_ms: int, model: str, total_cost: float,
+    verdicts: Optional[Dict[str, Dict[str, Any]]] = None
+) -> None:
+    '''
+    Учёт запроса и сохранение новых вердиктов одним round trip
+    '''
+    sql = ACCOUNTING_SQL
+    params: Dict[str, Any] = {'status': status, 'latency_ms': latency_ms, 'model': model, 'total_cost': total_cost}
+    if verdicts:
+        sql += ';' + SAVE_VERDICTS_SQL
+        params.update({
+            'hashes': list(verdicts),
+            'results': [json_dumps(result) for result in verdicts.values()],
+            'ttl_days': VERDICT_TTL_DAYS
+        })
+    try:
+        with db_cursor(database_url) as cursor:
+            cursor.execute(sql, params)
+    except Exception as e:
+        print(f"[MODERATION] Failed to record request: {str(e)}")
+
+@http_handler('POST')
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
-    Business: Модерация контента через GPTunnel
-    Args: event с httpMethod, body
+    Business: Модерация контента через GPTunnel с локальным фильтром, кэшем вердиктов
+              и параллельной отправкой больших input пачками
+    Args: event с httpMethod, body {input: строка или массив строк, model}
           context с request_id
-    Returns: HTTP response с результатом модерации
+    Returns: HTTP response с результатом модерации в формате OpenAI
     '''
-    method: str = event.get('httpMethod', 'POST')
-    
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
-    
-    if method != 'POST':
-        return {
-            'statusCode': 405,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Method not allowed'}),
-            'isBase64Encoded': False
-        }
-    
     database_url = os.environ.get('DATABASE_URL')
     if not database_url:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Database not configured'}),
-            'isBase64Encoded': False
-        }
-    
-    auth_header = event.get('headers', {}).get('authorization', '')
-    if not auth_header.startswith('Bearer '):
-        return {
-            'statusCode': 401,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Missing or invalid authorization header'}),
-            'isBase64Encoded': False
-        }
+        return error_response(500, 'Database not configured')
     
-    client_api_key = auth_header[7:]
-    
-    try:
-        import hashlib
-        
-        # Hash the provided key to compare with stored hash
-        key_hash = hashlib.sha256(client_api_key.encode()).hexdigest()
-        
-        conn = psycopg2.connect(database_url)
-        cursor = conn.cursor()
-        cursor.execute('SELECT active FROM api_keys WHERE key_hash = %s', (key_hash,))
-        result = cursor.fetchone()
-        cursor.close()
-        conn.close()
-        
-        if not result:
-            return {
-                'statusCode': 401,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Invalid API key'}),
-                'isBase64Encoded': False
-            }
-        
-        if not result[0]:
-            return {
-                'statusCode': 403,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'API key is disabled'}),
-                'isBase64Encoded': False
-            }
-    except Exception as e:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': f'Authentication error: {str(e)}'}),
-            'isBase64Encoded': False
-        }
+    auth_error = authenticate_client(event, database_url)
+    if auth_error:
+        return auth_error
     
     gptunnel_api_key = os.environ.get('GPTUNNEL_API_KEY')
     if not gptunnel_api_key:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'GPTunnel API не настроен'}),
-            'isBase64Encoded': False
-        }
+        return error_response(500, 'GPTunnel API не настроен')
     
     try:
         body_data = json.loads(event.get('body', '{}'))
-        model = 'text-moderation-latest'
+        requested_model = body_data.get('model') or ''
+        raw_input = body_data.get('input', '')
+        texts = raw_input if isinstance(raw_input, list) else [raw_input]
         
         start_time = time.time()
-        response = requests.post(
-            'https://gptunnel.ru/v1/moderations',
-            headers={
-                'Authorization': f'Bearer {gptunnel_api_key}',
-                'Content-Type': 'application/json'
-            },
-            json=body_data,
-            timeout=30
-        )
-        latency_ms = int((time.time() - start_time) * 1000)
         
+        # Мультимодальный input (картинки) не кэшируется и уходит в GPTunnel как есть
+        if not all(isinstance(text, str) for text in texts):
+            response = moderate_upstream(gptunnel_api_key, body_data)
+            model = DEFAULT_MODEL
+            total_cost = 0.0
+            if response.status_code == 200:
+                try:
+                    response_json = response.json()
+                    model = response_json.get('model') or requested_model or DEFAULT_MODEL
+                    total_cost = response_json.get('usage', {}).get('total_cost', 0.0)
+                except ValueError:
+                    pass
+            record_request(database_url, response.status_code, int((time.time() - start_time) * 1000), model, total_cost)
+            return raw_response(response.status_code, response.text)
+        
+        pattern, groups = deny_filter()
+        results: List[Optional[Dict[str, Any]]] = [None] * len(texts)
+        keys = [verdict_key(requested_model, text) for text in texts]
+        response_model = requested_model or None
+        pending: Dict[str, List[int]] = {}
+        prefiltered = 0
+        
+        for index, text in enumerate(texts):
+            local = prefilter(text, pattern, groups)
+            if local is not None:
+                results[index] = local
+                prefiltered += 1
+                continue
+            cached = cached_verdict(keys[index])
+            if cached is not None:
+                response_model = response_model or cached[0]
+                results[index] = cached[1]
+                continue
+            pending.setdefault(keys[index], []).append(index)
+        
+        memory_hits = len(texts) - prefiltered - sum(len(indexes) for indexes in pending.values())
+        db_hits = 0
+        
+        if pending:
+            with db_cursor(database_url) as cursor:
+                cursor.execute(
+                    'SELECT text_hash, model, result FROM moderation_verdicts WHERE text_hash = ANY(%s) AND expires_at > CURRENT_TIMESTAMP',
+                    (list(pending),)
+                )
+                stored = cursor.fetchall()
+            for text_hash, model, result in stored:
+                cache_verdict(text_hash, model, result)
+                response_model = response_model or model
+                for index in pending.pop(text_hash):
+                    results[index] = result
+                    db_hits += 1
+        
+        new_verdicts: Dict[str, Dict[str, Any]] = {}
         total_cost = 0.0
+        upstream_id = None
         
-        if response.status_code == 200:
-            try:
+        if pending:
+            unique_texts = [texts[indexes[0]] for indexes in pending.values()]
+            batches = split_batches(unique_texts)
+            
+            def send(batch: List[str]) -> requests.Response:
+                batch_body = {'input': batch}
+                if requested_model:
+                    batch_body['model'] = requested_model
+                return moderate_upstream(gptunnel_api_key, batch_body)
+            
+            if len(batches) == 1:
+                responses = [send(batches[0])]
+            else:
+                responses = list(_executor.map(send, batches))
+            
+            failed = next((r for r in responses if r.status_code != 200), None)
+            if failed is not None:
+                record_request(database_url, failed.status_code, int((time.time() - start_time) * 1000), requested_model or DEFAULT_MODEL, 0.0)
+                return raw_response(failed.status_code, failed.text)
+            
+            upstream_results: List[Dict[str, Any]] = []
+            for response in responses:
                 response_json = response.json()
-                usage = response_json.get('usage', {})
-                total_cost = usage.get('total_cost', 0.0)
-            except:
-                pass
-        
-        if database_url:
-            try:
-                conn = psycopg2.connect(database_url)
-                cursor = conn.cursor()
-                cursor.execute('''
-                    INSERT INTO api_requests (endpoint, method, status_code, latency_ms, model)
-                    VALUES (%s, %s, %s, %s, %s)
-                ''', ('/v1/moderations', 'POST', response.status_code, latency_ms, model))
-                
-                cursor.execute('''
-                    INSERT INTO usage_stats (endpoint, model, request_count, total_cost)
-                    VALUES (%s, %s, 1, %s)
-                    ON CONFLICT (endpoint, model, date) 
-                    DO UPDATE SET 
-                        request_count = usage_stats.request_count + 1,
-                        total_cost = usage_stats.total_cost + EXCLUDED.total_cost,
-                        updated_at = CURRENT_TIMESTAMP
-                ''', ('/v1/moderations', model, total_cost))
-                
-                conn.commit()
-                cursor.close()
-                conn.close()
-            except:
-                pass
+                upstream_results.extend(response_json.get('results', []))
+                total_cost += response_json.get('usage', {}).get('total_cost', 0.0) or 0.0
+                response_model = response_model or response_json.get('model')
+                upstream_id = upstream_id or response_json.get('id')
+            
+            if len(upstream_results) != len(unique_texts):
+                return error_response(502, 'GPTunnel returned unexpected number of moderation results')
+            
+            for text_hash, result in zip(pending, upstream_results):
+                cache_verdict(text_hash, response_model or DEFAULT_MODEL, result)
+                new_verdicts[text_hash] = result
+                for index in pending[text_hash]:
+                    results[index] = result
         
-        return {
-            'statusCode': response.status_code,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': response.text,
-            'isBase64Encoded': False
-        }
+        model = response_model or DEFAULT_MODEL
+        latency_ms = int((time.time() - start_time) * 1000)
+        print(
+            f"[MODERATION] inputs={len(texts)}, prefiltered={prefiltered}, memory_hits={memory_hits}, "
+            f"db_hits={db_hits}, upstream={len(new_verdicts)}, latency={latency_ms}ms"
+        )
+        record_request(database_url, 200, latency_ms, model, total_cost, new_verdicts)
         
+        return json_response(200, {
+            'id': upstream_id or f'modr-{uuid.uuid4().hex}',
+            'model': model,
+            'results': results
+        })
+    
     except requests.RequestException as e:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': f'Ошибка GPTunnel API: {str(e)}'}),
-            'isBase64Encoded': False
-        }
+        return error_response(500, f'Ошибка GPTunnel API: {str(e)}')
     except Exception as e:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': str(e)}),
-            'isBase64Encoded': False
-        }
\ No newline at end of file
+        return error_response(500, str(e))
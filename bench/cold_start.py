@@ -0,0 +1,123 @@
+'''
+Замер холодного старта облачных функций: время импорта index.py каждой функции
+в чистом интерпретаторе (медиана по нескольким запускам) и проверка того,
+что копии общих модулей (runtime.py, routing.py, model_catalog.py, rag_index.py, rag_lexical.py) в каталогах backend/ совпадают.
+
+Запуск: python bench/cold_start.py [--runs 7] [--top 5] [функция ...]
+'''
+import argparse
+import hashlib
+import os
+import statistics
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACKEND_DIR = os.path.join(ROOT, 'backend')
+
+IMPORT_SNIPPET = (
+    'import time; started = time.perf_counter(); import index; '
+    'print(int((time.perf_counter() - started) * 1_000_000))'
+)
+
+def list_functions() -> List[str]:
+    return sorted(
+        name for name in os.listdir(BACKEND_DIR)
+        if os.path.isfile(os.path.join(BACKEND_DIR, name, 'index.py'))
+    )
+
+# Общие модули, которые лежат копиями в каталогах функций: runtime.py нужен каждой функции,
+# остальные — только тем, кто их использует, но копии должны совпадать
+SHARED_MODULES = (('runtime.py', True), ('routing.py', False), ('model_catalog.py', False), ('rag_index.py', False), ('rag_lexical.py', False))
+
+def check_runtime_copies(functions: List[str]) -> List[str]:
+    '''
+    Возвращает список проблем: отсутствующие или расходящиеся копии общих модулей
+    '''
+    problems = []
+    for module, required in SHARED_MODULES:
+        digests: Dict[str, List[str]] = {}
+        for name in functions:
+            path = os.path.join(BACKEND_DIR, name, module)
+            if not os.path.exists(path):
+                if required:
+                    problems.append(f'{name}: {module} отсутствует')
+                continue
+            with open(path, 'rb') as f:
+                digests.setdefault(hashlib.md5(f.read()).hexdigest(), []).append(name)
+        if len(digests) > 1:
+            for digest, names in sorted(digests.items(), key=lambda item: -len(item[1])):
+                problems.append(f'{module} {digest[:8]}: {", ".join(names)}')
+    return problems
+
+def measure_import(name: str, runs: int) -> List[int]:
+    cwd = os.path.join(BACKEND_DIR, name)
+    env = {**os.environ, 'PYTHONDONTWRITEBYTECODE': '1'}
+    samples = []
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, '-c', IMPORT_SNIPPET],
+            cwd=cwd, env=env, capture_output=True, text=True
+        )
+        if result.returncode != 0:
+            raise RuntimeError(f'{name}: {result.stderr.strip().splitlines()[-1]}')
+        samples.append(int(result.stdout.strip().splitlines()[-1]))
+    return samples
+
+def top_imports(name: str, top: int) -> List[Tuple[int, str]]:
+    '''
+    Самые тяжёлые модули по -X importtime (кумулятивное время, мкс)
+    '''
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import index'],
+        cwd=os.path.join(BACKEND_DIR, name), capture_output=True, text=True
+    )
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, module = line[len('import time:'):].split('|')
+        if not cumulative.strip().isdigit():
+            continue
+        # Отступ в -X importtime — глубина вложенности: берём index и его прямые импорты
+        depth = (len(module) - len(module.lstrip()) - 1) // 2
+        module = module.strip()
+        if depth > 1 or module == 'site':
+            continue
+        rows.append((int(cumulative), module))
+    return sorted(rows, reverse=True)[:top]
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Время импорта облачных функций')
+    parser.add_argument('functions', nargs='*', help='имена каталогов в backend/ (по умолчанию все)')
+    parser.add_argument('--runs', type=int, default=7)
+    parser.add_argument('--top', type=int, default=0, help='показать N самых тяжёлых импортов')
+    args = parser.parse_args()
+
+    functions = args.functions or list_functions()
+
+    problems = check_runtime_copies(list_functions())
+    for problem in problems:
+        print(f'[runtime] {problem}')
+
+    print(f'{"function":<24}{"median ms":>10}{"min ms":>10}{"max ms":>10}')
+    failed = False
+    for name in functions:
+        try:
+            samples = measure_import(name, args.runs)
+        except RuntimeError as e:
+            print(f'{name:<24} ошибка импорта: {e}')
+            failed = True
+            continue
+        print(
+            f'{name:<24}{statistics.median(samples) / 1000:>10.1f}'
+            f'{min(samples) / 1000:>10.1f}{max(samples) / 1000:>10.1f}'
+        )
+        for cumulative, module in top_imports(name, args.top):
+            print(f'{"":<4}{module:<28}{cumulative / 1000:>8.1f} ms')
+
+    return 1 if problems or failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,367 @@
+'''
+Локальная заглушка GPTunnel и поиска QQRenta для нагрузочных прогонов.
+
+Отвечает на те же пути, что вызывают функции из backend/ (chat/completions, assistant/chat,
+embeddings, moderations, models, balance, database/*) и на любой путь, оканчивающийся на /search.
+Задержка, доля ошибок и стриминг (SSE при "stream": true) настраиваются.
+
+Запуск отдельно: python bench/fake_upstream.py --port 8765 --latency-ms 150 --error-rate 0.01
+Затем GPTUNNEL_BASE_URL=http://127.0.0.1:8765 для функций.
+'''
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+EMBEDDING_DIM = 16
+
+class UpstreamConfig:
+    '''
+    Поведение заглушки; поля можно менять на лету между прогонами
+    '''
+    def __init__(
+        self,
+        latency_ms: float = 0.0,
+        jitter_ms: float = 0.0,
+        error_rate: float = 0.0,
+        error_status: int = 503,
+        route_latency_ms: Optional[Dict[str, float]] = None,
+        stream_chunks: int = 8,
+        stream_chunk_delay_ms: float = 5.0,
+        search_results: int = 40,
+        failing_models: Optional[List[str]] = None,
+        seed: Optional[int] = None
+    ):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.route_latency_ms = route_latency_ms or {}
+        self.stream_chunks = stream_chunks
+        self.stream_chunk_delay_ms = stream_chunk_delay_ms
+        self.search_results = search_results
+        # Модели, на которые chat/completions всегда отвечает error_status (проверка failover)
+        self.failing_models = set(failing_models or [])
+        self.random = random.Random(seed)
+
+class UpstreamStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls: Dict[str, int] = {}
+        self.errors = 0
+        self.connections = 0
+
+    def record(self, route: str, injected_error: bool) -> None:
+        with self.lock:
+            self.calls[route] = self.calls.get(route, 0) + 1
+            if injected_error:
+                self.errors += 1
+
+    def record_connection(self) -> None:
+        with self.lock:
+            self.connections += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self.lock:
+            return {'calls': dict(self.calls), 'injected_errors': self.errors, 'connections': self.connections}
+
+    def reset(self) -> None:
+        with self.lock:
+            self.calls.clear()
+            self.errors = 0
+            self.connections = 0
+
+def words(text: Any) -> int:
+    return len(str(text).split())
+
+def usage(prompt_tokens: int, completion_tokens: int) -> Dict[str, Any]:
+    total = prompt_tokens + completion_tokens
+    return {
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': completion_tokens,
+        'total_tokens': total,
+        'total_cost': round(total * 0.00002, 6)
+    }
+
+def default_search_args() -> Dict[str, Any]:
+    checkin = date.today() + timedelta(days=14)
+    return {'city': 'Москва', 'checkin': checkin.isoformat(), 'nights': 2, 'guests': 2}
+
+def chat_completion(payload: Dict[str, Any]) -> Dict[str, Any]:
+    messages = payload.get('messages') or []
+    prompt_tokens = sum(words(m.get('content', '')) for m in messages)
+    model = payload.get('model', 'gpt-4o-mini')
+    has_tool_result = any(m.get('role') == 'tool' for m in messages)
+
+    if payload.get('tools') and not has_tool_result:
+        tool = payload['tools'][0]['function']['name']
+        message = {
+            'role': 'assistant',
+            'content': None,
+            'tool_calls': [{
+                'id': 'call_fake',
+                'type': 'function',
+                'function': {'name': tool, 'arguments': json.dumps(default_search_args(), ensure_ascii=False)}
+            }]
+        }
+        completion_tokens = 24
+    else:
+        last_user = next((m.get('content', '') for m in reversed(messages) if m.get('role') == 'user'), '')
+        content = f'Ответ заглушки на: {str(last_user)[:80]}'
+        message = {'role': 'assistant', 'content': content}
+        completion_tokens = words(content)
+
+    return {
+        'id': 'chatcmpl-fake',
+        'object': 'chat.completion',
+        'model': model,
+        'choices': [{'index': 0, 'message': message, 'finish_reason': 'stop'}],
+        'usage': usage(prompt_tokens, completion_tokens)
+    }
+
+def assistant_chat(payload: Dict[str, Any]) -> Dict[str, Any]:
+    message = str(payload.get('message', ''))
+    content = f'Ответ внешнего ассистента на: {message[:80]}'
+    prompt_tokens = words(message)
+    return {
+        'id': payload.get('chatId'),
+        'message': content,
+        'model': 'gpt-4o-mini',
+        'spendTokenCount': prompt_tokens + words(content),
+        'usage': usage(prompt_tokens, words(content))
+    }
+
+def as_list(value: Any) -> List[Any]:
+    return value if isinstance(value, list) else [value]
+
+def embeddings(payload: Dict[str, Any]) -> Dict[str, Any]:
+    inputs = as_list(payload.get('input', ''))
+    data = []
+    for index, text in enumerate(inputs):
+        rnd = random.Random(str(text))
+        data.append({'object': 'embedding', 'index': index, 'embedding': [rnd.uniform(-1, 1) for _ in range(EMBEDDING_DIM)]})
+    prompt_tokens = sum(words(text) for text in inputs)
+    return {
+        'object': 'list',
+        'model': payload.get('model', 'text-embedding-3-small'),
+        'data': data,
+        'usage': {'prompt_tokens': prompt_tokens, 'total_tokens': prompt_tokens, 'total_cost': 0.0}
+    }
+
+def moderations(payload: Dict[str, Any]) -> Dict[str, Any]:
+    inputs = as_list(payload.get('input', ''))
+    results = []
+    for text in inputs:
+        flagged = 'запрещ' in str(text).lower()
+        results.append({
+            'flagged': flagged,
+            'categories': {'harassment': flagged, 'violence': False},
+            'category_scores': {'harassment': 0.97 if flagged else 0.01, 'violence': 0.0}
+        })
+    return {
+        'id': 'modr-fake',
+        'model': 'omni-moderation-latest',
+        'results': results,
+        'usage': {'total_tokens': sum(words(text) for text in inputs), 'total_cost': 0.0}
+    }
+
+MODELS = ['gpt-4o', 'gpt-4o-mini', 'claude-3-haiku', 'text-embedding-3-small', 'omni-moderation-latest']
+
+def search_results(query: Dict[str, List[str]], count: int) -> Dict[str, Any]:
+    city = (query.get('city') or ['Москва'])[0]
+    rnd = random.Random(city)
+    categories = ['Квартира', 'Апартаменты', 'Гостиница', 'Хостел', 'Дом']
+    results = []
+    for i in range(count):
+        prefix = 'hotel' if i % 3 == 0 else 'flat'
+        results.append({
+            'id': f'{prefix}-{10000 + i}',
+            'title': f'Объект {i} в городе {city}',
+            'category': categories[i % len(categories)],
+            'price': rnd.randint(1500, 15000),
+            'external_reviews_rating': round(rnd.uniform(3.5, 5.0), 1),
+            'reviews_count': rnd.randint(0, 400),
+            'latitude': round(55.75 + rnd.uniform(-0.12, 0.12), 6),
+            'longitude': round(37.62 + rnd.uniform(-0.2, 0.2), 6),
+            'guests': rnd.randint(1, 8),
+            'preview_img': f'https://img.example/{prefix}-{10000 + i}.jpg'
+        })
+    return {'results': results, 'total': count}
+
+class UpstreamHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Заголовки и тело пишутся отдельно: без TCP_NODELAY keep-alive ответы ждут delayed ACK (~40 мс)
+    disable_nagle_algorithm = True
+    server: 'FakeUpstream'
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def setup(self) -> None:
+        super().setup()
+        self.server.stats.record_connection()
+
+    def do_GET(self) -> None:
+        self.dispatch('GET')
+
+    def do_POST(self) -> None:
+        self.dispatch('POST')
+
+    def read_json(self) -> Dict[str, Any]:
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return {}
+        try:
+            return json.loads(self.rfile.read(length))
+        except ValueError:
+            return {}
+
+    def send_json(self, status: int, data: Any) -> None:
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_stream(self, completion: Dict[str, Any]) -> None:
+        config = self.server.config
+        content = completion['choices'][0]['message'].get('content') or ''
+        step = max(1, len(content) // max(1, config.stream_chunks))
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for start in range(0, len(content), step):
+            chunk = {'model': completion['model'], 'choices': [{'index': 0, 'delta': {'content': content[start:start + step]}}]}
+            self.write_chunk(f'data: {json.dumps(chunk, ensure_ascii=False)}\n\n')
+            time.sleep(config.stream_chunk_delay_ms / 1000)
+        final = {'model': completion['model'], 'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}], 'usage': completion['usage']}
+        self.write_chunk(f'data: {json.dumps(final, ensure_ascii=False)}\n\n')
+        self.write_chunk('data: [DONE]\n\n')
+        self.wfile.write(b'0\r\n\r\n')
+
+    def write_chunk(self, text: str) -> None:
+        data = text.encode('utf-8')
+        self.wfile.write(f'{len(data):x}\r\n'.encode('ascii') + data + b'\r\n')
+        self.wfile.flush()
+
+    def route(self, method: str, path: str, query: Dict[str, List[str]], payload: Dict[str, Any]) -> Tuple[int, Any]:
+        if path.endswith('/search'):
+            return 200, search_results(query, self.server.config.search_results)
+        if method == 'POST' and path == '/v1/chat/completions':
+            return 200, chat_completion(payload)
+        if method == 'POST' and path == '/v1/assistant/chat':
+            return 200, assistant_chat(payload)
+        if method == 'POST' and path == '/v1/embeddings':
+            return 200, embeddings(payload)
+        if method == 'POST' and path == '/v1/moderations':
+            return 200, moderations(payload)
+        if method == 'GET' and path == '/v1/models':
+            return 200, {'object': 'list', 'data': [{'id': m, 'object': 'model', 'owned_by': 'gptunnel'} for m in MODELS]}
+        if method == 'GET' and path == '/v1/balance':
+            return 200, {'balance': 1000.0}
+        if method == 'GET' and path == '/v1/database/list':
+            return 200, {'data': [{'id': f'db_{i}', 'name': f'База {i}'} for i in range(3)]}
+        if method == 'GET' and path == '/v1/database/file/list':
+            database_id = (query.get('databaseId') or [''])[0]
+            return 200, {'data': [{'id': f'{database_id}_file_{i}', 'name': f'Файл {i}', 'status': 'ready'} for i in range(5)]}
+        if method == 'POST' and path == '/v1/database/file/add':
+            file_id = f"{payload.get('databaseId')}_file_{uuid.uuid4().hex[:12]}"
+            return 200, {'id': file_id, 'name': payload.get('name'), 'status': 'processing'}
+        if method == 'POST' and path == '/v1/database/file/delete':
+            return 200, {'success': True}
+        return 404, {'error': f'Unknown route {method} {path}'}
+
+    def dispatch(self, method: str) -> None:
+        config = self.server.config
+        parsed = urlparse(self.path)
+        path = parsed.path.rstrip('/') or '/'
+        route_key = '/search' if path.endswith('/search') else path
+        payload = self.read_json() if method == 'POST' else {}
+
+        delay = config.route_latency_ms.get(route_key, config.latency_ms)
+        if config.jitter_ms:
+            delay += config.random.uniform(0, config.jitter_ms)
+        if delay:
+            time.sleep(delay / 1000)
+
+        injected_error = config.error_rate > 0 and config.random.random() < config.error_rate
+        if route_key == '/v1/chat/completions' and payload.get('model') in config.failing_models:
+            injected_error = True
+        self.server.stats.record(route_key, injected_error)
+        if injected_error:
+            self.send_json(config.error_status, {'error': {'message': 'Injected upstream error', 'code': config.error_status}})
+            return
+
+        status, data = self.route(method, path, parse_qs(parsed.query), payload)
+        if status == 200 and path == '/v1/chat/completions' and payload.get('stream'):
+            self.send_stream(data)
+            return
+        self.send_json(status, data)
+
+class FakeUpstream(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, config: Optional[UpstreamConfig] = None):
+        super().__init__((host, port), UpstreamHandler)
+        self.config = config or UpstreamConfig()
+        self.stats = UpstreamStats()
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self) -> 'FakeUpstream':
+        self.thread = threading.Thread(target=self.serve_forever, name='fake-upstream', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+def parse_route_latency(values: List[str]) -> Dict[str, float]:
+    result = {}
+    for value in values:
+        route, _, ms = value.partition('=')
+        result[route] = float(ms)
+    return result
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Заглушка GPTunnel/QQRenta')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency-ms', type=float, default=0.0)
+    parser.add_argument('--jitter-ms', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--error-status', type=int, default=503)
+    parser.add_argument('--route-latency', action='append', default=[], metavar='PATH=MS')
+    parser.add_argument('--failing-model', action='append', default=[], metavar='MODEL')
+    args = parser.parse_args()
+
+    config = UpstreamConfig(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        route_latency_ms=parse_route_latency(args.route_latency),
+        failing_models=args.failing_model
+    )
+    server = FakeUpstream(args.host, args.port, config)
+    print(f'Fake upstream on {server.base_url}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
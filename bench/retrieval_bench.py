@@ -0,0 +1,206 @@
+'''
+Замер локального векторного поиска (backend/gptunnel-bot/rag_index.py) на синтетических данных:
+время построения индекса, размер на диске, recall@k относительно точного перебора и QPS
+одного потока для нескольких nprobe. Векторы — кластеры вокруг случайных центров на сфере,
+запросы — зашумлённые точки из набора, как у реальных вопросов к базе знаний.
+
+С --hybrid замеряется гибридный поиск (векторы + BM25 из rag_lexical.py, слияние RRF) на синтетических
+русских текстах: у каждого документа тема (её ловят эмбеддинги) и адрес с ценой (их ловит только
+лексический поиск). Два набора запросов: «точные» — адрес и цена документа с другими формами слов,
+вектор запроса знает только тему; «смысловые» — близкий к документу вектор и текст без общих с ним
+слов. Печатается hit@k для векторного, лексического и гибридного поиска и задержки.
+
+BLAS ограничивается одним потоком: функция работает на одном CPU.
+
+Запуск:
+    python bench/retrieval_bench.py                       # 1M чанков, dim 256
+    python bench/retrieval_bench.py --count 200000 --dim 384 --nprobe 8,16,32 --queries 500
+    python bench/retrieval_bench.py --hybrid --count 100000
+'''
+import os
+
+for _var in ('OPENBLAS_NUM_THREADS', 'OMP_NUM_THREADS', 'MKL_NUM_THREADS'):
+    os.environ.setdefault(_var, '1')
+
+import argparse
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'backend', 'gptunnel-bot'))
+from rag_index import VectorIndex, build_index, normalize, RAG_CANDIDATES
+from rag_lexical import terms, rrf
+
+def synthetic_vectors(count: int, dim: int, clusters: int, noise: float, rng: np.random.Generator) -> np.ndarray:
+    centers = normalize(rng.standard_normal((clusters, dim)).astype(np.float32))
+    vectors = np.empty((count, dim), dtype=np.float32)
+    step = 100000
+    for start in range(0, count, step):
+        size = min(step, count - start)
+        labels = rng.integers(0, clusters, size)
+        vectors[start:start + size] = centers[labels] + noise * rng.standard_normal((size, dim)).astype(np.float32) / np.sqrt(dim)
+    return normalize(vectors)
+
+def exact_top_k(vectors: np.ndarray, queries: np.ndarray, k: int) -> np.ndarray:
+    result = np.empty((len(queries), k), dtype=np.int64)
+    for i, query in enumerate(queries):
+        scores = vectors @ query
+        top = np.argpartition(-scores, k - 1)[:k]
+        result[i] = top[np.argsort(-scores[top])]
+    return result
+
+def directory_size(path: str) -> int:
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+SYLLABLES = ('ка', 'ро', 'ме', 'ти', 'на', 'во', 'ле', 'су', 'да', 'ми', 'зо', 'пе', 'ры', 'ла', 'ку', 'не', 'то', 'ва')
+NOUN_ENDINGS = ('а', 'ы', 'е', 'у', 'ой', 'ами', 'ах')
+ADJ_ENDINGS = ('ый', 'ая', 'ое', 'ого', 'ому', 'ыми', 'ых')
+
+def synthetic_word(rng: np.random.Generator) -> str:
+    return ''.join(SYLLABLES[i] for i in rng.integers(0, len(SYLLABLES), rng.integers(2, 4))) + 'н'
+
+def inflect(stem: str, rng: np.random.Generator) -> str:
+    endings = ADJ_ENDINGS if stem.endswith('нн') else NOUN_ENDINGS
+    return stem + endings[rng.integers(0, len(endings))]
+
+def percentile(latencies: List[float], share: float) -> float:
+    return latencies[min(len(latencies) - 1, int(len(latencies) * share))]
+
+def hybrid_bench(args: argparse.Namespace) -> None:
+    rng = np.random.default_rng(args.seed)
+    topics = max(1, args.count // 500)
+    vocabulary = sorted({synthetic_word(rng) for _ in range(20000)})
+    streets = sorted({synthetic_word(rng).capitalize() for _ in range(2000)})
+    topic_words = [rng.choice(len(vocabulary), 40, replace=False) for _ in range(topics)]
+    centers = normalize(rng.standard_normal((topics, args.dim)).astype(np.float32))
+
+    started = time.perf_counter()
+    doc_topics = rng.integers(0, topics, args.count)
+    addresses = [(streets[rng.integers(0, len(streets))], int(rng.integers(1, 300)), int(rng.integers(1000, 100000))) for _ in range(args.count)]
+    texts = []
+    for doc in range(args.count):
+        words = [inflect(vocabulary[w], rng) for w in rng.choice(topic_words[doc_topics[doc]], 60)]
+        street, house, price = addresses[doc]
+        texts.append(' '.join(words[:30]) + f'. Адрес: улица {street}, дом {house}. Цена {price} руб. ' + ' '.join(words[30:]))
+    vectors = normalize(centers[doc_topics] + 0.3 * rng.standard_normal((args.count, args.dim)).astype(np.float32) / np.sqrt(args.dim))
+    print(f'data: {args.count} docs, {topics} topics, dim {args.dim} in {time.perf_counter() - started:.1f}s')
+
+    targets = rng.integers(0, args.count, args.queries)
+    exact = []
+    for doc in targets:
+        street, house, price = addresses[doc]
+        topic_word = inflect(vocabulary[topic_words[doc_topics[doc]][0]], rng)
+        query_vector = normalize(centers[doc_topics[doc]] + 0.3 * rng.standard_normal(args.dim).astype(np.float32) / np.sqrt(args.dim))
+        exact.append((f'{topic_word} на улице {street} {house}, за {price}', query_vector))
+    semantic = []
+    for doc in targets:
+        query_vector = normalize(vectors[doc] + 0.1 * rng.standard_normal(args.dim).astype(np.float32) / np.sqrt(args.dim))
+        semantic.append((' '.join(inflect(vocabulary[w], rng) for w in rng.choice(len(vocabulary), 4)), query_vector))
+
+    workdir = tempfile.mkdtemp(prefix='rag-bench-')
+    try:
+        path = os.path.join(workdir, 'index')
+        started = time.perf_counter()
+        build_index(path, np.arange(args.count), vectors, texts, {'databaseId': 'bench', 'version': '1'}, nlist=args.nlist)
+        build_s = time.perf_counter() - started
+        del texts
+        index = VectorIndex(path)
+        lexical_bytes = sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path) if name.startswith('lex_'))
+        print(
+            f'build: {build_s:.1f}s, {index.meta["lexicalTerms"]} terms, '
+            f'lexical index {lexical_bytes / 2**20:.1f} MiB, total {directory_size(path) / 2**20:.0f} MiB'
+        )
+        nprobe = int(args.nprobe.split(',')[0])
+        print(f'{"queries":>9} {"mode":>8} {"hit@" + str(args.k):>7} {"p50 ms":>8} {"p95 ms":>8}')
+        for name, queries in (('exact', exact), ('semantic', semantic)):
+            found = {'vector': 0, 'lexical': 0, 'hybrid': 0}
+            latencies: Dict[str, List[float]] = {'vector': [], 'lexical': [], 'hybrid': []}
+            for (text, query_vector), doc in zip(queries, targets):
+                started = time.perf_counter()
+                vector_ranking = [int(index.ids[p]) for _, _, p in index.search(query_vector, RAG_CANDIDATES, nprobe)]
+                vector_ms = (time.perf_counter() - started) * 1000
+                started = time.perf_counter()
+                lexical_ranking = [int(index.ids[p]) for p, _ in index.lexical.search(terms(text), RAG_CANDIDATES)]
+                lexical_ms = (time.perf_counter() - started) * 1000
+                started = time.perf_counter()
+                fused = sorted(rrf([vector_ranking, lexical_ranking]).items(), key=lambda item: -item[1])
+                hybrid_ranking = [key for key, _ in fused]
+                latencies['vector'].append(vector_ms)
+                latencies['lexical'].append(lexical_ms)
+                latencies['hybrid'].append(vector_ms + lexical_ms + (time.perf_counter() - started) * 1000)
+                for mode, ranking in (('vector', vector_ranking), ('lexical', lexical_ranking), ('hybrid', hybrid_ranking)):
+                    found[mode] += int(doc) in ranking[:args.k]
+            for mode in ('vector', 'lexical', 'hybrid'):
+                values = sorted(latencies[mode])
+                print(
+                    f'{name:>9} {mode:>8} {found[mode] / len(queries):>7.3f} '
+                    f'{statistics.median(values):>8.2f} {percentile(values, 0.95):>8.2f}'
+                )
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Recall и QPS локального векторного индекса')
+    parser.add_argument('--count', type=int, default=1_000_000)
+    parser.add_argument('--dim', type=int, default=256)
+    parser.add_argument('--clusters', type=int, default=2000)
+    parser.add_argument('--noise', type=float, default=1.0)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--nlist', type=int, default=None, help='по умолчанию как в rag_index: sqrt(count)')
+    parser.add_argument('--nprobe', default='4,8,16,32,64')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--hybrid', action='store_true', help='гибридный поиск на синтетических текстах')
+    args = parser.parse_args()
+    if args.hybrid:
+        hybrid_bench(args)
+        return
+
+    rng = np.random.default_rng(args.seed)
+    started = time.perf_counter()
+    vectors = synthetic_vectors(args.count, args.dim, args.clusters, args.noise, rng)
+    picks = rng.integers(0, args.count, args.queries)
+    queries = normalize(vectors[picks] + 0.5 * rng.standard_normal((args.queries, args.dim)).astype(np.float32) / np.sqrt(args.dim))
+    print(f'data: {args.count} x {args.dim} in {time.perf_counter() - started:.1f}s')
+
+    started = time.perf_counter()
+    truth = exact_top_k(vectors, queries, args.k)
+    exact_ms = (time.perf_counter() - started) * 1000 / args.queries
+    print(f'exact float32 scan: {exact_ms:.2f} ms/query')
+
+    workdir = tempfile.mkdtemp(prefix='rag-bench-')
+    try:
+        path = os.path.join(workdir, 'index')
+        started = time.perf_counter()
+        build_index(path, np.arange(args.count), vectors, [''] * args.count, {'databaseId': 'bench', 'version': '1'}, nlist=args.nlist)
+        build_s = time.perf_counter() - started
+        del vectors
+        index = VectorIndex(path)
+        print(f'build: {build_s:.1f}s, nlist={index.meta["nlist"]}, on disk {directory_size(path) / 2**20:.0f} MiB')
+
+        print(f'{"nprobe":>7} {"recall@" + str(args.k):>10} {"qps":>8} {"p50 ms":>8} {"p95 ms":>8}')
+        for nprobe in [int(n) for n in args.nprobe.split(',')] if index.meta['nlist'] else [0]:
+            latencies: List[float] = []
+            found = 0
+            for query, expected in zip(queries, truth):
+                started = time.perf_counter()
+                hits = index.search(query, args.k, nprobe)
+                latencies.append((time.perf_counter() - started) * 1000)
+                found += len(set(expected.tolist()) & {hit[0] for hit in hits})
+            latencies.sort()
+            p95 = percentile(latencies, 0.95)
+            print(
+                f'{nprobe:>7} {found / (args.k * args.queries):>10.3f} {1000 / statistics.mean(latencies):>8.0f} '
+                f'{statistics.median(latencies):>8.2f} {p95:>8.2f}'
+            )
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+-- Инкрементально обновляемая статистика по ассистентам (вместо GROUP BY по assistant_usage)
+CREATE TABLE IF NOT EXISTS assistant_stats (
+    assistant_id VARCHAR(50) PRIMARY KEY,
+    total_messages BIGINT NOT NULL DEFAULT 0,
+    total_tokens BIGINT NOT NULL DEFAULT 0,
+    users_hll BYTEA NOT NULL DEFAULT decode(repeat('00', 4096), 'hex'),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+COMMENT ON TABLE assistant_stats IS 'Агрегированная статистика ассистентов, обновляется gptunnel-bot при каждом сообщении';
+COMMENT ON COLUMN assistant_stats.users_hll IS 'HyperLogLog-скетч уникальных user_id: 4096 регистров по 1 байту, хэш = первые 8 байт md5(user_id)';
+
+-- Переносим накопленную статистику из assistant_usage.
+-- Регистр HLL: индекс = старшие 12 бит хэша, значение = позиция первой единицы в оставшихся 52 битах.
+INSERT INTO assistant_stats (assistant_id, total_messages, total_tokens, users_hll)
+SELECT
+    totals.assistant_id,
+    totals.total_messages,
+    totals.total_tokens,
+    sketches.users_hll
+FROM (
+    SELECT assistant_id,
+           COALESCE(SUM(message_count), 0) AS total_messages,
+           COALESCE(SUM(tokens_used), 0) AS total_tokens
+    FROM assistant_usage
+    WHERE assistant_id IS NOT NULL
+    GROUP BY assistant_id
+) totals
+JOIN (
+    SELECT ids.assistant_id,
+           decode(string_agg(lpad(to_hex(COALESCE(registers.rank, 0)), 2, '0'), '' ORDER BY slots.idx), 'hex') AS users_hll
+    FROM (SELECT DISTINCT assistant_id FROM assistant_usage WHERE assistant_id IS NOT NULL) ids
+    CROSS JOIN generate_series(0, 4095) AS slots(idx)
+    LEFT JOIN (
+        SELECT assistant_id,
+               substring(hash_bits FROM 1 FOR 12)::bit(12)::integer AS idx,
+               MAX(CASE WHEN position('1' IN substring(hash_bits::text FROM 13)) = 0 THEN 53
+                        ELSE position('1' IN substring(hash_bits::text FROM 13)) END) AS rank
+        FROM (
+            SELECT DISTINCT assistant_id, ('x' || substr(md5(user_id), 1, 16))::bit(64) AS hash_bits
+            FROM assistant_usage
+            WHERE assistant_id IS NOT NULL
+        ) hashed
+        GROUP BY assistant_id, substring(hash_bits FROM 1 FOR 12)::bit(12)::integer
+    ) registers ON registers.assistant_id = ids.assistant_id AND registers.idx = slots.idx
+    GROUP BY ids.assistant_id
+) sketches ON sketches.assistant_id = totals.assistant_id
+ON CONFLICT (assistant_id) DO NOTHING;
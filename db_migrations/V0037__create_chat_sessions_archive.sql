@@ -0,0 +1,15 @@
+-- Архив сессий GPTunnel, давно не получавших сообщений (переносит функция maintenance)
+CREATE TABLE IF NOT EXISTS chat_sessions_archive (
+    id VARCHAR(255) PRIMARY KEY,
+    assistant_id VARCHAR(255) NOT NULL,
+    user_id VARCHAR(255) NOT NULL,
+    chat_id VARCHAR(255) NOT NULL,
+    message_count INTEGER DEFAULT 0,
+    created_at TIMESTAMP,
+    updated_at TIMESTAMP,
+    archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX idx_chat_sessions_archive_assistant_user ON chat_sessions_archive(assistant_id, user_id);
+
+COMMENT ON TABLE chat_sessions_archive IS 'Сессии chat_sessions без активности дольше порога; рабочая таблица остаётся маленькой';
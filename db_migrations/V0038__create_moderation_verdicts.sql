@@ -0,0 +1,16 @@
+-- Кэш вердиктов модерации: повторяющиеся сообщения виджета не уходят в GPTunnel повторно
+CREATE TABLE IF NOT EXISTS moderation_verdicts (
+    text_hash VARCHAR(64) PRIMARY KEY,
+    model VARCHAR(100),
+    result JSONB NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    expires_at TIMESTAMP NOT NULL
+);
+
+-- Индекс для очистки устаревших записей (функция maintenance)
+CREATE INDEX idx_moderation_verdicts_expires ON moderation_verdicts(expires_at);
+
+COMMENT ON TABLE moderation_verdicts IS 'Результаты /v1/moderations по sha256(модель + текст)';
+COMMENT ON COLUMN moderation_verdicts.text_hash IS 'sha256 от запрошенной модели и текста';
+COMMENT ON COLUMN moderation_verdicts.model IS 'Модель, которую вернул GPTunnel';
+COMMENT ON COLUMN moderation_verdicts.result IS 'Элемент results ответа GPTunnel';
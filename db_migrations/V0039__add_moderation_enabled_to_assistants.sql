@@ -0,0 +1,4 @@
+-- Модерация входящих сообщений виджета в gptunnel-bot (выполняется параллельно с генерацией)
+ALTER TABLE assistants ADD COLUMN moderation_enabled BOOLEAN DEFAULT FALSE NOT NULL;
+
+COMMENT ON COLUMN assistants.moderation_enabled IS 'Проверять сообщения пользователя через /v1/moderations; ответ на помеченное сообщение не показывается';
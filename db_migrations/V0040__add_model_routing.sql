@@ -0,0 +1,9 @@
+-- Маршрутизация между моделями: политика ассистента и стоимость каждого запроса для статистики моделей
+ALTER TABLE assistants ADD COLUMN routing_policy JSONB;
+
+ALTER TABLE api_requests ADD COLUMN total_cost DECIMAL(10, 6) DEFAULT 0;
+
+-- Скользящая статистика по модели за последние минуты (latency, доля ошибок, стоимость)
+CREATE INDEX IF NOT EXISTS idx_api_requests_model_created_at ON api_requests(model, created_at);
+
+COMMENT ON COLUMN assistants.routing_policy IS 'Политика выбора модели: {"strategy": "cheapest"|"fastest"|"fallback", "models": [...], "maxLatencyMs", "maxErrorRate", "timeoutMs"}';
@@ -0,0 +1,14 @@
+-- Каталог моделей GPTunnel (/v1/models): холодный контейнер отдаёт его из БД, не обращаясь к GPTunnel
+CREATE TABLE IF NOT EXISTS model_catalog (
+    id VARCHAR(100) PRIMARY KEY,
+    position INTEGER NOT NULL DEFAULT 0,
+    data JSONB NOT NULL,
+    context_window INTEGER,
+    prompt_price DECIMAL(12, 6),
+    completion_price DECIMAL(12, 6),
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+COMMENT ON COLUMN model_catalog.data IS 'Элемент data из ответа GPTunnel /v1/models как есть';
+COMMENT ON COLUMN model_catalog.prompt_price IS 'Цена 1000 токенов запроса, если GPTunnel её сообщает';
+COMMENT ON COLUMN model_catalog.completion_price IS 'Цена 1000 токенов ответа, если GPTunnel её сообщает';
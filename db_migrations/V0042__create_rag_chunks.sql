@@ -0,0 +1,16 @@
+-- Чанки RAG-баз с эмбеддингами для локального векторного поиска (rag_index.py)
+CREATE TABLE IF NOT EXISTS rag_chunks (
+    id BIGSERIAL PRIMARY KEY,
+    database_id VARCHAR(100) NOT NULL,
+    file_id VARCHAR(100),
+    position INTEGER NOT NULL DEFAULT 0,
+    content TEXT NOT NULL,
+    embedding BYTEA,
+    model VARCHAR(100),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_rag_chunks_database ON rag_chunks(database_id, id);
+CREATE INDEX IF NOT EXISTS idx_rag_chunks_file ON rag_chunks(database_id, file_id);
+
+COMMENT ON COLUMN rag_chunks.embedding IS 'Эмбеддинг float32 little-endian; индекс контейнера строится из этих строк';
@@ -0,0 +1,25 @@
+-- Задания потоковой загрузки документов в RAG-базы (rag-databases/rag_ingest.py):
+-- прогресс и контрольная точка, с которой продолжается прерванная загрузка
+CREATE TABLE IF NOT EXISTS rag_ingest_jobs (
+    id SERIAL PRIMARY KEY,
+    database_id VARCHAR(100) NOT NULL,
+    file_id VARCHAR(100),
+    name VARCHAR(255),
+    source_type VARCHAR(20) NOT NULL,
+    source_url TEXT,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',
+    lease VARCHAR(36),
+    units_done INTEGER NOT NULL DEFAULT 0,
+    units_total INTEGER,
+    chunks_done INTEGER NOT NULL DEFAULT 0,
+    checkpoint JSONB,
+    error TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_rag_ingest_jobs_status ON rag_ingest_jobs(status, updated_at);
+CREATE INDEX IF NOT EXISTS idx_rag_ingest_jobs_file ON rag_ingest_jobs(database_id, file_id);
+
+COMMENT ON COLUMN rag_ingest_jobs.status IS 'pending | running | done | failed | cancelled';
+COMMENT ON COLUMN rag_ingest_jobs.checkpoint IS 'Состояние чанкера после units_done единиц источника (страниц, строк, абзацев)';
@@ -0,0 +1,24 @@
+-- MinHash-сигнатуры чанков и хэши полос LSH для поиска почти-дубликатов при загрузке (rag-databases/rag_dedup.py)
+ALTER TABLE rag_chunks ADD COLUMN IF NOT EXISTS minhash BYTEA;
+ALTER TABLE rag_chunks ADD COLUMN IF NOT EXISTS lsh_bands BIGINT[];
+
+CREATE INDEX IF NOT EXISTS idx_rag_chunks_lsh_bands ON rag_chunks USING GIN (lsh_bands);
+
+-- Чанк, пропущенный как дубликат, остаётся ссылкой на оригинал из другого файла:
+-- при удалении файла-владельца оригинал переходит к файлу из ссылки
+CREATE TABLE IF NOT EXISTS rag_chunk_duplicates (
+    id SERIAL PRIMARY KEY,
+    database_id VARCHAR(100) NOT NULL,
+    chunk_id BIGINT NOT NULL REFERENCES rag_chunks(id) ON DELETE CASCADE,
+    file_id VARCHAR(100),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE (chunk_id, file_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_rag_chunk_duplicates_file ON rag_chunk_duplicates(database_id, file_id);
+
+ALTER TABLE rag_ingest_jobs ADD COLUMN IF NOT EXISTS duplicates_skipped INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE rag_ingest_jobs ADD COLUMN IF NOT EXISTS duplicate_chars BIGINT NOT NULL DEFAULT 0;
+
+COMMENT ON COLUMN rag_chunks.minhash IS 'MinHash-сигнатура: 64 значения uint32 little-endian';
+COMMENT ON COLUMN rag_chunks.lsh_bands IS 'Хэши 16 полос сигнатуры, солённые database_id';
@@ -0,0 +1,20 @@
+-- Упреждающий поиск gptunnel-bot: поиск по слотам из сообщения стартует параллельно с первым вызовом GPTunnel
+CREATE TABLE IF NOT EXISTS prefetch_stats (
+    assistant_id VARCHAR(50) NOT NULL,
+    date DATE NOT NULL DEFAULT CURRENT_DATE,
+    turns INTEGER NOT NULL DEFAULT 0,
+    speculated INTEGER NOT NULL DEFAULT 0,
+    hits INTEGER NOT NULL DEFAULT 0,
+    misses INTEGER NOT NULL DEFAULT 0,
+    saved_ms BIGINT NOT NULL DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (assistant_id, date)
+);
+
+COMMENT ON TABLE prefetch_stats IS 'Исходы упреждающего поиска по ассистентам с интеграцией поиска, по дням';
+COMMENT ON COLUMN prefetch_stats.turns IS 'Ходы ассистента с интеграцией поиска';
+COMMENT ON COLUMN prefetch_stats.speculated IS 'Ходы, где слоты нашлись локально и поиск был запущен заранее';
+COMMENT ON COLUMN prefetch_stats.hits IS 'tool_call совпал с догадкой, результат переиспользован';
+COMMENT ON COLUMN prefetch_stats.misses IS 'tool_call пришёл с другими аргументами, результат отброшен';
+COMMENT ON COLUMN prefetch_stats.saved_ms IS 'Суммарное время поиска, прошедшее до того, как он понадобился';
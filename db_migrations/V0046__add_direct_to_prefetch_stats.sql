@@ -0,0 +1,4 @@
+-- Ходы режима json, обслуженные без вызова модели: параметры поиска разобраны правилами (gptunnel-bot/slots.py)
+ALTER TABLE prefetch_stats ADD COLUMN direct INTEGER NOT NULL DEFAULT 0;
+
+COMMENT ON COLUMN prefetch_stats.direct IS 'Ходы, где сообщение разобрано локально и поиск выполнен без вызова модели';
@@ -0,0 +1,7 @@
+-- Ключ search_cache строится только из параметров, уходящих в API, в канонической форме:
+-- max_price и exclude_property_types применяются к закэшированному результату
+COMMENT ON COLUMN search_cache.cache_key IS 'md5 канонизированных параметров запроса к API (город из справочника, без клиентских фильтров)';
+COMMENT ON COLUMN search_cache.search_params IS 'Канонизированные параметры запроса, из которых посчитан ключ';
+
+-- Записи со старыми ключами больше не находятся и только занимают место до истечения
+DELETE FROM search_cache WHERE search_params ? 'max_price';
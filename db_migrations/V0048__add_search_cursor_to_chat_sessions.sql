@@ -0,0 +1,5 @@
+-- Курсор по результатам последнего поиска в режиме json: «покажи ещё» и пересортировка
+-- отдаются из search_cache без вызова модели и API
+ALTER TABLE chat_sessions ADD COLUMN search_cursor JSONB;
+
+COMMENT ON COLUMN chat_sessions.search_cursor IS 'Последний поиск: cacheKey в search_cache, аргументы запроса, клиентские фильтры, показано (offset), сортировка';
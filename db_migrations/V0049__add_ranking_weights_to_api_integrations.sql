@@ -0,0 +1,12 @@
+-- Ранжирование результатов поиска в gptunnel-bot (ranking.py): веса признаков на интеграцию
+ALTER TABLE api_integrations ADD COLUMN ranking_weights JSONB;
+
+COMMENT ON COLUMN api_integrations.ranking_weights IS 'Веса ранжирования результатов: {"price", "rating", "distance", "capacity"} >= 0; "presort": true — ранжировать ответ API один раз при записи в search_cache. NULL — порядок API';
+
+-- QQRenta: дешевле и с рейтингом выше, затем ближе к центру и по числу гостей
+UPDATE api_integrations
+SET ranking_weights = '{"price": 1.0, "rating": 1.0, "distance": 0.5, "capacity": 0.5}'::jsonb,
+    updated_at = CURRENT_TIMESTAMP
+WHERE id = '4a9b3f88-56dd-4913-ad60-7f495ffafa56';
+
+COMMENT ON COLUMN search_cache.cache_key IS 'md5 канонизированных параметров запроса к API (город из справочника, без клиентских фильтров); у ответов, ранжированных при записи, — вместе с весами presort';
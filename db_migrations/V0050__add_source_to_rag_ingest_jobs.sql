@@ -0,0 +1,5 @@
+-- Источник загрузки, пришедший в теле запроса, хранится в задании: продолжить его может любой контейнер,
+-- а не только тот, что принял файл. Очищается, когда задание завершено, упало или отменено
+ALTER TABLE rag_ingest_jobs ADD COLUMN source BYTEA;
+
+COMMENT ON COLUMN rag_ingest_jobs.source IS 'Декодированный источник из тела запроса (текст или файл); NULL — источник по source_url или задание завершено';
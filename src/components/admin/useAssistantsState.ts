@@ -32,6 +32,7 @@ export const useAssistantsState = () => {
     humanEmulation: 5,
     creativity: 0.7,
     voiceRecognition: false,
+    moderationEnabled: false,
     ragDatabaseIds: [] as string[],
     assistantCode: ''
   });
@@ -81,6 +82,7 @@ export const useAssistantsState = () => {
       humanEmulation: assistant.humanEmulation || 5,
       creativity: assistant.creativity !== undefined && assistant.creativity !== null ? assistant.creativity : 0.7,
       voiceRecognition: assistant.voiceRecognition || false,
+      moderationEnabled: assistant.moderationEnabled || false,
       ragDatabaseIds: assistant.ragDatabaseIds || [],
       assistantCode: assistant.assistantCode || ''
     };
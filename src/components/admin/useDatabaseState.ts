@@ -36,7 +36,8 @@ export const useDatabaseState = () => {
     console.log('[useDatabaseState] fetchDatabases called');
     setIsLoading(true);
     try {
-      const response = await fetch(RAG_API_URL, {
+      // Базы сразу со списками файлов: одна загрузка страницы вместо запроса на каждую базу
+      const response = await fetch(`${RAG_API_URL}?include=files`, {
         method: 'GET',
       });
 
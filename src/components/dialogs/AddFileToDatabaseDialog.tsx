@@ -20,6 +20,54 @@ type SourceType = 'text' | 'api' | 'xml' | 'json' | 'pdf' | 'docx' | 'csv' | 'ex
 
 const RAG_API_URL = 'https://functions.poehali.dev/101d01cd-5cab-43fa-a4c9-87a37f3b38b4';
 
+// Файл из формы уходит в теле запроса в base64 (+33%), а тело вызова функции ограничено шлюзом.
+// Документы крупнее загружаются по ссылке: сервер скачивает их сам (fileUrl)
+const INLINE_FILE_MAX_BYTES = 2.5 * 1024 * 1024;
+const BINARY_SOURCE_TYPES: SourceType[] = ['pdf', 'docx', 'csv', 'excel'];
+
+interface IngestJob {
+  id: number;
+  status: 'pending' | 'running' | 'done' | 'failed' | 'cancelled';
+  unitsDone: number;
+  unitsTotal: number | null;
+  chunks: number;
+  progress: number | null;
+  error: string | null;
+}
+
+const readAsDataUrl = (file: File) =>
+  new Promise<string>((resolve, reject) => {
+    const reader = new FileReader();
+    reader.onload = () => resolve(reader.result as string);
+    reader.onerror = () => reject(reader.error);
+    reader.readAsDataURL(file);
+  });
+
+// Большой документ разбирается на сервере по частям: каждый запрос продолжает задание с контрольной точки
+const waitForIngest = async (initial: IngestJob, toastId: string | number) => {
+  let job = initial;
+  while (job.status === 'pending' || job.status === 'running') {
+    const progress = job.progress !== null ? `${Math.round(job.progress * 100)}%` : `${job.chunks} фрагментов`;
+    toast.loading(`Индексация документа: ${progress}`, { id: toastId });
+    if (job.status === 'running') {
+      await new Promise((resolve) => setTimeout(resolve, 3000));
+    }
+    const response = await fetch(RAG_API_URL, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ jobId: job.id }),
+    });
+    if (!response.ok) {
+      throw new Error('Не удалось получить статус индексации');
+    }
+    job = await response.json();
+  }
+  if (job.status === 'failed') {
+    throw new Error(job.error || 'Ошибка индексации документа');
+  }
+  return job;
+};
+
 export const AddFileToDatabaseDialog = ({ 
   open, 
   onOpenChange, 
@@ -31,6 +79,7 @@ export const AddFileToDatabaseDialog = ({
   const [sourceType, setSourceType] = useState<SourceType>('text');
   const [content, setContent] = useState('');
   const [file, setFile] = useState<File | null>(null);
+  const [fileUrl, setFileUrl] = useState('');
   const [isLoading, setIsLoading] = useState(false);
 
   const handleFileChange = (e: React.ChangeEvent<HTMLInputElement>) => {
@@ -49,8 +98,15 @@ export const AddFileToDatabaseDialog = ({
       return;
     }
 
-    if (!content.trim() && !file) {
-      toast.error('Введите содержимое или выберите файл');
+    const linkedFile = BINARY_SOURCE_TYPES.includes(sourceType) && !file ? fileUrl.trim() : '';
+
+    if (!content.trim() && !file && !linkedFile) {
+      toast.error('Введите содержимое, выберите файл или укажите ссылку');
+      return;
+    }
+
+    if (file && BINARY_SOURCE_TYPES.includes(sourceType) && file.size > INLINE_FILE_MAX_BYTES) {
+      toast.error('Файл больше 2,5 МБ: укажите ссылку на него вместо загрузки');
       return;
     }
 
@@ -63,9 +119,7 @@ export const AddFileToDatabaseDialog = ({
         if (sourceType === 'text' || sourceType === 'json' || sourceType === 'xml') {
           finalContent = await file.text();
         } else {
-          toast.error('Загрузка бинарных файлов пока не поддерживается');
-          setIsLoading(false);
-          return;
+          finalContent = await readAsDataUrl(file);
         }
       }
 
@@ -79,6 +133,7 @@ export const AddFileToDatabaseDialog = ({
           name,
           sourceType,
           content: finalContent,
+          ...(linkedFile ? { fileUrl: linkedFile } : {}),
         }),
       });
 
@@ -87,10 +142,23 @@ export const AddFileToDatabaseDialog = ({
         throw new Error(errorData.error || 'Ошибка добавления файла');
       }
 
-      toast.success('Файл успешно добавлен');
+      const result = await response.json();
+      if (result.ingestJob) {
+        const toastId = toast.loading('Индексация документа...');
+        try {
+          const job = await waitForIngest(result.ingestJob, toastId);
+          toast.success(`Файл добавлен: ${job.chunks} фрагментов`, { id: toastId });
+        } catch (error) {
+          toast.dismiss(toastId);
+          throw error;
+        }
+      } else {
+        toast.success('Файл успешно добавлен');
+      }
       setName('');
       setContent('');
       setFile(null);
+      setFileUrl('');
       setSourceType('text');
       onOpenChange(false);
       onSuccess();
@@ -169,7 +237,7 @@ export const AddFileToDatabaseDialog = ({
                   id="file-upload"
                   type="file"
                   onChange={handleFileChange}
-                  accept={sourceType === 'text' ? '.txt' : sourceType === 'json' ? '.json' : sourceType === 'xml' ? '.xml' : '*'}
+                  accept={sourceType === 'text' ? '.txt' : sourceType === 'json' ? '.json' : sourceType === 'xml' ? '.xml' : sourceType === 'pdf' ? '.pdf' : sourceType === 'docx' ? '.docx' : sourceType === 'csv' ? '.csv' : sourceType === 'excel' ? '.xlsx' : '*'}
                   className="mt-1"
                 />
                 {file && (
@@ -180,6 +248,20 @@ export const AddFileToDatabaseDialog = ({
                 )}
               </div>
 
+              {BINARY_SOURCE_TYPES.includes(sourceType) && (
+                <div>
+                  <Label htmlFor="file-url">Или ссылка на файл (для документов больше 2,5 МБ)</Label>
+                  <Input
+                    id="file-url"
+                    value={fileUrl}
+                    onChange={(e) => setFileUrl(e.target.value)}
+                    placeholder="https://example.com/document.pdf"
+                    className="mt-1"
+                    disabled={!!file}
+                  />
+                </div>
+              )}
+
               <div>
                 <Label htmlFor="content">Или введите содержимое</Label>
                 <Textarea
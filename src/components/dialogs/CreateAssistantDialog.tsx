@@ -21,6 +21,7 @@ interface AssistantConfig {
   humanEmulation: number;
   creativity: number;
   voiceRecognition: boolean;
+  moderationEnabled: boolean;
   ragDatabaseIds?: string[];
   assistantCode?: string;
 }
@@ -45,6 +46,7 @@ const defaultConfig: AssistantConfig = {
   humanEmulation: 5,
   creativity: 0.7,
   voiceRecognition: false,
+  moderationEnabled: false,
   ragDatabaseIds: [],
   assistantCode: ''
 };
@@ -358,6 +360,20 @@ export const CreateAssistantDialog = ({
             </div>
               </>
             )}
+
+            <div className="flex items-center justify-between space-x-4 rounded-lg border border-border bg-muted/50 p-4">
+              <div className="space-y-1 flex-1">
+                <Label htmlFor="moderation">Модерация сообщений</Label>
+                <p className="text-xs text-muted-foreground">
+                  Сообщения проверяются параллельно с генерацией ответа; ответ на недопустимое сообщение не показывается
+                </p>
+              </div>
+              <Switch
+                id="moderation"
+                checked={config.moderationEnabled}
+                onCheckedChange={(v) => updateConfig('moderationEnabled', v)}
+              />
+            </div>
           </div>
         </ScrollArea>
 
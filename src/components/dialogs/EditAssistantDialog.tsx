@@ -21,6 +21,7 @@ interface AssistantConfig {
   humanEmulation: number;
   creativity: number;
   voiceRecognition: boolean;
+  moderationEnabled: boolean;
   ragDatabaseIds?: string[];
   assistantCode?: string;
 }
@@ -349,6 +350,20 @@ export const EditAssistantDialog = ({
             </div>
               </>
             )}
+
+            <div className="flex items-center justify-between space-x-4 rounded-lg border border-border bg-muted/50 p-4">
+              <div className="space-y-1 flex-1">
+                <Label htmlFor="edit-moderation">Модерация сообщений</Label>
+                <p className="text-xs text-muted-foreground">
+                  Сообщения проверяются параллельно с генерацией ответа; ответ на недопустимое сообщение не показывается
+                </p>
+              </div>
+              <Switch
+                id="edit-moderation"
+                checked={config.moderationEnabled}
+                onCheckedChange={(v) => updateConfig('moderationEnabled', v)}
+              />
+            </div>
           </div>
         </ScrollArea>
 